@@ -0,0 +1,243 @@
+import pandas as pd
+import requests
+import argparse
+import sys
+import os
+from datetime import datetime, timedelta
+import time
+
+# This script counts alerts by severity, device, policy, reason code, threat ID or any other alert field over the last
+# --days_to_export days, for dashboards that only need the numbers. It asks the alerts v7 facet API for the counts, so
+# no alert is downloaded at all. Where the facet API is not available (or with --no_facet) it falls back to paging
+# through the alert search and counting as it goes, keeping only the counted fields of each page, never the alerts.
+# The facet API returns the --rows most common values of each field; the fallback counts every value.
+# The counts are saved to a CSV file with one row per field and value, e.g.
+#   field,value,count
+#   severity,3,1520
+
+# Usage: python alert-facets.py --help
+
+# API key permissions required:
+# Alerts - General information - org.alerts - read
+
+DEFAULT_FIELDS = "severity,device_name,device_policy,reason_code,threat_id"
+# The alert search returns at most this many alerts for one query, however it is paged
+MAX_RESULTS = 10000
+# Alerts per page when counting from the alert search, so only this many full alerts are held at once
+PAGE_SIZE = 500
+
+
+def get_environment(environment):
+    # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
+
+    # rtype: string
+
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
+    if environment == "EAP1":
+        return "https://defense-eap01.confer.deploy.net"
+    elif environment == "PROD01":
+        return "https://dashboard.confer.net"
+    elif environment == "PROD02":
+        return "https://defense.conferdeploy.net"
+    elif environment == "PROD05":
+        return "https://defense-prod05.conferdeploy.net"
+    elif environment == "PROD06":
+        return "https://defense-eu.conferdeploy.net"
+    elif environment == "PRODNRT":
+        return "https://defense-prodnrt.conferdeploy.net"
+    elif environment == "PRODSYD":
+        return "https://defense-prodsyd.conferdeploy.net"
+    elif environment == "PRODUK":
+        return "https://ew2.carbonblack.vmware.com"
+    elif environment == "GOVCLOUD":
+        return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
+
+
+def setup_session(api_secret, api_id):
+    s = requests.session()
+    headers = {
+        "X-Auth-Token": f"{api_secret}/{api_id}",
+        "Content-Type": "application/json"
+        }
+    s.headers.update(headers)
+    return s
+
+
+def build_facet_url(environment, org_key):
+    # Build the facet URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/alerts-api/#alert-facet
+
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/api/alerts/v7/orgs/{org_key}/alerts/_facet"
+
+
+def build_search_url(environment, org_key):
+    # Build the search URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/alerts-api/#alert-search
+
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/api/alerts/v7/orgs/{org_key}/alerts/_search"
+
+
+def alert_values(alert, field):
+    # The values of one field of an alert: workflow_status lives in the workflow object, and list fields count once
+    # per entry
+
+    # rtype: list
+    if field == 'workflow_status':
+        value = (alert.get('workflow') or {}).get('status')
+    else:
+        value = alert.get(field)
+    if value is None:
+        return []
+    if isinstance(value, list):
+        return [str(v) for v in value]
+    return [str(value)]
+
+
+def facet_counts(session, environment, org_key, payload, fields, rows):
+    # Ask the facet API for the counts of every field
+
+    # rtype: dict or None (when the facet API is not available)
+    facet_payload = dict(payload, terms={"fields": fields, "rows": rows})
+    response = session.post(build_facet_url(environment, org_key), json=facet_payload)
+    if response.status_code != 200:
+        print(f"Facet request failed {response}, counting from the alert search instead")
+        return None
+    print(f"Success {response}")
+    counts = {field: {} for field in fields}
+    for facet in response.json()['results']:
+        counts[facet['field']] = {str(value['id']): value['total'] for value in facet['values']}
+    for field, values in counts.items():
+        if len(values) >= rows:
+            print(f"{field}: only the {rows} most common values were returned (see --rows)")
+    return counts
+
+
+def search_counts(session, environment, org_key, payload, fields, start, end, counts, page_size=PAGE_SIZE):
+    # Page through the alerts between start and end, page_size at a time, adding the values of the fields to counts.
+    # A time range holding more alerts than one search can return is split in two.
+
+    # rtype: int (alerts counted) or None
+    url = build_search_url(environment, org_key)
+    page = dict(payload, time_range={"start": start.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+                                     "end": end.strftime('%Y-%m-%dT%H:%M:%S.%fZ')}, start=1, rows=page_size)
+    response = session.post(url, json=dict(page, rows=1))
+    if response.status_code >= 300:
+        print(response)
+        return None
+    num_found = response.json()['num_found']
+    if num_found > MAX_RESULTS and end - start > timedelta(seconds=1):
+        middle = start + (end - start) / 2
+        first = search_counts(session, environment, org_key, payload, fields, start, middle, counts, page_size)
+        second = search_counts(session, environment, org_key, payload, fields, middle, end, counts, page_size)
+        if first is None or second is None:
+            return None
+        return first + second
+
+    counted = 0
+    while counted < min(num_found, MAX_RESULTS):
+        page['start'] = counted + 1
+        response = session.post(url, json=page)
+        if response.status_code >= 300:
+            print(response)
+            return None
+        alerts = response.json()['results']
+        if not alerts:
+            break
+        for alert in alerts:
+            for field in fields:
+                for value in alert_values(alert, field):
+                    counts[field][value] = counts[field].get(value, 0) + 1
+        counted += len(alerts)
+        # Let the page go before the next one is requested
+        del alerts
+    print(f"Counted {counted} alerts from {page['time_range']['start']} to {page['time_range']['end']}")
+    return counted
+
+
+def main():
+    # Main function to parse arguments and retrieve the alert counts
+
+    parser = argparse.ArgumentParser(prog="alert-facets.py",
+                                     description="Count VMware Carbon Black Cloud v7 alerts by field.")
+    requiredNamed = parser.add_argument_group('required arguments')
+    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
+                               choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                        "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                               help="Environment for the Base URL")
+    requiredNamed.add_argument("-o", "--org_key", required=True,
+                               help="Org key (found in your product console under Settings > API Access > API Keys)")
+    requiredNamed.add_argument("-i", "--api_id", required=True,
+                               help="API ID")
+    requiredNamed.add_argument("-s", "--api_secret", required=True,
+                               help="API Secret Key")
+    requiredNamed.add_argument("-d", "--days_to_export", required=True, type=int, help="Days of alerts to count")
+    parser.add_argument("-f", "--fields", default=DEFAULT_FIELDS,
+                        help="Comma separated alert fields to count by (default: " + DEFAULT_FIELDS + ")")
+    parser.add_argument("-q", "--query", default="", help="Alert search query to narrow down the alerts counted")
+    parser.add_argument("--minimum_severity", type=int, default=1, help="Lowest alert severity to count")
+    parser.add_argument("--rows", type=int, default=100, help="Values per field returned by the facet API")
+    parser.add_argument("--no_facet", action='store_true',
+                        help="Count from the alert search instead of the facet API, for exact counts of every value")
+    parser.add_argument("--page_size", type=int, default=PAGE_SIZE,
+                        help="Alerts per search page when counting from the alert search")
+    args = parser.parse_args()
+
+    fields = [field.strip() for field in args.fields.split(',') if field.strip()]
+    session = setup_session(args.api_secret, args.api_id)
+    end = datetime.combine(datetime.now() + timedelta(days=1), datetime.min.time())
+    start = end - timedelta(days=args.days_to_export)
+
+    payload = {
+        "query": args.query,
+        "time_range": {
+            "start": start.strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            "end": end.strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+        },
+        "criteria": {
+            "minimum_severity": args.minimum_severity,
+            "workflow_status": [
+                "OPEN",
+                "IN_PROGRESS",
+                "CLOSED"
+            ]
+        }
+    }
+
+    counts = None
+    if not args.no_facet:
+        counts = facet_counts(session, args.environment, args.org_key, payload, fields, args.rows)
+    if counts is None:
+        counts = {field: {} for field in fields}
+        counted = search_counts(session, args.environment, args.org_key, payload, fields, start, end, counts,
+                                args.page_size)
+        if counted is None:
+            return 1
+        print(f"Counted {counted} alerts")
+
+    rows = [{"field": field, "value": value, "count": count}
+            for field in fields
+            for value, count in sorted(counts[field].items(), key=lambda item: (-item[1], item[0]))]
+    counts_df = pd.DataFrame(rows, columns=["field", "value", "count"])
+    for field in fields:
+        top = counts_df[counts_df['field'] == field].head(5)
+        print(f"{field}: " + ", ".join(f"{value} ({count})" for value, count in zip(top['value'], top['count'])))
+
+    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+    counts_df.to_csv('alert-facets-' + timestamp + '.csv', index=False)
+    print('Saved to \'alert-facets-' + timestamp + '.csv\'')  # let the user know
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
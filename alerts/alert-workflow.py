@@ -0,0 +1,257 @@
+import pandas as pd
+import requests
+import argparse
+import sys
+import os
+import time
+from datetime import datetime, timedelta
+
+# This script closes, reopens or annotates alerts in bulk with the alerts v7 workflow API: a handful of workflow jobs
+# instead of one call per alert. Pick the alerts either with a list of alert ids (--ids, or --id_file with one id per
+# line or a CSV such as the one export-alerts-v7.py writes, which has an "id" column) or with an alert search query
+# over the last --days days. Listed ids are changed whatever their age. Ids are sent --chunk_size per job; a query is a
+# single job that the server applies to every matching alert. Each job is then polled, waiting a little longer after
+# every poll (up to --max_wait seconds), until it completes, and the number of alerts each job changed is reported. A
+# job that fails or does not finish within --timeout seconds is reported with its status and message.
+# Use --dry_run to see how many alerts would be changed without changing anything.
+
+# Examples:
+#   python alert-workflow.py -e PROD05 -o ORGKEY -i APIID -s APISECRET --id_file alerts-v7-20240101-120000.csv \
+#       --status CLOSED --closure_reason RESOLVED_BENIGN_KNOWN_GOOD --determination FALSE_POSITIVE --note "Tuning"
+#   python alert-workflow.py -e PROD05 -o ORGKEY -i APIID -s APISECRET -q "device_name:lab-*" --days 7 \
+#       --status CLOSED --closure_reason OTHER
+
+# Usage: python alert-workflow.py --help
+
+# API key permissions required:
+# Alerts - General information - org.alerts - read
+# Alerts - Alert Closure - org.alerts.close - execute
+# Background tasks - Status - jobs.status - read
+
+
+def get_environment(environment):
+    # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
+
+    # rtype: string
+
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
+    if environment == "EAP1":
+        return "https://defense-eap01.confer.deploy.net"
+    elif environment == "PROD01":
+        return "https://dashboard.confer.net"
+    elif environment == "PROD02":
+        return "https://defense.conferdeploy.net"
+    elif environment == "PROD05":
+        return "https://defense-prod05.conferdeploy.net"
+    elif environment == "PROD06":
+        return "https://defense-eu.conferdeploy.net"
+    elif environment == "PRODNRT":
+        return "https://defense-prodnrt.conferdeploy.net"
+    elif environment == "PRODSYD":
+        return "https://defense-prodsyd.conferdeploy.net"
+    elif environment == "PRODUK":
+        return "https://ew2.carbonblack.vmware.com"
+    elif environment == "GOVCLOUD":
+        return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
+
+
+def setup_session(api_secret, api_id):
+    s = requests.session()
+    headers = {
+        "X-Auth-Token": f"{api_secret}/{api_id}",
+        "Content-Type": "application/json"
+        }
+    s.headers.update(headers)
+    return s
+
+
+def build_workflow_url(environment, org_key):
+    # Build the workflow URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/alerts-api/#update-alert-workflow
+
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/api/alerts/v7/orgs/{org_key}/alerts/workflow"
+
+
+def build_job_url(environment, org_key, job_id):
+    # Build the job status URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/jobs-api/#get-job
+
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/jobs/v1/orgs/{org_key}/jobs/{job_id}"
+
+
+def build_search_url(environment, org_key):
+    # Build the search URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/alerts-api/#alert-search
+
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/api/alerts/v7/orgs/{org_key}/alerts/_search"
+
+
+def read_ids(ids, id_file):
+    # Collect the alert ids from the command line and the id file, without repeats
+
+    # rtype: list
+    alert_ids = [alert_id.strip() for alert_id in (ids or "").split(',') if alert_id.strip()]
+    if id_file:
+        if id_file.endswith('.csv'):
+            alert_ids.extend(str(alert_id) for alert_id in pd.read_csv(id_file, usecols=['id'])['id'].dropna())
+        else:
+            with open(id_file, 'r') as f:
+                alert_ids.extend(line.strip() for line in f if line.strip())
+    return list(dict.fromkeys(alert_ids))
+
+
+def submit_job(session, environment, org_key, payload):
+    # Start a workflow job and return its id
+
+    # rtype: string or None
+    response = session.post(build_workflow_url(environment, org_key), json=payload)
+    if response.status_code >= 300:
+        print(f"Workflow request failed {response}: {response.text}")
+        return None
+    print(f"Success {response}")
+    return response.json()['request_id']
+
+
+def wait_for_job(session, environment, org_key, job_id, max_wait, timeout):
+    # Poll a job until it completes, waiting 1 second after the first poll and half as long again after each one after
+    # that, up to max_wait seconds between polls
+
+    # rtype: dict (the last job status, which is not COMPLETED when the job failed or timed out) or None
+    url = build_job_url(environment, org_key, job_id)
+    wait = 1.0
+    deadline = time.time() + timeout
+    while True:
+        response = session.get(url)
+        if response.status_code >= 300:
+            print(f"Job {job_id} status request failed {response}")
+            return None
+        job = response.json()
+        if job['status'] in ("COMPLETED", "FAILED"):
+            return job
+        if time.time() + wait > deadline:
+            print(f"Job {job_id} timed out after {timeout} seconds")
+            return job
+        progress = job.get('progress') or {}
+        print(f"Job {job_id} {job['status']}: {progress.get('num_completed', 0)} of {progress.get('num_total', '?')}")
+        time.sleep(wait)
+        wait = min(wait * 1.5, max_wait)
+
+
+def main():
+    # Main function to parse arguments and update the alerts
+
+    parser = argparse.ArgumentParser(prog="alert-workflow.py",
+                                     description="Close, reopen or annotate VMware Carbon Black Cloud v7 alerts "
+                                                 "in bulk.")
+    requiredNamed = parser.add_argument_group('required arguments')
+    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
+                               choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                        "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                               help="Environment for the Base URL")
+    requiredNamed.add_argument("-o", "--org_key", required=True,
+                               help="Org key (found in your product console under Settings > API Access > API Keys)")
+    requiredNamed.add_argument("-i", "--api_id", required=True,
+                               help="API ID")
+    requiredNamed.add_argument("-s", "--api_secret", required=True,
+                               help="API Secret Key")
+    requiredNamed.add_argument("--status", required=True, choices=["OPEN", "IN_PROGRESS", "CLOSED"],
+                               help="Workflow status to set")
+    parser.add_argument("--ids", help="Comma separated alert ids")
+    parser.add_argument("--id_file", help="File of alert ids, one per line, or a CSV file with an id column")
+    parser.add_argument("-q", "--query", help="Alert search query selecting the alerts to update")
+    parser.add_argument("--days", type=int, default=30, help="Days of alerts the query covers")
+    parser.add_argument("--closure_reason",
+                        choices=["NO_REASON", "RESOLVED", "RESOLVED_BENIGN_KNOWN_GOOD", "DUPLICATE_CLEANUP", "OTHER"],
+                        help="Closure reason to set (default NO_REASON when closing, none otherwise)")
+    parser.add_argument("--determination", choices=["TRUE_POSITIVE", "FALSE_POSITIVE", "NONE"],
+                        help="Determination to set")
+    parser.add_argument("--note", help="Note to add to every alert")
+    parser.add_argument("--chunk_size", type=int, default=1000, help="Alert ids per workflow job")
+    parser.add_argument("--max_wait", type=float, default=30, help="Longest wait in seconds between job status polls")
+    parser.add_argument("--timeout", type=float, default=1800, help="Seconds to wait for each job to complete")
+    parser.add_argument("--dry_run", action='store_true', help="Report how many alerts would change, change nothing")
+    args = parser.parse_args()
+
+    alert_ids = read_ids(args.ids, args.id_file)
+    if bool(alert_ids) == bool(args.query):
+        parser.error("give either alert ids (--ids/--id_file) or a --query")
+
+    session = setup_session(args.api_secret, args.api_id)
+    update = {"status": args.status}
+    if args.closure_reason or args.status == "CLOSED":
+        update["closure_reason"] = args.closure_reason or "NO_REASON"
+    if args.determination:
+        update["determination"] = args.determination
+    if args.note:
+        update["note"] = args.note
+
+    # One payload per job: chunks of ids, or the query over the time range. Listed ids carry no time range, so none of
+    # them is skipped for its age. The dry run searches with the same criteria, query and time range as the jobs.
+    if alert_ids:
+        payloads = [dict(update, criteria={"id": alert_ids[i:i + args.chunk_size]})
+                    for i in range(0, len(alert_ids), args.chunk_size)]
+        print(f"{len(alert_ids)} alerts in {len(payloads)} jobs of up to {args.chunk_size}")
+    else:
+        end = datetime.now()
+        payloads = [dict(update, query=args.query, time_range={
+            "start": (end - timedelta(days=args.days)).strftime('%Y-%m-%dT%H:%M:%S.%fZ'),
+            "end": end.strftime('%Y-%m-%dT%H:%M:%S.%fZ')})]
+
+    if args.dry_run:
+        total = 0
+        for payload in payloads:
+            search = {key: payload[key] for key in ("query", "time_range", "criteria") if key in payload}
+            response = session.post(build_search_url(args.environment, args.org_key), json=dict(search, rows=1))
+            if response.status_code >= 300:
+                print(response)
+                return 1
+            total += response.json()['num_found']
+        print(f"Dry run: {total} alerts would be set to {args.status}")
+        return 0
+
+    # Submit every job first so the server works on them together, then wait for each one
+    jobs = []
+    for payload in payloads:
+        job_id = submit_job(session, args.environment, args.org_key, payload)
+        if job_id is None:
+            break
+        jobs.append(job_id)
+
+    affected = 0
+    completed = 0
+    for job_id in jobs:
+        job = wait_for_job(session, args.environment, args.org_key, job_id, args.max_wait, args.timeout)
+        if job is None:
+            continue
+        progress = job.get('progress') or {}
+        if job['status'] != "COMPLETED":
+            errors = {key: job[key] for key in ("errors", "error_code", "message") if job.get(key)}
+            print(f"Job {job_id} {job['status']}: {progress.get('num_completed', 0)} of "
+                  f"{progress.get('num_total', '?')} alerts updated, message: {progress.get('message') or 'none'}"
+                  + (f", {errors}" if errors else ""))
+            continue
+        completed += 1
+        affected += progress.get('num_completed', 0)
+        print(f"Job {job_id} completed: {progress.get('num_completed', 0)} alerts updated")
+
+    print(f"{affected} alerts set to {args.status} by {completed} of {len(payloads)} jobs")
+    return 0 if completed == len(payloads) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
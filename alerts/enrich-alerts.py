@@ -0,0 +1,336 @@
+import requests
+import argparse
+import sys
+import json
+import time
+import threading
+import queue
+import os
+from datetime import datetime, timedelta
+
+# The process detail cache lives in tools/process_cache.py, shared with the other process scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools"))
+from process_cache import ProcessDetailCache  # noqa: E402
+
+# This script enriches alerts with their observations and the details of the processes involved, in one pipelined run.
+# It replaces running export-alerts-v7.py, observations-alert-id.py and processes.py by hand for each alert.
+
+# The work is split into stages that run at the same time, connected by bounded queues:
+#   alerts       - pages through the v7 alert search, one time chunk at a time
+#   observations - runs an observation search job per alert, narrowed to the alert's first/last event times
+#   processes    - requests process details (cmdline, parent, hashes) for the process GUIDs of the alert and its
+#                  observations. Details are cached, so a GUID shared by many alerts is only fetched once. The cache
+#                  is a SQLite file (~/.cbcloud/process-cache.sqlite by default) shared with processes.py, events.py
+#                  and observations-alert-id.py, so processes seen by earlier runs are not fetched again
+#   writer       - writes each enriched alert as a line of JSON as soon as it is complete
+# The bounded queues keep memory flat: a fast stage waits for a slow one instead of piling up work.
+
+# Usage: python enrich-alerts.py --help
+
+# API key permissions required:
+# Alerts - General information - org.alerts - read
+# Search - Events - org.search.events - CREATE, READ
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cbcloud", "process-cache.sqlite")
+DETAIL_FIELDS = ["process_guid", "process_name", "process_pid", "process_cmdline", "process_username",
+                 "process_sha256", "process_md5", "process_terminated", "parent_guid", "parent_name", "parent_pid",
+                 "parent_cmdline"]
+
+
+def get_environment(environment):
+    # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
+
+    # rtype: string
+
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
+    if environment == "EAP1":
+        return "https://defense-eap01.confer.deploy.net"
+    elif environment == "PROD01":
+        return "https://dashboard.confer.net"
+    elif environment == "PROD02":
+        return "https://defense.conferdeploy.net"
+    elif environment == "PROD05":
+        return "https://defense-prod05.conferdeploy.net"
+    elif environment == "PROD06":
+        return "https://defense-eu.conferdeploy.net"
+    elif environment == "PRODNRT":
+        return "https://defense-prodnrt.conferdeploy.net"
+    elif environment == "PRODSYD":
+        return "https://defense-prodsyd.conferdeploy.net"
+    elif environment == "PRODUK":
+        return "https://ew2.carbonblack.vmware.com"
+    elif environment == "GOVCLOUD":
+        return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
+
+def setup_session(api_secret,api_id):
+    s = requests.session()
+    headers = {
+        "X-Auth-Token": f"{api_secret}/{api_id}",
+        "Content-Type": "application/json"
+        }
+    s.headers.update(headers)
+    return s
+
+
+def build_alert_search_url(environment, org_key):
+    # Build the alert search URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/alerts-api/#alert-search
+
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/api/alerts/v7/orgs/{org_key}/alerts/_search"
+
+
+def build_observations_search_url(environment, org_key):
+    # Build the observations search job URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/observations-api/#start-an-observation-search
+
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/api/investigate/v2/orgs/{org_key}/observations/search_jobs"
+
+
+def build_process_detail_url(environment, org_key):
+    # Build the URL to start a process details job
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#request-details-of-processes-v2
+
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/detail_jobs"
+
+
+def get_date_range(days_to_export):
+    chunks = 6
+    tomorrow = datetime.combine(datetime.now() + timedelta(days=1), datetime.min.time())
+    dates = [tomorrow - timedelta(days=x) for x in range(days_to_export, 0, chunks * -1)] + [tomorrow]
+    return [datetime.strftime(date, '%Y-%m-%dT%H:%M:%S.%fZ') for date in dates]
+
+
+def wait_for_job(session, results_url, poll_interval=1, rows=10000):
+    # Poll a search or detail job until every backend partition has answered, then page through its results
+
+    # rtype: list
+    # Initialize contacted and completed to different values so the while loop kicks off at least once
+    contacted = 1
+    completed = -1
+    while contacted != completed:
+        response = session.get(results_url, params={"start": 0, "rows": 0}).json()
+        contacted = response['contacted']
+        completed = response['completed']
+        if contacted != completed:
+            time.sleep(poll_interval)
+
+    results = []
+    while True:
+        response = session.get(results_url, params={"start": len(results), "rows": rows}).json()
+        results.extend(response['results'])
+        if not response['results'] or len(results) >= response.get('num_available', response['num_found']):
+            break
+    return results
+
+
+def fetch_process_details(session, environment, org_key, process_guids):
+    # Fetch the details of several processes with a single detail job
+
+    # rtype: dict of process_guid -> details
+    payload = {
+        "process_guids": process_guids,
+        "fields": DETAIL_FIELDS
+    }
+    response = session.post(build_process_detail_url(environment, org_key), json=payload)
+    if response.status_code != 200:
+        print(f"Process detail request failed: {response}")
+        return {}
+    job_id = response.json()['job_id']
+    results = wait_for_job(session, build_process_detail_url(environment, org_key) + f"/{job_id}/results")
+    return {result['process_guid']: {k: result.get(k) for k in DETAIL_FIELDS} for result in results}
+
+
+def produce_alerts(session, environment, org_key, days_to_export, minimum_severity, out_queue, rows=10000):
+    # Stage 1: page through the alerts of each time chunk and hand them to the next stage one by one
+
+    # rtype: int (number of alerts produced)
+    url = build_alert_search_url(environment, org_key)
+    dates = get_date_range(days_to_export)
+    produced = 0
+    for start_date, end_date in zip(dates, dates[1:]):
+        payload = {
+            "time_range": {
+                "start": start_date,
+                "end": end_date
+            },
+            "criteria": {
+                "minimum_severity": minimum_severity
+            },
+            "start": 1,
+            "rows": rows,
+            "sort": [
+                {
+                    "field": "backend_timestamp",
+                    "order": "DESC"
+                }
+            ]
+        }
+        while True:
+            r = session.post(url, json=payload)
+            if r.status_code >= 300:
+                print(f"Alert search failed for {start_date} - {end_date}: {r}")
+                break
+            data = r.json()
+            for alert in data['results']:
+                out_queue.put(alert)
+                produced += 1
+            payload['start'] += len(data['results'])
+            if not data['results'] or payload['start'] > data['num_found']:
+                break
+    return produced
+
+
+def observe_alert(session, environment, org_key, alert, margin):
+    # Stage 2: run the observation search for one alert, narrowed to the alert's own time span
+
+    # rtype: list
+    payload = {
+        "query": f"alert_id:{alert['id']}",
+        "time_range": {
+            "window": "-180d"
+        },
+        "rows": 10000,
+        "sort": [
+            {
+                "field": "device_timestamp",
+                "order": "DESC"
+            }
+        ]
+    }
+    if alert.get('first_event_timestamp') and alert.get('last_event_timestamp'):
+        first = datetime.fromisoformat(alert['first_event_timestamp'].replace('Z', '+00:00')) - margin
+        last = datetime.fromisoformat(alert['last_event_timestamp'].replace('Z', '+00:00')) + margin
+        payload['time_range'] = {"start": first.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+                                 "end": last.strftime('%Y-%m-%dT%H:%M:%S.000Z')}
+    url = build_observations_search_url(environment, org_key)
+    response = session.post(url, json=payload)
+    if response.status_code != 200:
+        print(f"Observation search failed for alert {alert['id']}: {response}")
+        return []
+    return wait_for_job(session, url + f"/{response.json()['job_id']}/results")
+
+
+def run_stage(worker, in_queue, out_queue, workers):
+    # Run a pipeline stage with several worker threads. Each item from in_queue is passed through worker() and the
+    # result put on out_queue. A None on in_queue marks the end of the input; once every worker has seen it, a single
+    # None is passed on to the next stage.
+
+    # rtype: list of threads
+    remaining = [workers]
+    remaining_lock = threading.Lock()
+
+    def loop():
+        while True:
+            item = in_queue.get()
+            if item is None:
+                in_queue.put(None)  # let the other workers of this stage see the end marker too
+                break
+            try:
+                out_queue.put(worker(item))
+            except Exception as e:
+                print(f"Enrichment of alert {item.get('id')} failed: {e}")
+        with remaining_lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                out_queue.put(None)
+
+    threads = [threading.Thread(target=loop, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    return threads
+
+
+def main():
+    # Main function to parse arguments and run the enrichment pipeline
+
+    parser = argparse.ArgumentParser(prog="enrich-alerts.py",
+                                     description="Enrich VMware Carbon Black \
+                                         Cloud alerts with their observations and process details.")
+    requiredNamed = parser.add_argument_group('required arguments')
+    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
+                               choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                        "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                               help="Environment for the Base URL")
+    requiredNamed.add_argument("-o", "--org_key", required=True,
+                               help="Org key (found in your product console under \
+                              Settings > API Access > API Keys)")
+    requiredNamed.add_argument("-i", "--api_id", required=True,
+                               help="API ID")
+    requiredNamed.add_argument("-s", "--api_secret", required=True,
+                               help="API Secret Key")
+    requiredNamed.add_argument("-d", "--days_to_export", required=True, help="Days to export")
+    parser.add_argument("--minimum_severity", type=int, default=1, help="Lowest alert severity to enrich")
+    parser.add_argument("--margin_minutes", type=int, default=60,
+                        help="Minutes to search for observations either side of the alert's events")
+    parser.add_argument("--observation_workers", type=int, default=4, help="Concurrent observation searches")
+    parser.add_argument("--process_workers", type=int, default=4, help="Concurrent process detail jobs")
+    parser.add_argument("--queue_size", type=int, default=100, help="Most alerts waiting between two stages")
+    parser.add_argument("--cache_file", default=DEFAULT_CACHE_FILE, help="Process detail cache shared between scripts")
+    parser.add_argument("--cache_ttl", type=int, default=3600,
+                        help="Seconds to keep the details of a process that was still running when fetched")
+    parser.add_argument("--no_cache", action='store_true', help="Do not read or write the process detail cache")
+    args = parser.parse_args()
+
+    session = setup_session(args.api_secret, args.api_id)
+    margin = timedelta(minutes=args.margin_minutes)
+    cache = ProcessDetailCache(None if args.no_cache else args.cache_file, ttl=args.cache_ttl, fields=DETAIL_FIELDS)
+
+    def add_observations(alert):
+        alert['observations'] = observe_alert(session, args.environment, args.org_key, alert, margin)
+        return alert
+
+    def add_process_details(alert):
+        guids = [alert.get('process_guid'), alert.get('parent_guid')]
+        guids += [observation.get('process_guid') for observation in alert['observations']]
+        guids = list(dict.fromkeys(guid for guid in guids if guid))
+        alert['processes'] = cache.get_many(
+            guids, lambda missing: fetch_process_details(session, args.environment, args.org_key, missing))
+        return alert
+
+    alert_queue = queue.Queue(maxsize=args.queue_size)
+    observed_queue = queue.Queue(maxsize=args.queue_size)
+    enriched_queue = queue.Queue(maxsize=args.queue_size)
+    run_stage(add_observations, alert_queue, observed_queue, args.observation_workers)
+    run_stage(add_process_details, observed_queue, enriched_queue, args.process_workers)
+
+    def producer():
+        try:
+            count = produce_alerts(session, args.environment, args.org_key, int(args.days_to_export),
+                                   args.minimum_severity, alert_queue)
+            print(f"Found {count} alerts")
+        finally:
+            alert_queue.put(None)
+    threading.Thread(target=producer, daemon=True).start()
+
+    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+    filename = 'enriched-alerts-' + timestamp + '.jsonl'
+    written = 0
+    with open(filename, 'w') as f:
+        while True:
+            alert = enriched_queue.get()
+            if alert is None:
+                break
+            f.write(json.dumps(alert) + '\n')
+            written += 1
+            if written % 100 == 0:
+                print(f"{written} alerts enriched")
+
+    cache.close()
+    print(f"Process detail cache: {cache.hits} hits, {cache.misses} fetched")
+    print(f"Saved {written} enriched alerts to '{filename}'")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,8 +1,13 @@
 import pandas as pd
+import numpy as np
 import requests
 import argparse
 import sys
+import os
 import json
+import hashlib
+import sqlite3
+import tempfile
 from datetime import datetime, timedelta
 import time
 
@@ -11,6 +16,14 @@ import time
 # The CB Cloud API will return up to 10,000 items in a single request. If you have more than 10,000 alerts, you would need
 # multiple requests to fetch them all.
 
+# The date range is fetched in windows whose start is the end of the window before, so an alert at a boundary can come
+# back twice. Alerts are deduplicated on their id with a seen-set of fixed size (--dedupe_memory MB): a Bloom filter
+# answers "not seen" for almost every new id from memory, and only when it says an id may have been seen is the id
+# looked up in a SQLite file holding every id (as a 128-bit hash). Tens of millions of ids cost the same memory as a
+# few (the default 64 MB keeps the false positives that need a lookup near 1% up to about 50 million ids). Pass
+# --seen_file to keep the ids between runs, so an incremental export skips every alert an earlier run already
+# saved.
+
 # Usage: python export-alerts.py --help
 
 # API key permissions required:
@@ -22,6 +35,9 @@ def get_environment(environment):
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -71,6 +87,101 @@ def request_data(session, pd, environment, org_id):
     return results
 
 
+class SeenIds:
+    # Ids seen so far: a Bloom filter in memory and the exact ids, as 128-bit hashes, in a SQLite file (a temporary one
+    # unless a filename is given). Each page of ids is checked and added in one go with numpy.
+
+    def __init__(self, filename=None, memory_mb=64, hashes=7):
+        self.bits = np.zeros(memory_mb * 1024 * 1024, dtype=np.uint8)
+        self.size = np.uint64(len(self.bits) * 8)
+        self.steps = np.arange(hashes, dtype=np.uint64)
+        self.temporary = filename is None
+        if self.temporary:
+            handle, filename = tempfile.mkstemp(suffix=".sqlite", prefix="seen-alerts-")
+            os.close(handle)
+        self.filename = filename
+        self.db = sqlite3.connect(filename)
+        if self.temporary:
+            # Nobody else reads the temporary file and it is deleted at the end, so skip the fsyncs
+            self.db.execute("PRAGMA synchronous = OFF")
+        else:
+            # A --seen_file outlives the run, so it must survive a crash: write-ahead logging with NORMAL syncs keeps
+            # it consistent at far less cost than the default full syncs
+            self.db.execute("PRAGMA journal_mode = WAL")
+            self.db.execute("PRAGMA synchronous = NORMAL")
+        # Give SQLite a page cache of its own (16 MB)
+        self.db.execute("PRAGMA cache_size = -16384")
+        self.db.execute("CREATE TABLE IF NOT EXISTS seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+        self.duplicates = 0
+        self.confirmations = 0
+        self.loaded = 0
+        cursor = self.db.execute("SELECT digest FROM seen")
+        while True:
+            rows = cursor.fetchmany(100000)
+            if not rows:
+                break
+            self.set_bits(self.positions([row[0] for row in rows]))
+            self.loaded += len(rows)
+
+    @staticmethod
+    def digest(alert_id):
+        # rtype: bytes
+        return hashlib.blake2b(alert_id.encode(), digest_size=16).digest()
+
+    def positions(self, digests):
+        # Bit positions of each digest, from its two 64-bit halves (double hashing): one row per digest
+
+        # rtype: numpy array
+        halves = np.frombuffer(b''.join(digests), dtype=np.uint64).reshape(-1, 2)
+        with np.errstate(over='ignore'):
+            return (halves[:, :1] + self.steps * (halves[:, 1:] | np.uint64(1))) % self.size
+
+    def set_bits(self, positions):
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        np.bitwise_or.at(self.bits, positions >> np.uint64(3), masks)
+
+    def maybe_seen(self, positions):
+        # rtype: numpy array of bool, one per row of positions
+        masks = np.left_shift(1, positions & np.uint64(7)).astype(np.uint8)
+        return ((self.bits[positions >> np.uint64(3)] & masks) != 0).all(axis=1)
+
+    def add_many(self, alert_ids):
+        # Remember the ids and return the ones not seen before, in order
+
+        # rtype: list
+        unique = list(dict.fromkeys(alert_ids))
+        self.duplicates += len(alert_ids) - len(unique)
+        if not unique:
+            return []
+        digests = [self.digest(alert_id) for alert_id in unique]
+        positions = self.positions(digests)
+        maybe = self.maybe_seen(positions)
+
+        # Confirm the possible repeats against the exact ids; most of them are real repeats, the rest false positives
+        candidates = [digest for digest, flag in zip(digests, maybe) if flag]
+        known = set()
+        for i in range(0, len(candidates), 500):
+            chunk = candidates[i:i + 500]
+            self.confirmations += len(chunk)
+            known.update(row[0] for row in self.db.execute(
+                f"SELECT digest FROM seen WHERE digest IN ({','.join('?' * len(chunk))})", chunk))
+        self.duplicates += len(known)
+
+        self.set_bits(positions[~maybe])
+        new = [(alert_id, digest) for alert_id, digest in zip(unique, digests) if digest not in known]
+        self.db.executemany("INSERT OR IGNORE INTO seen VALUES (?)", sorted((digest,) for _, digest in new))
+        return [alert_id for alert_id, _ in new]
+
+    def save(self):
+        # Commit the ids added in this run, once the alerts have been written out
+        self.db.commit()
+
+    def close(self):
+        self.db.close()
+        if self.temporary:
+            os.remove(self.filename)
+
+
 def get_date_range(days_to_export):
     chunks = 6
     tomorrow = datetime.combine(datetime.now() + timedelta(days=1), datetime.min.time())
@@ -102,6 +213,10 @@ def main():
     requiredNamed.add_argument("-s", "--api_secret", required=True,
                                help="API Secret Key")
     requiredNamed.add_argument("-d", "--days_to_export", required=True, help="Days to export")
+    parser.add_argument("--seen_file", help="SQLite file of alert ids already exported, kept between runs so "
+                                            "incremental exports skip them")
+    parser.add_argument("--dedupe_memory", type=int, default=64,
+                        help="Megabytes of memory for the alert id seen-set, whatever the number of alerts")
     args = parser.parse_args()
 
     dates = get_date_range(int(args.days_to_export))
@@ -129,21 +244,35 @@ def main():
         ]
     }
 
-    alerts_json = []
-    for x, i in enumerate(dates):
-        if x + 1 < len(dates):
-            payload["time_range"]["start"] = dates[x]
-            payload["time_range"]["end"] = dates[x + 1]
-            print(payload)
-            data = request_data(session, payload, args.environment, args.org_key)
-            alerts_json.extend(data["results"])
-    timestamp = time.strftime("%Y%m%d-%H%M%S") # create a timestamp for our filename
-    with open('alerts-' + timestamp + '.json', "w") as f:
-        json.dump(alerts_json, f)
-    # Now pull the json into a pandas dataframe as it can export to csv very nicely:
-    alerts_df = pd.read_json("alerts.json")
-    alerts_df.to_csv('alerts-v7-' + timestamp + '.csv' )
-    print('Saved to \'alerts-v7-' + timestamp + ' .csv\'') # let the user know
+    seen = SeenIds(args.seen_file, args.dedupe_memory)
+    if seen.loaded:
+        print(f"Skipping the {seen.loaded} alerts already exported according to '{args.seen_file}'")
+    try:
+        alerts_json = []
+        for x, i in enumerate(dates):
+            if x + 1 < len(dates):
+                payload["time_range"]["start"] = dates[x]
+                payload["time_range"]["end"] = dates[x + 1]
+                print(payload)
+                data = request_data(session, payload, args.environment, args.org_key)
+                new_ids = set(seen.add_many([alert["id"] for alert in data["results"]]))
+                for alert in data["results"]:
+                    if alert["id"] in new_ids:
+                        new_ids.discard(alert["id"])
+                        alerts_json.append(alert)
+        print(f"Skipped {seen.duplicates} duplicate alerts "
+              f"({seen.confirmations} ids checked against the seen-set file)")
+        timestamp = time.strftime("%Y%m%d-%H%M%S") # create a timestamp for our filename
+        with open('alerts-' + timestamp + '.json', "w") as f:
+            json.dump(alerts_json, f)
+        # Now pull the json into a pandas dataframe as it can export to csv very nicely:
+        alerts_df = pd.read_json('alerts-' + timestamp + '.json')
+        alerts_df.to_csv('alerts-v7-' + timestamp + '.csv' )
+        print('Saved to \'alerts-v7-' + timestamp + ' .csv\'') # let the user know
+        seen.save()
+    finally:
+        # Always close the seen-set, so its temporary file is removed even when the export fails
+        seen.close()
 
 
 
@@ -0,0 +1,236 @@
+import requests
+import argparse
+import sys
+import os
+import json
+import sqlite3
+import hashlib
+import time
+
+
+# This script answers Asset Group membership questions ("which groups is device X in?" and "which devices are in
+# group Y?") from a local SQLite index instead of asking the API every time.
+# Run it with --refresh to pull all asset groups and their members into the index. Later refreshes are incremental:
+# only groups whose definition or member count changed since the last refresh have their members fetched again, and
+# groups that no longer exist are dropped. Dynamic (query-based) groups are always fetched again, since devices join
+# and leave them as they change without the group itself changing. --device and --group queries are answered offline
+# from the index.
+
+# Usage: python assetGroupMembership.py --help
+
+# API key permissions required:
+# group-management - READ
+
+
+def get_environment(environment):
+    # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
+
+    # rtype: string
+
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
+    if environment == "EAP1":
+        return "https://defense-eap01.confer.deploy.net"
+    elif environment == "PROD01":
+        return "https://dashboard.confer.net"
+    elif environment == "PROD02":
+        return "https://defense.conferdeploy.net"
+    elif environment == "PROD05":
+        return "https://defense-prod05.conferdeploy.net"
+    elif environment == "PROD06":
+        return "https://defense-eu.conferdeploy.net"
+    elif environment == "PRODNRT":
+        return "https://defense-prodnrt.conferdeploy.net"
+    elif environment == "PRODSYD":
+        return "https://defense-prodsyd.conferdeploy.net"
+    elif environment == "PRODUK":
+        return "https://ew2.carbonblack.vmware.com"
+    elif environment == "GOVCLOUD":
+        return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
+
+
+def build_base_url(environment, org_key):
+    # Build the base URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/asset-groups-api/#get-all-asset-groups
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/asset_groups/v1/orgs/{org_key}/groups"
+
+
+def build_members_url(environment, org_key, group_id):
+    # Build the URL to list the members of an asset group
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/asset-groups-api/#get-asset-group-members
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/asset_groups/v1/orgs/{org_key}/groups/{group_id}/members"
+
+
+def open_index(filename):
+    # Open (and if needed create) the local membership index
+
+    # rtype: sqlite3.Connection
+    db = sqlite3.connect(filename)
+    db.executescript("""
+        CREATE TABLE IF NOT EXISTS groups (
+            group_id TEXT PRIMARY KEY,
+            name TEXT,
+            fingerprint TEXT,
+            refreshed TEXT
+        );
+        CREATE TABLE IF NOT EXISTS members (
+            group_id TEXT,
+            device_id TEXT,
+            membership_type TEXT,
+            PRIMARY KEY (group_id, device_id)
+        );
+        CREATE INDEX IF NOT EXISTS members_by_device ON members (device_id);
+        CREATE INDEX IF NOT EXISTS groups_by_name ON groups (name);
+    """)
+    return db
+
+
+def group_fingerprint(group):
+    # Summarise the parts of a group definition that affect its membership. If the fingerprint of a group without a
+    # query has not changed since the last refresh the stored members are still current. The members of a dynamic
+    # group follow the devices its query matches, so its fingerprint alone says nothing about them.
+
+    # rtype: string
+    relevant = {k: group.get(k) for k in ('name', 'query', 'member_count', 'status', 'policy_id', 'update_time')}
+    return hashlib.sha1(json.dumps(relevant, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def fetch_members(req_url, headers, rows=10000):
+    # Page through the members of an asset group. Returns None when a page can not be fetched, so a partial list is
+    # never mistaken for the whole membership.
+
+    # rtype: list of (device_id, membership_type) tuples or None
+    members = []
+    start = 0
+    while True:
+        response = requests.request("GET", req_url, headers=headers, params={"start": start, "rows": rows})
+        if response.status_code != 200:
+            print(response)
+            return None
+        page = response.json()
+        results = page.get('members', page.get('results', []))
+        for member in results:
+            if isinstance(member, dict):
+                device_id = member.get('external_member_id', member.get('device_id', member.get('id')))
+                membership_type = ','.join(member.get('membership_type', []))
+            else:
+                device_id = member
+                membership_type = ''
+            members.append((str(device_id), membership_type))
+        start += len(results)
+        if len(results) < rows or start >= page.get('num_found', start):
+            break
+    return members
+
+
+def refresh_index(db, environment, org_key, headers, full=False):
+    # Pull the asset groups and update the members of any group that changed since the last refresh
+
+    # rtype: None
+    response = requests.request("GET", build_base_url(environment, org_key), headers=headers)
+    if response.status_code != 200:
+        print(response)
+        return
+    groups = response.json()['results']
+    stored = dict(db.execute("SELECT group_id, fingerprint FROM groups"))
+    refreshed = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    current = set()
+    changed = 0
+    failed = 0
+    for group in groups:
+        group_id = str(group['id'])
+        current.add(group_id)
+        fingerprint = group_fingerprint(group)
+        if not full and not group.get('query') and stored.get(group_id) == fingerprint:
+            continue
+        members = fetch_members(build_members_url(environment, org_key, group_id), headers)
+        if members is None:
+            # Keep the stored members and fingerprint, so the next refresh tries this group again
+            print(f"Could not fetch the members of '{group.get('name')}', keeping its stored members")
+            failed += 1
+            continue
+        with db:
+            db.execute("DELETE FROM members WHERE group_id = ?", (group_id,))
+            db.executemany("INSERT OR REPLACE INTO members VALUES (?, ?, ?)",
+                           [(group_id, device_id, membership_type) for device_id, membership_type in members])
+            db.execute("INSERT OR REPLACE INTO groups VALUES (?, ?, ?, ?)",
+                       (group_id, group.get('name'), fingerprint, refreshed))
+        changed += 1
+        print(f"Indexed '{group.get('name')}': {len(members)} members")
+
+    removed = set(stored) - current
+    with db:
+        for group_id in removed:
+            db.execute("DELETE FROM members WHERE group_id = ?", (group_id,))
+            db.execute("DELETE FROM groups WHERE group_id = ?", (group_id,))
+    print(f"{len(groups)} asset groups: {changed} refreshed, {len(groups) - changed - failed} unchanged, "
+          f"{failed} failed, {len(removed)} removed")
+
+
+def main():
+    # Main function to parse arguments and answer membership queries
+
+    parser = argparse.ArgumentParser(prog="assetGroupMembership.py",
+                                     description="Index VMware Carbon Black \
+                                         Cloud asset group membership and query it offline.")
+    parser.add_argument("-e", "--environment", default="PROD05",
+                        choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                 "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                        help="Environment for the Base URL")
+    parser.add_argument("-o", "--org_key",
+                        help="Org key (found in your product console under \
+                              Settings > API Access > API Keys)")
+    parser.add_argument("-i", "--api_id", help="API ID")
+    parser.add_argument("-s", "--api_secret", help="API Secret Key")
+    parser.add_argument("-r", "--refresh", action='store_true',
+                        help="Pull groups and members from the API into the index (needs -o, -i and -s)")
+    parser.add_argument("--full", action='store_true', help="With --refresh, re-fetch the members of every group")
+    parser.add_argument("-d", "--device", help="Device ID to list the asset groups of")
+    parser.add_argument("-g", "--group", help="Asset group name or ID to list the devices of")
+    parser.add_argument("--db", default="assetGroups.db", help="Local index file")
+    args = parser.parse_args()
+
+    db = open_index(args.db)
+
+    if args.refresh:
+        if not (args.org_key and args.api_id and args.api_secret):
+            parser.error("--refresh requires --org_key, --api_id and --api_secret")
+        headers = {
+            "Content-Type": "application/json",
+            "X-Auth-Token": f"{args.api_secret}/{args.api_id}"
+        }
+        refresh_index(db, args.environment, args.org_key, headers, full=args.full)
+
+    if args.device:
+        rows = db.execute("""SELECT g.group_id, g.name, m.membership_type FROM members m
+                             JOIN groups g ON g.group_id = m.group_id
+                             WHERE m.device_id = ? ORDER BY g.name""", (args.device,)).fetchall()
+        print(f"Device {args.device} is in {len(rows)} asset group(s)")
+        for group_id, name, membership_type in rows:
+            print(f"{group_id}\t{name}\t{membership_type}")
+
+    if args.group:
+        rows = db.execute("""SELECT m.device_id, m.membership_type FROM members m
+                             JOIN groups g ON g.group_id = m.group_id
+                             WHERE g.group_id = ? OR g.name = ? ORDER BY m.device_id""",
+                          (args.group, args.group)).fetchall()
+        print(f"Asset group {args.group} has {len(rows)} device(s)")
+        for device_id, membership_type in rows:
+            print(f"{device_id}\t{membership_type}")
+
+    db.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,7 @@
 import requests
 import argparse
 import sys
+import os
 import pandas as pd
 import time
 
@@ -21,6 +22,9 @@ def get_environment(environment):
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -51,6 +55,47 @@ def build_base_url(environment, org_key):
     return f"{environment}/asset_groups/v1/orgs/{org_key}/groups"
 
 
+def read_hostnames(filename):
+    # Read one hostname per line, dropping blank lines and surrounding whitespace. Hostnames are case-insensitive, so
+    # duplicates are removed on their lower-cased form while keeping the first spelling seen.
+
+    # rtype: list
+    hostnames = []
+    seen = set()
+    with open(filename, 'r') as f:
+        for line in f:
+            host = line.strip()
+            if host and host.lower() not in seen:
+                seen.add(host.lower())
+                hostnames.append(host)
+    return hostnames
+
+
+def build_queries(hostnames, max_query_length):
+    # Build the name.equals query for the hostnames. The terms are collected in a list and joined once, so the cost is
+    # linear in the number of hostnames. If the query would be longer than max_query_length it is split into several
+    # queries, each of which stays within the limit. Returns None if a single hostname does not fit in a query.
+
+    # rtype: list
+    queries = []
+    terms = []
+    length = 0
+    for host in hostnames:
+        term = 'name.equals: "' + host.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        if len(term) > max_query_length:
+            print(f"'{host}' does not fit in a query of at most {max_query_length} characters")
+            return None
+        if terms and length + len(' OR ') + len(term) > max_query_length:
+            queries.append(' OR '.join(terms))
+            terms = []
+            length = 0
+        length += len(term) if not terms else len(' OR ') + len(term)
+        terms.append(term)
+    if terms:
+        queries.append(' OR '.join(terms))
+    return queries
+
+
 def main():
     # Main function to parse arguments and retrieve the endpoint results
 
@@ -73,6 +118,8 @@ def main():
                                help="Name of the Asset Group to be added"),
     requiredNamed.add_argument("-f", "--file", required=True,
                                help="Filename containing hostnames to add to the Asset Group")
+    parser.add_argument("-m", "--max_query_length", type=int, default=8000,
+                        help="Longest query to send in one Asset Group. Longer lists are split into several groups")
     args = parser.parse_args()
 
     req_url = build_base_url(args.environment, args.org_key)
@@ -90,25 +137,29 @@ def main():
         "X-Auth-Token": api_token
     }
 
-    # loop through supplied file and assemble the payload:query value
-    hostnames = open(f'{args.file}', 'r').read().split('\n')
-    last_hostname = hostnames[-1]
-    query = 'name.equals: "'
-    for host in hostnames:
-        if host != last_hostname:
-            query += host + '" OR name.equals: "'
-        if host == last_hostname:
-            query += host + '"'
-    payload['query'] = query
-
-    response = requests.request("POST", req_url, headers=headers, json=payload)
-
-    if response.status_code == 200:
-        print(f"Success {response}")
-
-    else:
-        print(response)
-        print('pause here')
+    # Assemble the payload:query value(s) from the supplied file
+    hostnames = read_hostnames(args.file)
+    queries = build_queries(hostnames, args.max_query_length)
+    if queries is None:
+        return 1
+    if len(queries) > 1:
+        print(f"{len(hostnames)} hostnames do not fit in one query, creating {len(queries)} Asset Groups")
+
+    for i, query in enumerate(queries):
+        if len(queries) > 1:
+            group_name = f"{args.group_name} ({i + 1} of {len(queries)})"
+            payload['name'] = group_name
+            payload['description'] = group_name
+        payload['query'] = query
+
+        response = requests.request("POST", req_url, headers=headers, json=payload)
+
+        if response.status_code == 200:
+            print(f"Success {response}")
+
+        else:
+            print(response)
+            print(response.text)
 
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,208 @@
+import requests
+import argparse
+import sys
+import os
+import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+
+# This script creates many asset groups at once from a manifest file. The manifest is a CSV file with a header row and
+# the following columns:
+#   group_name  - Name of the Asset Group (also used as its description unless a description column is given)
+#   file        - Filename containing one hostname (or hostname pattern) per line
+#   match       - "equals" to match hostnames exactly (as createAssetGroupByHostnames.py does) or
+#                 "contains" to match hostname patterns (as createAssetGroupByPattern.py does). Defaults to "equals"
+#   description - Optional description of the Asset Group
+# Hostnames are de-duplicated and blank lines are ignored. When a hostname list is too long for a single query it is
+# split into several groups named "<group_name> (1 of N)", "<group_name> (2 of N)" and so on. The groups are created
+# concurrently.
+
+# Usage: python createAssetGroupsBulk.py --help
+
+# API key permissions required:
+# group-management - CREATE
+
+
+def get_environment(environment):
+    # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
+
+    # rtype: string
+
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
+    if environment == "EAP1":
+        return "https://defense-eap01.confer.deploy.net"
+    elif environment == "PROD01":
+        return "https://dashboard.confer.net"
+    elif environment == "PROD02":
+        return "https://defense.conferdeploy.net"
+    elif environment == "PROD05":
+        return "https://defense-prod05.conferdeploy.net"
+    elif environment == "PROD06":
+        return "https://defense-eu.conferdeploy.net"
+    elif environment == "PRODNRT":
+        return "https://defense-prodnrt.conferdeploy.net"
+    elif environment == "PRODSYD":
+        return "https://defense-prodsyd.conferdeploy.net"
+    elif environment == "PRODUK":
+        return "https://ew2.carbonblack.vmware.com"
+    elif environment == "GOVCLOUD":
+        return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
+
+
+def build_base_url(environment, org_key):
+    # Build the base URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/asset-groups-api/#create-asset-group
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/asset_groups/v1/orgs/{org_key}/groups"
+
+
+def read_hostnames(filename):
+    # Read one hostname per line, dropping blank lines and surrounding whitespace. Hostnames are case-insensitive, so
+    # duplicates are removed on their lower-cased form while keeping the first spelling seen.
+
+    # rtype: list
+    hostnames = []
+    seen = set()
+    with open(filename, 'r') as f:
+        for line in f:
+            host = line.strip()
+            if host and host.lower() not in seen:
+                seen.add(host.lower())
+                hostnames.append(host)
+    return hostnames
+
+
+def build_queries(hostnames, match, max_query_length):
+    # Build the Asset Group queries for the hostnames, "name.equals" terms for exact matches and "name" terms for
+    # patterns. The terms are collected in a list and joined once, so the cost is linear in the number of hostnames.
+    # If the query would be longer than max_query_length it is split into several queries, each within the limit.
+    # Returns None if a single hostname does not fit in a query.
+
+    # rtype: list
+    queries = []
+    terms = []
+    length = 0
+    for host in hostnames:
+        if match == "contains":
+            term = 'name: ' + host
+        else:
+            term = 'name.equals: "' + host.replace('\\', '\\\\').replace('"', '\\"') + '"'
+        if len(term) > max_query_length:
+            print(f"'{host}' does not fit in a query of at most {max_query_length} characters")
+            return None
+        if terms and length + len(' OR ') + len(term) > max_query_length:
+            queries.append(' OR '.join(terms))
+            terms = []
+            length = 0
+        length += len(term) if not terms else len(' OR ') + len(term)
+        terms.append(term)
+    if terms:
+        queries.append(' OR '.join(terms))
+    return queries
+
+
+def build_group_payloads(manifest_file, max_query_length):
+    # Read the manifest and build one create-group payload per Asset Group, splitting oversized hostname lists.
+    # Returns None if a hostname does not fit in a query.
+
+    # rtype: list
+    payloads = []
+    with open(manifest_file, 'r', newline='') as f:
+        for row in csv.DictReader(f):
+            group_name = row['group_name'].strip()
+            match = (row.get('match') or 'equals').strip().lower()
+            description = (row.get('description') or '').strip() or group_name
+            hostnames = read_hostnames(row['file'].strip())
+            if not hostnames:
+                print(f"Skipping '{group_name}': no hostnames in {row['file']}")
+                continue
+            queries = build_queries(hostnames, match, max_query_length)
+            if queries is None:
+                return None
+            for i, query in enumerate(queries):
+                name = group_name
+                if len(queries) > 1:
+                    name = f"{group_name} ({i + 1} of {len(queries)})"
+                payloads.append({
+                    "description": description if len(queries) == 1 else name,
+                    "member_type": "DEVICE",
+                    "name": name,
+                    "query": query
+                })
+    return payloads
+
+
+def create_group(req_url, headers, payload):
+    # Create a single Asset Group
+
+    # rtype: requests.Response
+    return requests.request("POST", req_url, headers=headers, json=payload)
+
+
+def main():
+    # Main function to parse arguments and create the Asset Groups
+
+    parser = argparse.ArgumentParser(prog="createAssetGroupsBulk.py",
+                                     description="Create VMware Carbon Black \
+                                         Cloud asset groups in bulk from a manifest file.")
+    requiredNamed = parser.add_argument_group('required arguments')
+    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
+                               choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                        "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                               help="Environment for the Base URL")
+    requiredNamed.add_argument("-o", "--org_key", required=True,
+                               help="Org key (found in your product console under \
+                              Settings > API Access > API Keys)")
+    requiredNamed.add_argument("-i", "--api_id", required=True,
+                               help="API ID")
+    requiredNamed.add_argument("-s", "--api_secret", required=True,
+                               help="API Secret Key")
+    requiredNamed.add_argument("-f", "--manifest", required=True,
+                               help="CSV manifest with group_name, file, match and description columns")
+    parser.add_argument("-m", "--max_query_length", type=int, default=8000,
+                        help="Longest query to send in one Asset Group. Longer lists are split into several groups")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of groups to create concurrently")
+    parser.add_argument("-n", "--dry_run", action='store_true', help="Show the groups that would be created and exit")
+    args = parser.parse_args()
+
+    req_url = build_base_url(args.environment, args.org_key)
+    api_token = f"{args.api_secret}/{args.api_id}"
+
+    headers = {
+        "Content-Type": "application/json",
+        "X-Auth-Token": api_token
+    }
+
+    payloads = build_group_payloads(args.manifest, args.max_query_length)
+    if payloads is None:
+        return 1
+    print(f"{len(payloads)} Asset Groups to create")
+    if args.dry_run:
+        for payload in payloads:
+            print(f"{payload['name']}: {len(payload['query'])} character query")
+        return 0
+
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(create_group, req_url, headers, payload): payload for payload in payloads}
+        for future in as_completed(futures):
+            payload = futures[future]
+            response = future.result()
+            if response.status_code == 200:
+                print(f"Created '{payload['name']}' {response}")
+            else:
+                failures += 1
+                print(f"Failed to create '{payload['name']}' {response} {response.text}")
+
+    print(f"Done. {len(payloads) - failures} created, {failures} failed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
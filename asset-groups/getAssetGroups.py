@@ -1,6 +1,7 @@
 import requests
 import argparse
 import sys
+import os
 import pandas as pd
 import time
 
@@ -19,6 +20,9 @@ def get_environment(environment):
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -2,6 +2,7 @@ import requests
 import argparse
 import json
 import sys
+import os
 from datetime import datetime, timedelta
 
 # This script exports Audit Log entries into a JSON blob. It uses undocumented API calls and was reverse engineered from
@@ -24,6 +25,9 @@ def get_environment(environment):
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -3,13 +3,26 @@ import argparse
 import sys
 import pandas as pd
 import json
+import time
+import os
+from collections import Counter
 
 # This script uses the differential analysis API to diff results of Audit & Remediation (osquery) runs
 
+# The counts are fetched first with count_only so that a full pull can be skipped when nothing (or too much) changed.
+# The full diff is then paged through, streamed to a JSON lines file and summarised per device and per change type in
+# the same pass.
+
+# For a query that runs on a schedule, --run_chain walks a list of run IDs (oldest first) and keeps a rolling history of
+# the adjacent diffs in a local Parquet store (--history_dir). Only pairs that are not in the store yet are requested,
+# so re-running with a longer chain just adds the new days. Every added or removed row becomes one record, which lets
+# trend questions be answered locally, e.g. when a binary first appeared on a host:
+#     python differential-analysis.py --history_dir diff-history --first_seen name=evil.exe --device 1234
+
 # Usage: python differential-analysis.py --help
 
 # API key permissions required:
-# TBD
+# Live Query - livequery.manage - READ
 
 def get_environment(environment):
     # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
@@ -17,6 +30,9 @@ def get_environment(environment):
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -43,49 +59,268 @@ def build_base_url(environment, org_key):
     return f"{environment}/livequery/v1/orgs/{org_key}/differential/runs/_search"
 
 
+def setup_session(api_secret, api_id, org_key):
+    s = requests.session()
+    headers = {
+        "X-Auth-Token": f"{api_secret}/{api_id}",
+        "X-Org": org_key,
+        "Content-Type": "application/json"
+        }
+    s.headers.update(headers)
+    return s
+
+
+def diff_counts(result):
+    # Pull the added/removed counts out of a single device's diff result
+
+    # rtype: tuple (added, removed)
+    diff = result.get('diff_results') or {}
+    added = diff.get('added_count', len(diff.get('added') or []))
+    removed = diff.get('removed_count', len(diff.get('removed') or []))
+    return added, removed
+
+
+def change_type(result, added, removed):
+    # Classify a device's diff result
+
+    # rtype: string
+    if result.get('older_run_not_responded'):
+        return 'older_run_not_responded'
+    if added and removed:
+        return 'added_and_removed'
+    if added:
+        return 'added'
+    if removed:
+        return 'removed'
+    return 'unchanged'
+
+
+def search_diffs(session, req_url, newer_run_id, older_run_id, count_only, rows):
+    # Page through the differential results of two runs, yielding one device result at a time
+
+    # rtype: generator of dict
+    payload = {
+        "count_only": count_only,
+        "newer_run_id": newer_run_id,
+        "older_run_id": older_run_id,
+        "start": 0,
+        "rows": rows
+    }
+    while True:
+        r = session.post(req_url, json=payload)
+        if r.status_code != 200:
+            raise RuntimeError(f"Differential search failed: {r.status_code} {r.text}")
+        page = r.json()
+        results = page.get('results', [])
+        for result in results:
+            yield result
+        payload['start'] += len(results)
+        if len(results) < rows or payload['start'] >= page.get('num_found', payload['start']):
+            break
+
+
+def summarize(results, output_file=None):
+    # Single streaming pass over the diff results: optionally write each one to a JSON lines file while counting
+    # per-device and per-change-type totals
+
+    # rtype: tuple (per_device dict, per_change_type Counter)
+    per_device = {}
+    per_change_type = Counter()
+    f = open(output_file, 'w') if output_file else None
+    try:
+        for result in results:
+            added, removed = diff_counts(result)
+            kind = change_type(result, added, removed)
+            per_change_type[kind] += 1
+            per_change_type['rows_added'] += added
+            per_change_type['rows_removed'] += removed
+            per_device[result.get('device_id')] = (added, removed, kind)
+            if f is not None:
+                f.write(json.dumps(result) + '\n')
+    finally:
+        if f is not None:
+            f.close()
+    return per_device, per_change_type
+
+
+def print_change_types(per_change_type):
+    for kind in ('added', 'removed', 'added_and_removed', 'unchanged', 'older_run_not_responded'):
+        print(f"  {kind}: {per_change_type[kind]} devices")
+    print(f"  rows added: {per_change_type['rows_added']}, rows removed: {per_change_type['rows_removed']}")
+
+
+def history_file(history_dir, older_run_id, newer_run_id):
+    # Each adjacent pair of runs is stored in its own Parquet file so the store can only ever grow by appending files
+
+    # rtype: string
+    return os.path.join(history_dir, f"{older_run_id}__{newer_run_id}.parquet")
+
+
+def diff_records(results):
+    # Flatten device diff results into one record per added or removed row. The row's own columns are kept as strings
+    # so every file in the store has a compatible schema. A row column with the name of one of the record's own fields
+    # (device_id, change, ...) is kept as row_<name>, so it never overwrites them.
+
+    # rtype: generator of dict
+    for result in results:
+        diff = result.get('diff_results') or {}
+        run_time = result.get('newer_run_create_time') or result.get('diff_processed_time')
+        for change in ('added', 'removed'):
+            for row in diff.get(change) or []:
+                metadata = {
+                    "older_run_id": result.get('older_run_id'),
+                    "newer_run_id": result.get('newer_run_id'),
+                    "run_time": run_time,
+                    "device_id": str(result.get('device_id')),
+                    "change": change
+                }
+                record = {("row_" + k if k in metadata else k): None if v is None else str(v) for k, v in row.items()}
+                record.update(metadata)
+                yield record
+
+
+def update_history(session, req_url, run_chain, history_dir, rows):
+    # Request only the adjacent diffs of the chain that are not in the history store yet and append them to it
+
+    # rtype: None
+    os.makedirs(history_dir, exist_ok=True)
+    for older_run_id, newer_run_id in zip(run_chain, run_chain[1:]):
+        filename = history_file(history_dir, older_run_id, newer_run_id)
+        if os.path.exists(filename):
+            continue
+        records = list(diff_records(search_diffs(session, req_url, newer_run_id, older_run_id, False, rows)))
+        # Write to a temporary name first so an interrupted pull is retried rather than treated as stored
+        df = pd.DataFrame.from_records(records)
+        if df.empty:
+            df = pd.DataFrame(columns=["older_run_id", "newer_run_id", "run_time", "device_id", "change"])
+        df.astype("string").to_parquet(filename + '.tmp', index=False)
+        os.replace(filename + '.tmp', filename)
+        print(f"Stored {len(records)} changes between {older_run_id} and {newer_run_id}")
+
+
+def history_files(history_dir):
+    # rtype: list
+    if not os.path.isdir(history_dir):
+        return []
+    return sorted(os.path.join(history_dir, f) for f in os.listdir(history_dir) if f.endswith('.parquet'))
+
+
+def read_history(history_dir, columns=None, filters=None):
+    # Load (a filtered part of) the history store. Files written for different pairs may have different row columns,
+    # so their schemas are unified before reading.
+
+    # rtype: pandas.DataFrame
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    files = history_files(history_dir)
+    if not files:
+        return pd.DataFrame()
+    schema = pa.unify_schemas([pq.read_schema(f) for f in files])
+    dataset = ds.dataset(files, schema=schema, format='parquet')
+    return dataset.to_table(columns=columns, filter=filters).to_pandas()
+
+
+def first_seen(history_dir, column, value, device_id=None):
+    # When did a row with column == value first get added, per device
+
+    # rtype: pandas.DataFrame
+    import pyarrow.dataset as ds
+    import pyarrow.parquet as pq
+
+    if not any(column in pq.read_schema(f).names for f in history_files(history_dir)):
+        return pd.DataFrame()
+    filters = (ds.field('change') == 'added') & (ds.field(column) == value)
+    if device_id is not None:
+        filters = filters & (ds.field('device_id') == str(device_id))
+    df = read_history(history_dir, columns=['device_id', 'run_time', 'newer_run_id'], filters=filters)
+    if df.empty:
+        return df
+    return df.sort_values('run_time').groupby('device_id', as_index=False).first()
+
+
+def export_pair(session, req_url, args):
+    # Export the full diff of one pair of runs
+
+    # rtype: int
+    # Ask for counts first. They are cheap and tell us whether pulling the full diff is worth it
+    _, counts = summarize(search_diffs(session, req_url, args.newer_run_id, args.older_run_id, True, args.rows))
+    changed = counts['added'] + counts['removed'] + counts['added_and_removed']
+    print(f"{changed} devices changed between {args.older_run_id} and {args.newer_run_id}")
+    print_change_types(counts)
+    if args.count_only:
+        return 0
+    if changed == 0:
+        print("Nothing to export")
+        return 0
+    if args.max_devices is not None and changed > args.max_devices:
+        print(f"More than {args.max_devices} devices changed, skipping the full pull")
+        return 0
+
+    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+    output_file = args.output_file or 'diff-' + timestamp + '.jsonl'
+    per_device, _ = summarize(search_diffs(session, req_url, args.newer_run_id, args.older_run_id, False, args.rows),
+                              output_file)
+    print('Saved diff results to \'' + output_file + '\'')
+
+    summary_df = pd.DataFrame.from_dict(per_device, orient='index', columns=['added', 'removed', 'change_type'])
+    summary_df.index.name = 'device_id'
+    summary_df.to_csv('diff-summary-' + timestamp + '.csv')
+    print('Saved per-device counts to \'diff-summary-' + timestamp + '.csv\'')
+    return 0
+
+
 def main():
     # Main function to parse arguments and retrieve the endpoint results
 
-    parser = argparse.ArgumentParser(prog="export-watchlists.py",
+    parser = argparse.ArgumentParser(prog="differential-analysis.py",
                                      description="Query VMware Carbon Black \
-                                         Cloud and export watchlist data.")
-    requiredNamed = parser.add_argument_group('required arguments')
-    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
-                               choices=["EAP1", "PROD01", "PROD02", "PROD05",
-                                        "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
-                               help="Environment for the Base URL")
-    requiredNamed.add_argument("-o", "--org_key", required=True,
-                               help="Org key (found in your product console under \
+                                         Cloud and export the differences between Live Query runs.")
+    parser.add_argument("-e", "--environment", default="PROD05",
+                        choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                 "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                        help="Environment for the Base URL")
+    parser.add_argument("-o", "--org_key",
+                        help="Org key (found in your product console under \
                               Settings > API Access > API Keys)")
-    requiredNamed.add_argument("-i", "--api_id", required=True,
-                               help="API ID")
-    requiredNamed.add_argument("-s", "--api_secret", required=True,
-                               help="API Secret Key")
+    parser.add_argument("-i", "--api_id", help="API ID")
+    parser.add_argument("-s", "--api_secret", help="API Secret Key")
+    parser.add_argument("-n", "--newer_run_id", help="ID of the newer Live Query run")
+    parser.add_argument("-r", "--older_run_id", help="ID of the older Live Query run")
+    parser.add_argument("-c", "--count_only", action='store_true', help="Only report the counts, skip the full pull")
+    parser.add_argument("-m", "--max_devices", type=int,
+                        help="Skip the full pull when more than this many devices have changes")
+    parser.add_argument("--rows", type=int, default=10000, help="Results to request per page")
+    parser.add_argument("-f", "--output_file", help="JSON lines file for the full diff results")
+    parser.add_argument("--run_chain", help="Comma separated run IDs, oldest first, to add to the history store")
+    parser.add_argument("--history_dir", default="diff-history", help="Directory of the local diff history store")
+    parser.add_argument("--first_seen", metavar="COLUMN=VALUE",
+                        help="Report when a row with this value was first added, per device, from the history store")
+    parser.add_argument("-d", "--device", help="Limit --first_seen to one device ID")
     args = parser.parse_args()
 
-    req_url = build_base_url(args.environment, args.org_key)
-    api_token = f"{args.api_secret}/{args.api_id}"
-
-    payload = {
-      "count_only": False,
-      "newer_run_id": "eyah16kwydxxnyfbg1nudcxq34rzkhus",
-      "older_run_id": "nu9aj8n5iycbjevbwi9g4mqwwpd1iqb4"
-    }
+    if args.run_chain or (args.newer_run_id and args.older_run_id):
+        if not (args.org_key and args.api_id and args.api_secret):
+            parser.error("--org_key, --api_id and --api_secret are required to query the API")
+        req_url = build_base_url(args.environment, args.org_key)
+        session = setup_session(args.api_secret, args.api_id, args.org_key)
+        if args.run_chain:
+            update_history(session, req_url, [run_id.strip() for run_id in args.run_chain.split(',')],
+                           args.history_dir, args.rows)
+        else:
+            export_pair(session, req_url, args)
+    elif not args.first_seen:
+        parser.error("give --newer_run_id and --older_run_id, --run_chain, or --first_seen")
 
-    headers = {
-        "Content-Type": "application/json",
-        "X-Org": args.org_key,
-        "X-Auth-Token": api_token
-    }
+    if args.first_seen:
+        column, _, value = args.first_seen.partition('=')
+        df = first_seen(args.history_dir, column, value, args.device)
+        if df.empty:
+            print("Not found in the history store")
+        else:
+            print(df.to_string(index=False))
 
-    response = requests.request('POST', req_url, headers=headers, json=payload)
-    if response.status_code == 200:
-        print(f"Success {response}")
-        response = response.json()
-        diff_data = response['results']
-        print("stop here")
-    else:
-        print(response)
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
@@ -3,22 +3,57 @@ import requests
 import argparse
 import sys
 import time
+import os
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# The process detail cache lives in tools/process_cache.py, shared with the other process scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools"))
+from process_cache import ProcessDetailCache  # noqa: E402
 
 
 # This script exports the queried for events into a csv via the process search and events search API. It will first
 # do a process search and then pivot from there using the process_guid to return full event details.
+# The query (used for both the process and the event search), time range, event fields and number of processes are set
+# with --query, --window (or --start and --end), --fields and --rows.
+# To run many saved hunts at once, put them in a JSON file and pass it with --query_file. The file holds a list of hunts,
+# each with a name and a query and optionally its own window (or start and end), fields and rows; anything left out
+# comes from the command line, except that a hunt with a window, start or end of its own takes no time range from
+# it. The hunts run concurrently (--workers) and each one is saved to its own CSV file, e.g.
+# [
+#     {"name": "js-scriptloads", "query": "scriptload_name:*.js"},
+#     {"name": "vbs-scriptloads", "query": "scriptload_name:*.vbs", "window": "-1d"}
+# ]
+
+# The events of each process are cached by process_guid, so a process that shows up several times is only searched
+# once. When the search uses a fixed start and end time, the events are also kept in the SQLite cache shared with
+# processes.py, observations-alert-id.py and enrich-alerts.py (~/.cbcloud/process-cache.sqlite by default): the events
+# of a process that has exited never change, so later runs over the same time range reuse them. Events of a process that
+# was still running are re-fetched after --cache_ttl seconds. Relative windows ("-5m") are only cached within a run.
 
 # Usage: python events.py --help
 
 # API key permissions required:
 # TBD
 
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cbcloud", "process-cache.sqlite")
+# The hunt keys that make up its time range, taken from the command line all together or not at all
+TIME_RANGE_KEYS = ("window", "start", "end")
+# Job status polls wait POLL_INTERVAL seconds after the first one that finds the job still running, twice as long after
+# each one after that, up to MAX_POLL_INTERVAL, so many lookup workers polling at once do not flood the API
+POLL_INTERVAL = 0.25
+MAX_POLL_INTERVAL = 2
+
 def get_environment(environment):
     # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
     # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -52,11 +87,11 @@ def build_process_search_url(environment, org_key):
 def build_process_search_job_id_url(environment, org_key, job_id):
     # Build the URL to return the results of the search based on job_id
     # Documentation on this specific API call can be found here:
-    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#retrieve-results-for-a-process-detail-search-v2
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#retrieve-results-for-a-process-search-v2
 
     # rtype: string
     environment = get_environment(environment)
-    return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/detail_jobs/{job_id}/results"
+    return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/search_jobs/{job_id}/results"
 
 
 def build_event_search_url(environment, org_key, process_guid):
@@ -67,38 +102,72 @@ def build_event_search_url(environment, org_key, process_guid):
     return f"{environment}/api/investigate/v2/orgs/{org_key}/events/{process_guid}/_search"
 
 
-def main():
-    # Main function to parse arguments and retrieve the endpoint results
+def fetch_process_events(environment, org_key, headers, process_guid, payload):
+    # Run the event search for one process_guid until every segment has been processed
 
-    # global event_data_df
-    parser = argparse.ArgumentParser(prog="events.py",
-                                     description="Query VMware Carbon Black Cloud for process data.")
-    requiredNamed = parser.add_argument_group('required arguments')
-    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
-                               choices=["EAP1", "PROD01", "PROD02", "PROD05", "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
-                               help="Environment for the Base URL")
-    requiredNamed.add_argument("-o", "--org_key", required=True,
-                               help="Org key (found in your product console under Settings > API Access > API Keys)")
-    requiredNamed.add_argument("-i", "--api_id", required=True,
-                               help="API ID")
-    requiredNamed.add_argument("-s", "--api_secret", required=True,
-                               help="API Secret Key")
-    args = parser.parse_args()
+    # rtype: list or None
+    req_url = build_event_search_url(environment, org_key, process_guid)
+    wait = POLL_INTERVAL
+    # Initialize total_segments and processed_segments to different values so the while loop kicks off at least once
+    total_segments = 1
+    processed_segments = -1
+    while total_segments != processed_segments:
+        response = requests.request("POST", req_url, headers=headers, json=payload)
+        if response.status_code != 200:
+            print(response)
+            return None
+        events_dict = response.json()
+        total_segments = events_dict['total_segments']
+        processed_segments = events_dict['processed_segments']
+        if total_segments != processed_segments:
+            time.sleep(wait)
+            wait = min(wait * 2, MAX_POLL_INTERVAL)
+    print(f"Event search success {response}")
+    return events_dict['results']
+
+
+def build_time_range(window, start=None, end=None):
+    # Build the time_range of a search: an absolute start and end when both are given, otherwise a relative window
+
+    # rtype: dict
+    if start and end:
+        return {"start": start, "end": end}
+    return {"window": window}
+
+
+def read_hunts(query_file, defaults):
+    # Read the saved hunts from a JSON file, filling in anything a hunt leaves out from the command line defaults. The
+    # command line time range only applies to hunts that set no window, start or end of their own.
+
+    # rtype: list of dict or None
+    with open(query_file, 'r') as f:
+        hunts = json.load(f)
+    for i, hunt in enumerate(hunts):
+        own_time_range = any(hunt.get(key) for key in TIME_RANGE_KEYS)
+        for key, value in defaults.items():
+            if own_time_range and key in TIME_RANGE_KEYS:
+                continue
+            hunt.setdefault(key, value)
+        hunt.setdefault('name', f"hunt{i + 1}")
+        if bool(hunt.get('start')) != bool(hunt.get('end')):
+            print(f"Hunt '{hunt['name']}' needs both a start and an end")
+            return None
+    return hunts
 
-    req_url = build_process_search_url(args.environment, args.org_key)
-    api_token = f"{args.api_secret}/{args.api_id}"
 
+def search_processes(environment, org_key, headers, hunt):
+    # Run the process search for a hunt and wait for the job to finish
+
+    # rtype: list or None
+    req_url = build_process_search_url(environment, org_key)
     payload = {
     "criteria":
     {},
     "exclusions":
     {},
-    "query": "scriptload_name:*.js",
-    "time_range":
-    {
-        "window":"-5m"
-    },
-    "rows": 10000,
+    "query": hunt['query'],
+    "time_range": build_time_range(hunt.get('window'), hunt.get('start'), hunt.get('end')),
+    "rows": hunt['rows'],
     "fields":
     [
        "*"
@@ -111,68 +180,172 @@ def main():
         }
     ]
     }
+    response = requests.request("POST", req_url, headers=headers, json=payload)
+    if response.status_code != 200:
+        print(f"{hunt['name']}: {response}")
+        return None
+    print(f"Process search success {response}")
+    response = response.json()
+    job_id = response['job_id']
+
+    # Now that we have a job_id, check the status of it.
+    req_url = build_process_search_job_id_url(environment, org_key, job_id)
+
+    wait = POLL_INTERVAL
+    # Initialize contacted and completed to different values so the while loop kicks off at least once
+    contacted = 1
+    completed = -1
+    while contacted != completed:
+        response = requests.request("GET", req_url, headers=headers, params={"start": 0, "rows": hunt['rows']})
+        response = response.json()
+        contacted = response['contacted']
+        completed = response['completed']
+        if contacted != completed:
+            time.sleep(wait)
+            wait = min(wait * 2, MAX_POLL_INTERVAL)
+    print(f"{hunt['name']}: number of processes found: " + str(response['num_found']))
+    return response['results']
+
+
+def run_hunt(environment, org_key, headers, hunt, cache_file, cache_ttl, lookup_workers):
+    # Run one hunt: search for the processes, then search the events of each one and merge the two
+
+    # rtype: DataFrame or None
+    results = search_processes(environment, org_key, headers, hunt)
+    if results is None:
+        return None
+    processes_df = pd.DataFrame.from_dict(results)
+    if processes_df.empty:
+        return processes_df
 
+    # Now that we have process_guids we can do an event search:
+    fields = hunt['fields']
+    if fields != ["*"]:
+        # process_guid is needed to merge the events with their processes
+        fields = list(dict.fromkeys(['process_guid'] + fields))
+    payload = {
+      "query": hunt['query'],
+      "fields": fields,
+      "time_range": build_time_range(hunt.get('window'), hunt.get('start'), hunt.get('end'))
+    }
+    if 'window' in payload['time_range']:
+        cache_file = None
+    cache = ProcessDetailCache(cache_file, ttl=cache_ttl, kind="process_events")
+    search_key = json.dumps([payload['query'], payload['fields'], payload['time_range']], sort_keys=True)
+    terminated = {}
+    if 'process_terminated' in processes_df:
+        terminated = dict(zip(processes_df['process_guid'], processes_df['process_terminated']))
+
+    def search(key):
+        process_guid = json.loads(key)[0]
+        print("Searching events of process " + process_guid)
+        return fetch_process_events(environment, org_key, headers, process_guid, payload)
+
+    # The event searches run --lookup_workers at a time. Searches that failed are left out so they are not cached.
+    def fetch(keys):
+        fetched = {}
+        with ThreadPoolExecutor(max_workers=lookup_workers) as executor:
+            for key, results in zip(keys, executor.map(search, keys)):
+                if results is not None:
+                    fetched[key] = {
+                        "process_terminated": bool(terminated.get(json.loads(key)[0])),
+                        "results": results
+                    }
+        return fetched
+
+    keys = [json.dumps([process_guid, search_key]) for process_guid in processes_df['process_guid']]
+    cached = cache.get_many(keys, fetch)
+    cache.close()
+    print(f"{hunt['name']}: event cache {cache.hits} hits, {cache.misses} fetched")
+    events = [event for key in dict.fromkeys(keys) for event in (cached.get(key) or {}).get('results', [])]
+    events_df = pd.DataFrame.from_dict(events)
+
+    if events_df.empty:
+        return processes_df
+    return pd.merge(processes_df, events_df, on='process_guid', how='left')
+
+
+def main():
+    # Main function to parse arguments and retrieve the endpoint results
+
+    parser = argparse.ArgumentParser(prog="events.py",
+                                     description="Query VMware Carbon Black Cloud for process data.")
+    requiredNamed = parser.add_argument_group('required arguments')
+    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
+                               choices=["EAP1", "PROD01", "PROD02", "PROD05", "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                               help="Environment for the Base URL")
+    requiredNamed.add_argument("-o", "--org_key", required=True,
+                               help="Org key (found in your product console under Settings > API Access > API Keys)")
+    requiredNamed.add_argument("-i", "--api_id", required=True,
+                               help="API ID")
+    requiredNamed.add_argument("-s", "--api_secret", required=True,
+                               help="API Secret Key")
+    parser.add_argument("-q", "--query", default="scriptload_name:*.js", help="Process and event search query")
+    parser.add_argument("--window", default="-5m", help="Relative time window to search, e.g. --window=-1h")
+    parser.add_argument("--start", help="Start of an absolute time range, e.g. 2024-01-01T00:00:00.000Z (needs --end)")
+    parser.add_argument("--end", help="End of an absolute time range (needs --start)")
+    parser.add_argument("--fields", default="*", help="Comma separated event fields to return (default: all)")
+    parser.add_argument("--rows", type=int, default=10000, help="Number of processes to search events for")
+    parser.add_argument("--query_file", help="JSON file of saved hunts to run concurrently, one CSV per hunt")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of hunts to run concurrently")
+    parser.add_argument("--lookup_workers", type=int, default=8,
+                        help="Number of per-process event searches to run concurrently for each hunt")
+    parser.add_argument("--cache_file", default=DEFAULT_CACHE_FILE, help="Process cache shared between scripts")
+    parser.add_argument("--cache_ttl", type=int, default=3600,
+                        help="Seconds to keep the events of a process that was still running when fetched")
+    parser.add_argument("--no_cache", action='store_true', help="Do not read or write the on-disk process cache")
+    args = parser.parse_args()
+
+    if bool(args.start) != bool(args.end):
+        parser.error("--start and --end must be given together")
+
+    api_token = f"{args.api_secret}/{args.api_id}"
     headers = {
         "Content-Type": "application/json",
         "X-Auth-Token": api_token
     }
 
-    response = requests.request("POST", req_url, headers=headers, json=payload)
-
-    if response.status_code == 200:
-        print(f"Process search success {response}")
-        response = response.json()
-        job_id = response['job_id']
-
-        # Now that we have a job_id, check the status of it.
-        req_url = build_process_search_job_id_url(args.environment, args.org_key, job_id)
-
-        # Initialize contacted and completed to different values so the while loop kicks off at least once
-        contacted = 1
-        completed = -1
-        while contacted != completed:
-            response = requests.request("GET", req_url, headers=headers)
-            response = response.json()
-            contacted = response['contacted']
-            completed = response['completed']
-        print("Number of processes found: " + str(response['num_found']))
-        processes_df = pd.DataFrame.from_dict(response['results'])
-        print("Done with Process pull")
-
-        # Now that we have process_guids we can do an event search:
-        events_df = pd.DataFrame() # Instantiate our events dataframe
-        for i, row in processes_df.iterrows():
-            print("Process dataframe row " + str(processes_df.index[i]))
-            req_url = build_event_search_url(args.environment, args.org_key, row['process_guid'])
-            payload = {
-              "query": "scriptload_name:*.js",
-              "fields": ["*"],
-              "time_range": {
-                "window":"-5m"
-              }
-            }
-            # Initialize total_segments and processed_segments to different values so the while loop kicks off at least once
-            total_segments = 1
-            processed_segments = -1
-            while total_segments != processed_segments:
-                response = requests.request("POST", req_url, headers=headers, json=payload)
-                events_dict = response.json()
-                event_data_df = pd.DataFrame.from_dict(events_dict['results'])
-                total_segments = events_dict['total_segments']
-                processed_segments = events_dict['processed_segments']
-            print(f"Event search success {response}")
-            events_df = pd.concat([events_df, event_data_df], ignore_index=True)
-
-        merged_df = pd.merge(processes_df, events_df, on='process_guid', how='left')
+    defaults = {
+        "query": args.query,
+        "window": args.window,
+        "start": args.start,
+        "end": args.end,
+        "fields": [field.strip() for field in args.fields.split(',') if field.strip()],
+        "rows": args.rows
+    }
+    cache_file = None if args.no_cache else args.cache_file
+    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
 
+    if not args.query_file:
+        merged_df = run_hunt(args.environment, args.org_key, headers, dict(defaults, name="events"),
+                             cache_file, args.cache_ttl, args.lookup_workers)
+        if merged_df is None:
+            return 1
         # Cool. Let's export to CSV now
         print("Done with Events pull")
-        timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
         merged_df.to_csv('events-' + timestamp + '.csv')
         print('Saved to \'events-' + timestamp + '.csv\'')
-    else:
-        print(response)
+        return 0
+
+    hunts = read_hunts(args.query_file, defaults)
+    if hunts is None:
+        return 1
+    print(f"Running {len(hunts)} hunts")
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(run_hunt, args.environment, args.org_key, headers, hunt, cache_file,
+                                   args.cache_ttl, args.lookup_workers): hunt for hunt in hunts}
+        for future in as_completed(futures):
+            hunt = futures[future]
+            merged_df = future.result()
+            if merged_df is None:
+                failures += 1
+                continue
+            filename = 'events-' + re.sub(r'[^\w.-]+', '_', hunt['name']) + '-' + timestamp + '.csv'
+            merged_df.to_csv(filename)
+            print(f"{hunt['name']}: {len(merged_df)} rows saved to '{filename}'")
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
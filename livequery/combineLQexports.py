@@ -1,35 +1,347 @@
+import requests
+import argparse
 import sys
+import os
+import json
 import pandas as pd
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# This script combines Live Query (Audit & Remediation) result exports into a single table joined on device_id.
+
+# What gets combined is described by a JSON config file:
+# {
+#     "key": "device_id",
+#     "drop_columns": ["sensor_msg", "response"],
+#     "output": "browser-extensions.csv",
+#     "sources": [
+#         {"file": "chrome-extensions.csv", "role": "base"},
+#         {"file": "ff-addons.csv", "role": "base"},
+#         {"file": "dns-info.csv", "dropna": true},
+#         {"file": "os-info.csv", "columns": ["device_id", "os_name", "os_version"], "dtypes": {"os_name": "category"}}
+#     ]
+# }
+# Sources with "role": "base" are stacked on top of each other and every other source is left-joined onto them by the
+# key column. Columns a joined source shares with the base (device_name for instance) are taken from the base.
+# "columns" limits which columns are read, "dtypes" overrides the column types (the key is read as int64 and everything
+# else as string by default) and "dropna" drops incomplete rows of that source. Output ending in .parquet is written
+# as Parquet, anything else as CSV.
+# A source can give "run_id" instead of "file" to pull the results of a Live Query run straight from the API, e.g.
+#     {"run_id": "nu9aj8n5iycbjevbwi9g4mqwwpd1iqb4", "role": "base"}
+# Matched results of every run are paged through concurrently and fed into the join without writing intermediate CSVs.
+# Each result becomes a row of device_id, device_name and the query's own columns. Run sources need the
+# --environment, --org_key, --api_id and --api_secret arguments.
+# Without a config file the script combines dns-info.csv, os-info.csv, chrome-extensions.csv and ff-addons.csv into
+# browser-extensions-<timestamp>.csv.
+
+# When the base sources are larger than --stream_threshold_mb (or --stream is given) they are streamed through pyarrow
+# in blocks and each block is joined and written out before the next one is read, so the base never has to fit in
+# memory. The joined sources are still loaded in full, which is fine as they have roughly one row per device.
+# Streamed output keeps the order of the inputs instead of being sorted by the key.
+
+# Usage: python combineLQexports.py --help
+
+# API key permissions required (only for run_id sources):
+# Live Query - livequery.manage - READ
+
+def get_environment(environment):
+    # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
+
+    # rtype: string
+
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
+    if environment == "EAP1":
+        return "https://defense-eap01.confer.deploy.net"
+    elif environment == "PROD01":
+        return "https://dashboard.confer.net"
+    elif environment == "PROD02":
+        return "https://defense.conferdeploy.net"
+    elif environment == "PROD05":
+        return "https://defense-prod05.conferdeploy.net"
+    elif environment == "PROD06":
+        return "https://defense-eu.conferdeploy.net"
+    elif environment == "PRODNRT":
+        return "https://defense-prodnrt.conferdeploy.net"
+    elif environment == "PRODSYD":
+        return "https://defense-prodsyd.conferdeploy.net"
+    elif environment == "PRODUK":
+        return "https://ew2.carbonblack.vmware.com"
+    elif environment == "GOVCLOUD":
+        return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
+
+
+def setup_session(api_secret, api_id):
+    s = requests.session()
+    headers = {
+        "X-Auth-Token": f"{api_secret}/{api_id}",
+        "Content-Type": "application/json"
+        }
+    s.headers.update(headers)
+    return s
+
+
+def build_run_results_url(environment, org_key, run_id):
+    # Build the URL to search the results of a Live Query run
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-query-api/#get-run-results
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/livequery/v1/orgs/{org_key}/runs/{run_id}/results/_search"
+
+
+def fetch_run_results(session, environment, org_key, run_id, rows=10000):
+    # Page through the matched results of a Live Query run and flatten them into a DataFrame of device_id, device_name
+    # and the columns returned by the query
+
+    # rtype: pandas.DataFrame
+    url = build_run_results_url(environment, org_key, run_id)
+    payload = {
+        "criteria": {
+            "status": ["matched"]
+        },
+        "start": 0,
+        "rows": rows,
+        "sort": [
+            {
+                "field": "device.id",
+                "order": "ASC"
+            }
+        ]
+    }
+    records = []
+    while True:
+        r = session.post(url, json=payload)
+        if r.status_code >= 300:
+            raise RuntimeError(f"Fetching results of run {run_id} failed: {r.status_code} {r.text}")
+        page = r.json()
+        for result in page['results']:
+            record = {"device_id": result['device']['id'], "device_name": result['device'].get('name')}
+            record.update(result.get('fields', {}))
+            records.append(record)
+        payload['start'] += len(page['results'])
+        if not page['results'] or payload['start'] >= page.get('num_found', 0):
+            break
+    print(f"Fetched {len(records)} results of run {run_id}")
+    return pd.DataFrame.from_records(records)
+
+
+def fetch_run_sources(config, session, environment, org_key, workers):
+    # Fetch every run_id source concurrently and attach the results to the source as its 'frame'
+
+    # rtype: None
+    run_sources = [source for source in config['sources'] if source.get('run_id')]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        frames = executor.map(lambda source: fetch_run_results(session, environment, org_key, source['run_id']),
+                              run_sources)
+        for source, frame in zip(run_sources, frames):
+            source['frame'] = frame
+
+
+DEFAULT_CONFIG = {
+    "key": "device_id",
+    "drop_columns": ["sensor_msg", "response"],
+    "output": None,
+    "sources": [
+        {"file": "chrome-extensions.csv", "role": "base"},
+        {"file": "ff-addons.csv", "role": "base"},
+        {"file": "dns-info.csv", "dropna": True},
+        {"file": "os-info.csv"}
+    ]
+}
+
+
+def load_config(filename):
+    # Load the combine config, filling in defaults for anything left out
+
+    # rtype: dict
+    config = dict(DEFAULT_CONFIG)
+    if filename:
+        with open(filename, 'r') as f:
+            config.update(json.load(f))
+    if not config.get('output'):
+        timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+        config['output'] = 'browser-extensions-' + timestamp + '.csv'
+    return config
 
-def main():
-    # import our csvs to dataframes and massage data as needed
-    df_dns_info = pd.read_csv("dns-info.csv")
-    df_dns_info = df_dns_info.drop(columns=['sensor_msg', 'response'])
-    df_dns_info = df_dns_info.dropna()
 
-    df_os_info = pd.read_csv("os-info.csv")
-    df_os_info = df_os_info.drop(columns=['sensor_msg', 'response'])
+def source_columns(source, drop_columns):
+    # Work out which columns of a source to read without loading any of its rows
 
-    df_chrome_extensions = pd.read_csv("chrome-extensions.csv")
-    df_chrome_extensions = df_chrome_extensions.drop(columns=['sensor_msg', 'response'])
+    # rtype: list
+    if source.get('columns'):
+        return list(source['columns'])
+    if 'frame' in source:
+        header = source['frame'].columns
+    else:
+        header = pd.read_csv(source['file'], nrows=0).columns
+    return [column for column in header if column not in drop_columns]
 
-    df_ff_addons = pd.read_csv("ff-addons.csv")
-    df_ff_addons = df_ff_addons.drop(columns=['sensor_msg', 'response'])
 
-    # Tie the data together
-    df_extensions = pd.concat([df_chrome_extensions, df_ff_addons])
-    df_extensions = pd.merge(df_extensions, df_dns_info, on=['device_id', 'device_name'], how='left')
-    df_extensions = pd.merge(df_extensions, df_os_info, on=['device_id', 'device_name'], how='left')
+def source_dtypes(source, key):
+    # Explicit, compact column types for a source: the key as int64, per-source overrides, and string for the rest
 
-    # re-sort by device_id
-    df_extensions = df_extensions.sort_values(by=['device_id'])
+    # rtype: defaultdict
+    return defaultdict(lambda: "string", {key: "int64", **source.get('dtypes', {})})
 
-    # Cool. Let's export to CSV now
-    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
-    df_extensions.to_csv('browser-extensions-' + timestamp + '.csv', index=False)
+
+def read_source(source, key, drop_columns):
+    # Read only the needed columns of a source with explicit dtypes
+
+    # rtype: pandas.DataFrame
+    columns = source_columns(source, drop_columns)
+    dtypes = source_dtypes(source, key)
+    if 'frame' in source:
+        df = source['frame'].reindex(columns=columns).astype({column: dtypes[column] for column in columns})
+    else:
+        df = pd.read_csv(source['file'], usecols=columns, dtype=dtypes)
+    if source.get('dropna'):
+        df = df.dropna()
+    return df
+
+
+def read_lookups(config, base_columns):
+    # Load every non-base source indexed by the key, ready to be joined onto the base rows
+
+    # rtype: list of pandas.DataFrame
+    key = config['key']
+    lookups = []
+    for source in config['sources']:
+        if source.get('role') == 'base':
+            continue
+        df = read_source(source, key, config['drop_columns'])
+        df = df.drop(columns=[column for column in df.columns if column != key and column in base_columns])
+        lookups.append(df.set_index(key))
+    return lookups
+
+
+def join_lookups(df, lookups, key):
+    # Left-join the indexed lookups onto a frame of base rows
+
+    # rtype: pandas.DataFrame
+    for lookup in lookups:
+        df = df.join(lookup, on=key, how='left')
+    return df
+
+
+def combine_in_memory(config, base_sources, base_columns, lookups):
+    # Read the base sources in full, join, sort by the key and write the result
+
+    # rtype: int (number of rows written)
+    key = config['key']
+    frames = [read_source(source, key, config['drop_columns']) for source in base_sources]
+    df = pd.concat(frames, ignore_index=True).reindex(columns=base_columns)
+    df = join_lookups(df, lookups, key)
+    df = df.sort_values(by=[key], kind='stable')
+    if config['output'].endswith('.parquet'):
+        df.to_parquet(config['output'], index=False)
+    else:
+        df.to_csv(config['output'], index=False)
+    return len(df)
+
+
+def combine_streaming(config, base_sources, base_columns, lookups, block_size):
+    # Stream the base sources through pyarrow block by block, joining and writing each block as it is read
+
+    # rtype: int (number of rows written)
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    key = config['key']
+    output = config['output']
+    as_parquet = output.endswith('.parquet')
+    writer = None
+    rows = 0
+    try:
+        for source in base_sources:
+            columns = source_columns(source, config['drop_columns'])
+            dtypes = source_dtypes(source, key)
+            if 'frame' in source:
+                # Fetched run results are already in memory, so they are joined and written as a single block
+                blocks = [read_source(source, key, config['drop_columns'])]
+            else:
+                column_types = {column: pa.int64() if dtypes[column] == "int64" else pa.string() for column in columns}
+                blocks = (batch.to_pandas() for batch in
+                          pa_csv.open_csv(source['file'],
+                                          read_options=pa_csv.ReadOptions(block_size=block_size),
+                                          convert_options=pa_csv.ConvertOptions(include_columns=columns,
+                                                                                column_types=column_types)))
+            for df in blocks:
+                if source.get('dropna'):
+                    df = df.dropna()
+                df = df.reindex(columns=base_columns).astype({column: dtypes[column] for column in base_columns})
+                df = join_lookups(df, lookups, key)
+                if as_parquet:
+                    table = pa.Table.from_pandas(df, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(output, table.schema)
+                    writer.write_table(table.cast(writer.schema))
+                else:
+                    df.to_csv(output, index=False, mode='a' if rows else 'w', header=not rows)
+                rows += len(df)
+    finally:
+        if writer is not None:
+            writer.close()
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="combineLQexports.py",
+                                     description="Combine Live Query result exports into one table joined on device_id.")
+    parser.add_argument("-c", "--config", help="JSON file describing the sources to combine")
+    parser.add_argument("-f", "--output", help="Output file (.csv or .parquet), overrides the config")
+    parser.add_argument("--stream", action='store_true', help="Always stream the base sources through pyarrow")
+    parser.add_argument("--stream_threshold_mb", type=int, default=1024,
+                        help="Stream automatically when the base sources are larger than this many MB")
+    parser.add_argument("--block_size_mb", type=int, default=64, help="Size of each streamed block in MB")
+    parser.add_argument("-e", "--environment", default="PROD05",
+                        choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                 "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                        help="Environment for the Base URL (run_id sources only)")
+    parser.add_argument("-o", "--org_key",
+                        help="Org key (found in your product console under \
+                              Settings > API Access > API Keys)")
+    parser.add_argument("-i", "--api_id", help="API ID")
+    parser.add_argument("-s", "--api_secret", help="API Secret Key")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of runs to fetch concurrently")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    if any(source.get('run_id') for source in config['sources']):
+        if not (args.org_key and args.api_id and args.api_secret):
+            parser.error("run_id sources require --org_key, --api_id and --api_secret")
+        session = setup_session(args.api_secret, args.api_id)
+        fetch_run_sources(config, session, args.environment, args.org_key, args.workers)
+    if args.output:
+        config['output'] = args.output
+    key = config['key']
+
+    base_sources = [source for source in config['sources'] if source.get('role') == 'base']
+    if not base_sources:
+        print("The config needs at least one source with \"role\": \"base\"")
+        return 1
+    base_columns = []
+    for source in base_sources:
+        for column in source_columns(source, config['drop_columns']):
+            if column not in base_columns:
+                base_columns.append(column)
+
+    lookups = read_lookups(config, base_columns)
+
+    base_size = sum(os.path.getsize(source['file']) for source in base_sources if 'file' in source)
+    if args.stream or base_size > args.stream_threshold_mb * 1024 * 1024:
+        print(f"Streaming {base_size / 1048576:.0f} MB of base rows")
+        rows = combine_streaming(config, base_sources, base_columns, lookups, args.block_size_mb * 1024 * 1024)
+    else:
+        rows = combine_in_memory(config, base_sources, base_columns, lookups)
+
+    print(f"Saved {rows} rows to '{config['output']}'")
 
 
 if __name__ == "__main__":
     sys.exit(main())
-
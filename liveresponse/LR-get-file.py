@@ -0,0 +1,196 @@
+import requests
+import argparse
+import sys
+import json
+import time
+import hashlib
+import os
+
+# This script retrieves a file from a device over an already established Live Response session and streams it to disk.
+# The file is written in chunks as raw bytes, so binary files (memory dumps, archives, etc.) are not corrupted and
+# large files do not need to fit in memory. An interrupted download can be picked up again with --resume.
+
+# Usage: python LR-get-file.py --help
+
+# API key permissions required:
+# org.liveresponse.session - READ
+# org.liveresponse.file - READ
+
+
+def get_environment(environment):
+    # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
+
+    # rtype: string
+
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
+    if environment == "EAP1":
+        return "https://defense-eap01.confer.deploy.net"
+    elif environment == "PROD01":
+        return "https://dashboard.confer.net"
+    elif environment == "PROD02":
+        return "https://defense.conferdeploy.net"
+    elif environment == "PROD05":
+        return "https://defense-prod05.conferdeploy.net"
+    elif environment == "PROD06":
+        return "https://defense-eu.conferdeploy.net"
+    elif environment == "PRODNRT":
+        return "https://defense-prodnrt.conferdeploy.net"
+    elif environment == "PRODSYD":
+        return "https://defense-prodsyd.conferdeploy.net"
+    elif environment == "PRODUK":
+        return "https://ew2.carbonblack.vmware.com"
+    elif environment == "GOVCLOUD":
+        return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
+
+
+def build_session_command_url(environment, org_key, session_id):
+    # Build the URL to issue LR commands
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-response-api/#issue-command
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions/{session_id}/commands"
+
+
+def build_command_id_url(environment, org_key, session_id, command_id):
+    # Build the URL to retrieve the LR command results
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-response-api/#retrieve-command-status
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions/{session_id}/commands/{command_id}"
+
+
+def build_get_file_contents_url(environment, org_key, session_id, file_id):
+    # Build the URL to retreive the contents of a file via LR
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-response-api/#get-file-content
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions/{session_id}/files/{file_id}/content"
+
+
+def download_file_content(req_url, headers, filename, chunk_size=1048576, resume=False, hash_algorithm=None):
+    # Stream the contents of a Live Response file to disk in chunks of bytes so the whole file never has to sit in memory.
+    # If resume is set and a partial local file already exists, a Range request is made for the remaining bytes. Servers
+    # that ignore the Range header answer with a 200 and the download simply starts over.
+    # If hash_algorithm is given (e.g. "sha256") the data is hashed as it is written. Returns whether the download
+    # succeeded and the hex digest (None without a hash_algorithm), so a failed download is never mistaken for a file
+    # that merely has no digest.
+
+    # rtype: tuple (bool, string or None)
+
+    hasher = hashlib.new(hash_algorithm) if hash_algorithm else None
+    request_headers = dict(headers)
+    offset = 0
+    if resume and os.path.exists(filename):
+        offset = os.path.getsize(filename)
+    if offset > 0:
+        request_headers['Range'] = f"bytes={offset}-"
+
+    with requests.get(req_url, headers=request_headers, stream=True) as response:
+        if response.status_code == 416:
+            # The requested range starts at the end of the file, so the local copy is already complete
+            print('Local file is already complete')
+            response = None
+        elif response.status_code == 206:
+            print(f"Resuming download at byte {offset}")
+        elif response.status_code == 200:
+            offset = 0
+        else:
+            print(f"Download failed {response}")
+            return False, None
+
+        if offset > 0 and hasher is not None:
+            # Bring the hash up to date with the bytes we already have on disk
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    hasher.update(chunk)
+
+        if response is not None:
+            with open(filename, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+
+    if hasher is not None:
+        return True, hasher.hexdigest()
+    return True, None
+
+
+def main():
+    # Main function to parse arguments and retrieve the file
+
+    parser = argparse.ArgumentParser(prog="LR-get-file.py",
+                                     description="Download a file from a device via an existing Live Response session.")
+    requiredNamed = parser.add_argument_group('required arguments')
+    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
+                               choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                        "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                               help="Environment for the Base URL")
+    requiredNamed.add_argument("-o", "--org_key", required=True,
+                               help="Org key (found in your product console under \
+                              Settings > API Access > API Keys)")
+    requiredNamed.add_argument("-i", "--api_id", required=True,
+                               help="API ID")
+    requiredNamed.add_argument("-s", "--api_secret", required=True,
+                               help="API Secret Key")
+    requiredNamed.add_argument("-sid", "--session_id", required=True, help="Active Live Response session ID")
+    requiredNamed.add_argument("-p", "--path", required=True, help="Full path of the file on the device")
+    parser.add_argument("-fid", "--file_id", help="File ID of a previous 'get file' command. Skips issuing a new one, "
+                                                   "which saves a re-upload when resuming")
+    parser.add_argument("-f", "--output_file", help="Local filename to write to (defaults to the remote file name)")
+    parser.add_argument("-r", "--resume", action='store_true',
+                        help="Resume a partial download of the local file using a Range request")
+    parser.add_argument("--hash", choices=["md5", "sha1", "sha256"], help="Hash the file while it is written")
+    parser.add_argument("--chunk_size", type=int, default=1048576, help="Bytes to read and write at a time")
+    args = parser.parse_args()
+
+    api_token = f"{args.api_secret}/{args.api_id}"
+    headers = {
+        "Content-Type": "application/json",
+        "X-Auth-Token": api_token
+    }
+    output_file = args.output_file or args.path.replace('\\', '/').split('/')[-1]
+
+    file_id = args.file_id
+    if file_id is None:
+        # Ask the sensor to upload the file to the backend, then wait for the command to finish
+        req_url = build_session_command_url(args.environment, args.org_key, args.session_id)
+        payload = {
+            "name": "get file",
+            "path": f"{args.path}"
+        }
+        print("Requesting " + args.path)
+        response = requests.request("POST", req_url, headers=headers, json=payload)
+        command = json.loads(response.text)
+        req_url = build_command_id_url(args.environment, args.org_key, args.session_id, command['id'])
+        while command['status'] == "PENDING":
+            print('Waiting for the file upload, trying again in 10 seconds...')
+            time.sleep(10)
+            response = requests.request("GET", req_url, headers=headers)
+            command = json.loads(response.text)
+        if command['status'] != "COMPLETE":
+            print('status: ' + command['status'])
+            return 1
+        file_id = command['file_details']['file_id']
+        print("File ID: " + file_id)
+
+    req_url = build_get_file_contents_url(args.environment, args.org_key, args.session_id, file_id)
+    ok, digest = download_file_content(req_url, headers, output_file, chunk_size=args.chunk_size,
+                                       resume=args.resume, hash_algorithm=args.hash)
+    if not ok or not os.path.exists(output_file):
+        return 1
+    print('Saved to \'' + output_file + '\' (' + str(os.path.getsize(output_file)) + ' bytes)')
+    if digest is not None:
+        print(args.hash + ': ' + digest)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,298 @@
+import requests
+import argparse
+import sys
+import json
+import time
+import hashlib
+import os
+
+# This script runs a playbook of Live Response commands against a device. Rather than issuing one command and waiting
+# for it to finish before issuing the next, every command in the playbook is submitted to the session back-to-back and
+# the command IDs are tracked together. Results are printed (and saved) as each command finishes, so a playbook takes
+# roughly as long as its slowest command instead of the sum of all of them.
+
+# The playbook is a JSON file containing a list of command payloads exactly as the issue-command API expects them, e.g.
+# [
+#     {"name": "create process", "path": "c:\\program files\\confer\\repcli.exe status",
+#      "output_file": "c:\\windows\\temp\\repcli.txt", "wait": false},
+#     {"name": "process list"},
+#     {"name": "directory list", "path": "c:\\windows\\temp\\"}
+# ]
+# When a "create process" command with an output_file completes, a "get file" command is queued for the output file
+# and its contents are downloaded locally. "get file" commands in the playbook are downloaded the same way.
+
+# Usage: python LR-run-playbook.py --help
+
+# API key permissions required:
+# org.liveresponse.session - CREATE, READ, DELETE
+# org.liveresponse.process - READ, EXECUTE
+# org.liveresponse.file - READ
+
+def get_environment(environment):
+    # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
+
+    # rtype: string
+
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
+    if environment == "EAP1":
+        return "https://defense-eap01.confer.deploy.net"
+    elif environment == "PROD01":
+        return "https://dashboard.confer.net"
+    elif environment == "PROD02":
+        return "https://defense.conferdeploy.net"
+    elif environment == "PROD05":
+        return "https://defense-prod05.conferdeploy.net"
+    elif environment == "PROD06":
+        return "https://defense-eu.conferdeploy.net"
+    elif environment == "PRODNRT":
+        return "https://defense-prodnrt.conferdeploy.net"
+    elif environment == "PRODSYD":
+        return "https://defense-prodsyd.conferdeploy.net"
+    elif environment == "PRODUK":
+        return "https://ew2.carbonblack.vmware.com"
+    elif environment == "GOVCLOUD":
+        return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
+
+def build_start_session_url(environment, org_key):
+    # Build the base URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-response-api/#start-session
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions"
+
+
+def build_session_command_url(environment, org_key, session_id):
+    # Build the URL to issue LR commands
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-response-api/#issue-command
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions/{session_id}/commands"
+
+
+def build_command_id_url(environment, org_key, session_id, command_id):
+    # Build the URL to retrieve the LR command results
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-response-api/#retrieve-command-status
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions/{session_id}/commands/{command_id}"
+
+
+def build_get_file_contents_url(environment, org_key, session_id, file_id):
+    # Build the URL to retreive the contents of a file via LR
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-response-api/#get-file-content
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions/{session_id}/files/{file_id}/content"
+
+
+def build_close_session_url(environment, org_key, session_id):
+    # Build the base URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/live-response-api/#close-session
+    # rtype: string
+
+    environment = get_environment(environment)
+    return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions/{session_id}"
+
+
+def download_file_content(req_url, headers, filename, chunk_size=1048576, resume=False, hash_algorithm=None):
+    # Stream the contents of a Live Response file to disk in chunks of bytes so the whole file never has to sit in memory.
+    # If resume is set and a partial local file already exists, a Range request is made for the remaining bytes. Servers
+    # that ignore the Range header answer with a 200 and the download simply starts over.
+    # If hash_algorithm is given (e.g. "sha256") the data is hashed as it is written. Returns whether the download
+    # succeeded and the hex digest (None without a hash_algorithm), so a failed download is never mistaken for a file
+    # that merely has no digest.
+
+    # rtype: tuple (bool, string or None)
+
+    hasher = hashlib.new(hash_algorithm) if hash_algorithm else None
+    request_headers = dict(headers)
+    offset = 0
+    if resume and os.path.exists(filename):
+        offset = os.path.getsize(filename)
+    if offset > 0:
+        request_headers['Range'] = f"bytes={offset}-"
+
+    with requests.get(req_url, headers=request_headers, stream=True) as response:
+        if response.status_code == 416:
+            # The requested range starts at the end of the file, so the local copy is already complete
+            print('Local file is already complete')
+            response = None
+        elif response.status_code == 206:
+            print(f"Resuming download at byte {offset}")
+        elif response.status_code == 200:
+            offset = 0
+        else:
+            print(f"Download failed {response}")
+            return False, None
+
+        if offset > 0 and hasher is not None:
+            # Bring the hash up to date with the bytes we already have on disk
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    hasher.update(chunk)
+
+        if response is not None:
+            with open(filename, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+
+    if hasher is not None:
+        return True, hasher.hexdigest()
+    return True, None
+
+
+def start_session(environment, org_key, headers, device_id):
+    # Establish a Live Response session with the device, retrying while the session is PENDING
+
+    # rtype: string or None
+    req_url = build_start_session_url(environment, org_key)
+    payload = {
+        "device_id": f"{device_id}"
+    }
+    status = "PENDING"
+    print('Connecting to device ID: ' + f"{device_id}")
+    while status == "PENDING":
+        response = requests.request("POST", req_url, headers=headers, json=payload)
+        session = json.loads(response.text)
+        status = session['status']
+        if status == "PENDING":
+            print('Trying again in 10 seconds...')
+            time.sleep(10)
+    if status != "ACTIVE":
+        print('Status: ' + status)
+        return None
+    print('Session id: ' + session['id'])
+    return session['id']
+
+
+def run_command_queue(environment, org_key, headers, session_id, commands, max_in_flight=10, poll_interval=5):
+    # Submit the commands to the session back-to-back and yield each one as soon as it is no longer PENDING.
+    # Up to max_in_flight commands are outstanding at once; every pending command ID is checked once per round and a
+    # single sleep covers the whole round, so waiting on one slow command does not hold up the others.
+    # The commands list is consumed as commands are submitted. Follow-up commands (such as fetching the output file
+    # of a "create process") can be appended to it while iterating and they will be picked up on the next round.
+
+    # rtype: generator of dict
+    commands_url = build_session_command_url(environment, org_key, session_id)
+    pending = {}
+    while commands or pending:
+        while commands and len(pending) < max_in_flight:
+            payload = commands.pop(0)
+            response = requests.request("POST", commands_url, headers=headers, json=payload)
+            if response.status_code >= 300:
+                print("Could not submit '" + payload['name'] + "': " + response.text)
+                continue
+            command = json.loads(response.text)
+            pending[command['id']] = payload
+            print("Submitted '" + payload['name'] + "' as command " + str(command['id']))
+
+        finished = 0
+        for command_id in list(pending):
+            req_url = build_command_id_url(environment, org_key, session_id, command_id)
+            response = requests.request("GET", req_url, headers=headers)
+            command = json.loads(response.text)
+            if command['status'] != "PENDING":
+                del pending[command_id]
+                finished += 1
+                yield command
+        if pending and finished == 0:
+            time.sleep(poll_interval)
+
+
+def main():
+    # Main function to parse arguments and run the playbook
+
+    parser = argparse.ArgumentParser(prog="LR-run-playbook.py",
+                                     description="Run a playbook of Live Response commands concurrently on a device.")
+    requiredNamed = parser.add_argument_group('required arguments')
+    requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
+                               choices=["EAP1", "PROD01", "PROD02", "PROD05",
+                                        "PROD06", "PRODNRT", "PRODSYD", "PRODUK", "GOVCLOUD"],
+                               help="Environment for the Base URL")
+    requiredNamed.add_argument("-o", "--org_key", required=True,
+                               help="Org key (found in your product console under \
+                              Settings > API Access > API Keys)")
+    requiredNamed.add_argument("-i", "--api_id", required=True,
+                               help="API ID")
+    requiredNamed.add_argument("-s", "--api_secret", required=True,
+                               help="API Secret Key")
+    requiredNamed.add_argument("-d", "--deviceid", required=True, help="Device ID of target system")
+    requiredNamed.add_argument("-p", "--playbook", required=True, help="JSON file containing the list of commands")
+    parser.add_argument("-sid", "--session_id", help="Use an existing session instead of establishing (and closing) one")
+    parser.add_argument("--max_in_flight", type=int, default=10, help="Maximum number of commands pending at once")
+    parser.add_argument("--poll_interval", type=int, default=5, help="Seconds between command status checks")
+    args = parser.parse_args()
+
+    api_token = f"{args.api_secret}/{args.api_id}"
+    headers = {
+        "Content-Type": "application/json",
+        "X-Auth-Token": api_token
+    }
+
+    with open(args.playbook, 'r') as f:
+        commands = json.load(f)
+
+    session_id = args.session_id
+    if session_id is None:
+        session_id = start_session(args.environment, args.org_key, headers, args.deviceid)
+        if session_id is None:
+            return 1
+
+    start = time.time()
+    results = []
+    failed_downloads = 0
+    for command in run_command_queue(args.environment, args.org_key, headers, session_id, commands,
+                                     max_in_flight=args.max_in_flight, poll_interval=args.poll_interval):
+        results.append(command)
+        print("Command " + str(command['id']) + " '" + command['name'] + "' finished: " + command['status'])
+        if command['status'] != "COMPLETE":
+            continue
+        output_file = (command.get('input') or {}).get('output_file')
+        if command['name'] == "create process" and output_file:
+            # Fetch the process output through the same queue so it overlaps with the remaining commands
+            commands.append({"name": "get file", "path": f"{output_file}"})
+        elif command['name'] == "get file":
+            file_id = command['file_details']['file_id']
+            remote_path = (command.get('input') or {}).get('path') or file_id
+            local_file = f"{args.deviceid}-" + remote_path.replace('\\', '/').split('/')[-1]
+            req_url = build_get_file_contents_url(args.environment, args.org_key, session_id, file_id)
+            ok, _ = download_file_content(req_url, headers, local_file)
+            if not ok:
+                failed_downloads += 1
+                continue
+            print('Saved to \'' + local_file + '\'')
+    print(f"Playbook finished in {time.time() - start:.1f} seconds")
+
+    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+    with open('playbook-' + f"{args.deviceid}" + '-' + timestamp + '.json', "w") as f:
+        json.dump(results, f, indent=4)
+
+    if args.session_id is None:
+        # Close the LR session we opened
+        req_url = build_close_session_url(args.environment, args.org_key, session_id)
+        response = requests.request("DELETE", req_url, headers=headers)
+        if response.status_code == 204:
+            print("Live Response session closed")
+        else:
+            print(response)
+
+    if failed_downloads:
+        print(f"{failed_downloads} file downloads failed")
+        return 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
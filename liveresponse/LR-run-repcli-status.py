@@ -3,6 +3,8 @@ import argparse
 import sys
 import json
 import time
+import hashlib
+import os
 
 # This script establishes a liveresponse session to a device, runs the 'repcli.exe status' command and then returns the result.
 # This script is only meant for Windows endpoints at this time.
@@ -20,6 +22,9 @@ def get_environment(environment):
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -77,6 +82,56 @@ def build_get_file_contents_url(environment, org_key, session_id, file_id):
     return f"{environment}/appservices/v6/orgs/{org_key}/liveresponse/sessions/{session_id}/files/{file_id}/content"
 
 
+def download_file_content(req_url, headers, filename, chunk_size=1048576, resume=False, hash_algorithm=None):
+    # Stream the contents of a Live Response file to disk in chunks of bytes so the whole file never has to sit in memory.
+    # If resume is set and a partial local file already exists, a Range request is made for the remaining bytes. Servers
+    # that ignore the Range header answer with a 200 and the download simply starts over.
+    # If hash_algorithm is given (e.g. "sha256") the data is hashed as it is written. Returns whether the download
+    # succeeded and the hex digest (None without a hash_algorithm), so a failed download is never mistaken for a file
+    # that merely has no digest.
+
+    # rtype: tuple (bool, string or None)
+
+    hasher = hashlib.new(hash_algorithm) if hash_algorithm else None
+    request_headers = dict(headers)
+    offset = 0
+    if resume and os.path.exists(filename):
+        offset = os.path.getsize(filename)
+    if offset > 0:
+        request_headers['Range'] = f"bytes={offset}-"
+
+    with requests.get(req_url, headers=request_headers, stream=True) as response:
+        if response.status_code == 416:
+            # The requested range starts at the end of the file, so the local copy is already complete
+            print('Local file is already complete')
+            response = None
+        elif response.status_code == 206:
+            print(f"Resuming download at byte {offset}")
+        elif response.status_code == 200:
+            offset = 0
+        else:
+            print(f"Download failed {response}")
+            return False, None
+
+        if offset > 0 and hasher is not None:
+            # Bring the hash up to date with the bytes we already have on disk
+            with open(filename, 'rb') as f:
+                for chunk in iter(lambda: f.read(chunk_size), b''):
+                    hasher.update(chunk)
+
+        if response is not None:
+            with open(filename, 'ab' if offset > 0 else 'wb') as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    if chunk:
+                        f.write(chunk)
+                        if hasher is not None:
+                            hasher.update(chunk)
+
+    if hasher is not None:
+        return True, hasher.hexdigest()
+    return True, None
+
+
 def build_close_session_url(environment, org_key, session_id):
     # Build the base URL
     # Documentation on this specific API call can be found here:
@@ -182,13 +237,12 @@ def main():
     file_id = json.loads(response.text)['file_details']['file_id']
     print("File ID: " + file_id)
 
-    # Get the file contents and write it to a file locally
+    # Get the file contents and stream them to a file locally
     req_url = build_get_file_contents_url(args.environment, args.org_key, session_id, file_id)
-    response = requests.request("GET", req_url, headers=headers)  # issue the get contents of the file
-    file_content = response.text
-    f=open('repcli-' + f"{args.deviceid}" + '-.txt', 'w')
-    f.write(file_content)
-    f.close()
+    local_file = 'repcli-' + f"{args.deviceid}" + '-.txt'
+    ok, _ = download_file_content(req_url, headers, local_file)
+    if ok:
+        print('Saved to \'' + local_file + '\'')
 
     # Close the LR session
     req_url = build_close_session_url(args.environment, args.org_key, session_id)
@@ -200,6 +254,9 @@ def main():
     else:
         print(response)
 
+    if not ok:
+        return 1
+
 
 if __name__ == "__main__":
     sys.exit(main())
\ No newline at end of file
@@ -4,13 +4,37 @@ import sys
 import pandas as pd
 import json
 import time
+import os
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-# This script will retrieve observations based off of an alert ID
+# The process detail cache lives in tools/process_cache.py, shared with the other process scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools"))
+from process_cache import ProcessDetailCache  # noqa: E402
+
+# This script will retrieve observations based off of one or more alert IDs.
+# When many alert IDs are given (with --alert-id or --alert_file) they are combined into a few
+# alert_id:(a OR b OR ...) search jobs sized to the query limits, the jobs are run concurrently and the results are
+# split back out into one CSV per alert. A job returns at most 10,000 observations, so a job that found more is split
+# in half and run again.
+# The alerts are looked up first so each search job only covers the time span of its alerts' first and last events
+# (plus --margin_minutes) rather than the default 180 days. Alerts are grouped by time before being split into jobs to
+# keep those spans tight. --fields limits which observation fields are returned.
+# --process_details adds the details of each observation's process (command line, user, hashes, parent). Details are
+# cached by process_guid in a SQLite file (~/.cbcloud/process-cache.sqlite by default) shared with processes.py,
+# events.py and enrich-alerts.py, so processes seen by an earlier run are not requested again.
 
 # Usage: python observations-alert-id.py --help
 
 # API key permissions required:
-# TBD
+# Search - Events - org.search.events - CREATE, READ
+# Alerts - General information - org.alerts - read (for the alert time lookup)
+# Search - Events - org.search.processes - CREATE, READ (for --process_details)
+
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cbcloud", "process-cache.sqlite")
+DETAIL_FIELDS = ["process_guid", "process_name", "process_pid", "process_cmdline", "process_username",
+                 "process_sha256", "process_md5", "process_terminated", "parent_guid", "parent_name", "parent_pid",
+                 "parent_cmdline"]
 
 def get_environment(environment):
     # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
@@ -18,6 +42,9 @@ def get_environment(environment):
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -38,6 +65,17 @@ def get_environment(environment):
         return "https://gprd1usgw1.carbonblack-us-gov.vmware.com"
 
 
+def setup_session(api_secret, api_id, org_key):
+    s = requests.session()
+    headers = {
+        "X-Auth-Token": f"{api_secret}/{api_id}",
+        "X-Org": org_key,
+        "Content-Type": "application/json"
+        }
+    s.headers.update(headers)
+    return s
+
+
 def build_base_url(environment, org_key):
     # Build the observations search job base URL.
     environment = get_environment(environment)
@@ -50,7 +88,202 @@ def build_observations_search_job_id_url(environment, org_key, job_id):
 
     # rtype: string
     environment = get_environment(environment)
-    return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/detail_jobs/{job_id}/results"
+    return f"{environment}/api/investigate/v2/orgs/{org_key}/observations/search_jobs/{job_id}/results"
+
+
+def build_alert_search_url(environment, org_key):
+    # Build the alert search URL
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/alerts-api/#alert-search
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/api/alerts/v7/orgs/{org_key}/alerts/_search"
+
+
+def build_process_detail_url(environment, org_key):
+    # Build the URL to start a process details job
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#request-details-of-processes-v2
+
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/detail_jobs"
+
+
+def parse_timestamp(value):
+    # rtype: datetime
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def format_timestamp(value):
+    # rtype: string
+    return value.strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+def lookup_alert_times(session, environment, org_key, alert_ids, batch_size=1000):
+    # Look up the first and last event times of the alerts, a batch of IDs per request
+
+    # rtype: dict of alert_id -> (first_event, last_event) datetimes
+    times = {}
+    url = build_alert_search_url(environment, org_key)
+    for i in range(0, len(alert_ids), batch_size):
+        batch = alert_ids[i:i + batch_size]
+        payload = {
+            "criteria": {
+                "id": batch
+            },
+            "start": 1,
+            "rows": len(batch)
+        }
+        response = session.post(url, json=payload)
+        if response.status_code != 200:
+            print(f"Alert lookup failed, searching the full window instead: {response}")
+            continue
+        for alert in response.json()['results']:
+            if alert.get('first_event_timestamp') and alert.get('last_event_timestamp'):
+                times[alert['id']] = (parse_timestamp(alert['first_event_timestamp']),
+                                      parse_timestamp(alert['last_event_timestamp']))
+    return times
+
+
+def time_range_for(alert_ids, times, margin, window):
+    # The search time range covering the events of all the given alerts plus a margin, or the fallback window when any
+    # of the alerts could not be looked up
+
+    # rtype: dict
+    if not all(alert_id in times for alert_id in alert_ids):
+        return {"window": window}
+    start = min(times[alert_id][0] for alert_id in alert_ids) - margin
+    end = max(times[alert_id][1] for alert_id in alert_ids) + margin
+    return {"start": format_timestamp(start), "end": format_timestamp(end)}
+
+
+def read_alert_ids(alert_ids, alert_file):
+    # Collect the alert IDs from the command line and/or a file with one ID per line, without duplicates
+
+    # rtype: list
+    ids = list(alert_ids or [])
+    if alert_file:
+        with open(alert_file, 'r') as f:
+            ids.extend(line.strip() for line in f)
+    return list(dict.fromkeys(alert_id for alert_id in ids if alert_id))
+
+
+def build_alert_queries(alert_ids, max_query_length, max_alerts_per_query):
+    # Combine the alert IDs into as few alert_id:(a OR b OR ...) queries as the query limits allow
+
+    # rtype: list of (query, alert_ids) tuples
+    queries = []
+    chunk = []
+    length = 0
+    for alert_id in alert_ids:
+        added = len(alert_id) + (len(' OR ') if chunk else 0)
+        if chunk and (len(chunk) >= max_alerts_per_query or len('alert_id:()') + length + added > max_query_length):
+            queries.append(('alert_id:(' + ' OR '.join(chunk) + ')', chunk))
+            chunk = []
+            length = 0
+            added = len(alert_id)
+        chunk.append(alert_id)
+        length += added
+    if chunk:
+        queries.append(('alert_id:(' + ' OR '.join(chunk) + ')', chunk))
+    return queries
+
+
+def run_search_job(session, environment, org_key, payload, poll_interval=1, rows=10000):
+    # Start an observation search job, wait for it to finish and page through all of its results
+
+    # rtype: tuple (list of results, number of observations found)
+    response = session.post(build_base_url(environment, org_key), json=payload)
+    if response.status_code != 200:
+        raise RuntimeError(f"Observation search failed: {response.status_code} {response.text}")
+    job_id = response.json()['job_id']
+    return wait_for_job(session, build_observations_search_job_id_url(environment, org_key, job_id),
+                        poll_interval=poll_interval, rows=rows)
+
+
+def wait_for_job(session, results_url, poll_interval=1, rows=10000):
+    # Poll a search or detail job until every backend partition has answered, then page through its results. A job
+    # returns at most the rows it was started with, so the number found can be larger than the results returned.
+
+    # rtype: tuple (list of results, number found)
+    # Initialize contacted and completed to different values so the while loop kicks off at least once
+    contacted = 1
+    completed = -1
+    while contacted != completed:
+        response = session.get(results_url, params={"start": 0, "rows": 0}).json()
+        contacted = response['contacted']
+        completed = response['completed']
+        if contacted != completed:
+            time.sleep(poll_interval)
+
+    results = []
+    while True:
+        response = session.get(results_url, params={"start": len(results), "rows": rows}).json()
+        results.extend(response['results'])
+        if not response['results'] or len(results) >= response.get('num_available', response['num_found']):
+            break
+    return results, response['num_found']
+
+
+def search_alert_observations(session, environment, org_key, payload, alert_ids, times, margin, window):
+    # Run one search job for the observations of a batch of alerts. A job returns at most 10,000 observations, so a
+    # batch that found more than it returned is split in half and each half searched again, until single alerts are
+    # left; an alert that still found more is reported as cut off.
+
+    # rtype: list
+    query = 'alert_id:(' + ' OR '.join(alert_ids) + ')'
+    results, num_found = run_search_job(session, environment, org_key,
+                                        dict(payload, query=query,
+                                             time_range=time_range_for(alert_ids, times, margin, window)))
+    if num_found <= len(results):
+        return results
+    if len(alert_ids) == 1:
+        print(f"{alert_ids[0]}: only {len(results)} of {num_found} observations could be returned")
+        return results
+    print(f"{num_found} observations found for {len(alert_ids)} alerts but only {len(results)} returned, "
+          f"splitting the job in two")
+    middle = len(alert_ids) // 2
+    return search_alert_observations(session, environment, org_key, payload, alert_ids[:middle], times, margin,
+                                     window) + \
+        search_alert_observations(session, environment, org_key, payload, alert_ids[middle:], times, margin, window)
+
+
+def fetch_process_details(session, environment, org_key, process_guids, batch_size=100):
+    # Fetch the details of the processes, batch_size GUIDs per detail job
+
+    # rtype: dict of process_guid -> details
+    details = {}
+    for i in range(0, len(process_guids), batch_size):
+        payload = {
+            "process_guids": process_guids[i:i + batch_size],
+            "fields": DETAIL_FIELDS
+        }
+        response = session.post(build_process_detail_url(environment, org_key), json=payload)
+        if response.status_code != 200:
+            print(f"Process detail request failed: {response}")
+            continue
+        job_id = response.json()['job_id']
+        results, _ = wait_for_job(session, build_process_detail_url(environment, org_key) + f"/{job_id}/results")
+        for result in results:
+            details[result['process_guid']] = {k: result.get(k) for k in DETAIL_FIELDS}
+    return details
+
+
+def split_by_alert(observations, alert_ids):
+    # Hand each observation back to the alert(s) it belongs to. An observation can be part of several alerts.
+
+    # rtype: dict of alert_id -> list
+    per_alert = {alert_id: [] for alert_id in alert_ids}
+    for observation in observations:
+        observation_alerts = observation.get('alert_id') or []
+        if isinstance(observation_alerts, str):
+            observation_alerts = [observation_alerts]
+        for alert_id in observation_alerts:
+            if alert_id in per_alert:
+                per_alert[alert_id].append(observation)
+    return per_alert
+
 
 def main():
     # Main function to parse arguments and retrieve the endpoint results
@@ -70,17 +303,36 @@ def main():
                                help="API ID")
     requiredNamed.add_argument("-s", "--api_secret", required=True,
                                help="API Secret Key")
-    requiredNamed.add_argument("-a", "--alert-id", required=True,
-                               help="Alert ID to query")
+    parser.add_argument("-a", "--alert-id", nargs='+', help="Alert ID(s) to query")
+    parser.add_argument("-f", "--alert_file", help="File with one alert ID per line")
+    parser.add_argument("--max_query_length", type=int, default=4000,
+                        help="Longest alert_id query to put in one search job")
+    parser.add_argument("--max_alerts_per_job", type=int, default=100, help="Most alert IDs to put in one search job")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of search jobs to run concurrently")
+    parser.add_argument("--margin_minutes", type=int, default=60,
+                        help="Minutes to search either side of the alert's first and last event")
+    parser.add_argument("--window", default="-180d",
+                        help="Time window to search for alerts that can not be looked up")
+    parser.add_argument("--no_alert_lookup", action='store_true',
+                        help="Skip the alert lookup and search the whole --window")
+    parser.add_argument("--fields", help="Comma separated observation fields to return (default: all)")
+    parser.add_argument("--process_details", action='store_true',
+                        help="Add the details of each observation's process (command line, user, hashes, parent)")
+    parser.add_argument("--cache_file", default=DEFAULT_CACHE_FILE, help="Process detail cache shared between scripts")
+    parser.add_argument("--cache_ttl", type=int, default=3600,
+                        help="Seconds to keep the details of a process that was still running when fetched")
+    parser.add_argument("--no_cache", action='store_true', help="Do not read or write the process detail cache")
     args = parser.parse_args()
 
-    req_url = build_base_url(args.environment, args.org_key)
-    api_token = f"{args.api_secret}/{args.api_id}"
+    alert_ids = read_alert_ids(args.alert_id, args.alert_file)
+    if not alert_ids:
+        parser.error("give at least one alert ID with --alert-id or --alert_file")
+    session = setup_session(args.api_secret, args.api_id, args.org_key)
 
     payload = {
           "query": "",
           "time_range": {
-            "window": "-180d"
+            "window": args.window
           },
           "rows": 10000,
           "sort": [
@@ -91,37 +343,59 @@ def main():
           ]
         }
 
-    headers = {
-        "Content-Type": "application/json",
-        "X-Org": args.org_key,
-        "X-Auth-Token": api_token
-    }
-    payload["query"] = "alert_id:"f"{args.alert_id}"
-    response = requests.request('POST', req_url, headers=headers, json=payload)
-    if response.status_code == 200:
-        print(f"Success {response}")
-        response = response.json()
-        job_id = response['job_id']
-        # Now that we have a job_id, check the status of it.
-        req_url = build_observations_search_job_id_url(args.environment, args.org_key, job_id)
-
-        # Initialize contacted and completed to different values so the while loop kicks off at least once
-        contacted = 1
-        completed = -1
-        while contacted != completed:
-            response = requests.request("GET", req_url, headers=headers)
-            response = response.json()
-            contacted = response['contacted']
-            completed = response['completed']
-        observations_df = pd.DataFrame.from_dict(response['results'])
-        print("Done with Observation pull")
-        timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+    if args.fields:
+        fields = [field.strip() for field in args.fields.split(',') if field.strip()]
+        # alert_id is needed to split the results back out per alert, process_guid to add the process details
+        fields.append("alert_id")
+        if args.process_details:
+            fields.append("process_guid")
+        payload["fields"] = list(dict.fromkeys(fields))
+
+    # Narrow each search to the time span of its alerts. Sorting the alerts by time first means alerts that happened
+    # close together end up in the same job, and alerts that could not be looked up are kept apart from the rest.
+    times = {} if args.no_alert_lookup else lookup_alert_times(session, args.environment, args.org_key, alert_ids)
+    known = sorted((alert_id for alert_id in alert_ids if alert_id in times), key=lambda alert_id: times[alert_id][0])
+    unknown = [alert_id for alert_id in alert_ids if alert_id not in times]
+    margin = timedelta(minutes=args.margin_minutes)
+
+    # Many alerts share one search job, and the jobs run side by side
+    queries = build_alert_queries(known, args.max_query_length, args.max_alerts_per_job) + \
+        build_alert_queries(unknown, args.max_query_length, args.max_alerts_per_job)
+    print(f"Searching observations for {len(alert_ids)} alert(s) with {len(queries)} search job(s)")
+    observations = []
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = [executor.submit(search_alert_observations, session, args.environment, args.org_key, payload,
+                                   chunk, times, margin, args.window)
+                   for _, chunk in queries]
+        for future in as_completed(futures):
+            observations.extend(future.result())
+    print("Done with Observation pull")
+
+    if args.process_details:
+        cache = ProcessDetailCache(None if args.no_cache else args.cache_file, ttl=args.cache_ttl, fields=DETAIL_FIELDS)
+        guids = [observation['process_guid'] for observation in observations if observation.get('process_guid')]
+        details = cache.get_many(guids, lambda missing: fetch_process_details(session, args.environment,
+                                                                                args.org_key, missing))
+        cache.close()
+        print(f"Process detail cache: {cache.hits} hits, {cache.misses} fetched")
+        for observation in observations:
+            for field, value in (details.get(observation.get('process_guid')) or {}).items():
+                observation.setdefault(field, value)
+
+    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+    if len(alert_ids) == 1:
         with open('alerts-' + timestamp + '.json', "w") as f:
-            json.dump(response, f)
-        observations_df.to_csv('observations-' + timestamp + '.csv')
+            json.dump(observations, f)
+        pd.DataFrame.from_dict(observations).to_csv('observations-' + timestamp + '.csv')
+        print('Saved to \'observations-' + timestamp + '.csv\'')
+        return 0
+
+    # Split the combined results back out per alert
+    for alert_id, alert_observations in split_by_alert(observations, alert_ids).items():
+        filename = 'observations-' + alert_id + '-' + timestamp + '.csv'
+        pd.DataFrame.from_dict(alert_observations).to_csv(filename)
+        print(f"{alert_id}: {len(alert_observations)} observations saved to '{filename}'")
 
-    else:
-        print(response)
 
 if __name__ == "__main__":
-    sys.exit(main())
\ No newline at end of file
+    sys.exit(main())
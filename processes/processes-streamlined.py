@@ -2,6 +2,8 @@ import pandas as pd
 import requests
 import argparse
 import sys
+import os
+import json
 
 
 # This script exports the queried for processes into a csv via the process search API. To change the query, look at the "payload" variable which is the
@@ -13,18 +15,59 @@ import sys
 # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-fields/
 # can simply be added to in the initial request making the follow-up request unnecessary.
 
+# The output columns are chosen with --columns. A small planner splits them into the fields the process search can
+# return itself (SEARCH_FIELDS) and the ones only a process detail job returns. The search asks for exactly the
+# searchable columns instead of "*", and detail jobs are only started when a column really needs one, for many
+# process GUIDs per job (--detail_batch). With the default columns no detail job is needed at all.
+
+# --arrow decodes the results into Arrow columns instead of a DataFrame and writes the CSV straight from Arrow. The body
+# is parsed by Arrow's JSON reader, so a page of 10,000 rows never becomes 10,000 row dicts, and every column gets the
+# same Arrow type on every run (FIELD_TYPES). A page the reader can not parse column by column (a field that is a list
+# in one row and a single value in another) is decoded in Python instead, with orjson when it is installed. List
+# fields are written as comma separated values. Needs pyarrow (pip install pyarrow); orjson is optional.
+# The CSV --arrow writes is laid out differently from the default one (see --help): no index column, list fields comma
+# separated rather than as Python lists, true/false booleans, quoted strings, and all columns even with no results.
+
 # Usage: python process-streamlined.py --help
 
 # API key permissions required:
 # Search - Events - org.search.processes - CREATE
 # Search - Events - org.search.processes - READ
 
+# Fields the process search can return when asked for them by name, from the platform search fields reference above.
+# Columns not listed here are fetched with a process detail job.
+SEARCH_FIELDS = {
+    "alert_category", "alert_id", "backend_timestamp", "childproc_count", "crossproc_count", "device_group_id",
+    "device_id", "device_name", "device_os", "device_policy", "device_policy_id", "device_timestamp", "enriched",
+    "enriched_event_type", "event_type", "filemod_count", "ingress_time", "legacy", "modload_count", "netconn_count",
+    "org_id", "parent_guid", "parent_hash", "parent_name", "parent_pid", "process_cmdline", "process_company_name",
+    "process_effective_reputation", "process_elevated", "process_file_description", "process_guid", "process_hash",
+    "process_integrity_level", "process_name", "process_original_filename", "process_pid", "process_privileges",
+    "process_product_name", "process_product_version", "process_reputation", "process_sha256", "process_start_time",
+    "process_terminated", "process_username", "regmod_count", "scriptload_count", "watchlist_hit"
+}
+# Arrow type of each search field: "int", "bool" or "list" (of strings). Anything else is a string column.
+FIELD_TYPES = {
+    "childproc_count": "int", "crossproc_count": "int", "filemod_count": "int", "modload_count": "int",
+    "netconn_count": "int", "regmod_count": "int", "scriptload_count": "int", "device_id": "int",
+    "device_group_id": "int", "device_policy_id": "int", "org_id": "str", "parent_pid": "int", "process_pid": "list",
+    "enriched": "bool", "legacy": "bool", "process_elevated": "bool", "process_terminated": "bool",
+    "watchlist_hit": "list", "alert_category": "list", "alert_id": "list", "enriched_event_type": "list",
+    "event_type": "list", "parent_hash": "list", "process_hash": "list", "process_cmdline": "list",
+    "process_username": "list", "process_privileges": "list"
+}
+DEFAULT_COLUMNS = "process_guid,backend_timestamp,device_id,device_name,device_policy_id,process_name," \
+                  "process_username,process_cmdline"
+
 def get_environment(environment):
     # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
     # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -58,6 +101,15 @@ def build_search_url(environment, org_key):
 def build_search_job_id_url(environment, org_key, job_id):
     # Build the URL to return the results of the search based on job_id
     # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#retrieve-results-for-a-process-search-v2
+
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/search_jobs/{job_id}/results"
+
+def build_detail_job_id_url(environment, org_key, job_id):
+    # Build the URL to return the results of a process detail job based on job_id
+    # Documentation on this specific API call can be found here:
     # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#retrieve-results-for-a-process-detail-search-v2
 
     # rtype: string
@@ -65,10 +117,152 @@ def build_search_job_id_url(environment, org_key, job_id):
     return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/detail_jobs/{job_id}/results"
 
 
+def build_process_detail_url(environment, org_key):
+    # Build the URL to request the details of processes
+    # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#request-details-of-processes-v2
+
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/detail_jobs"
+
+
+def plan_fields(columns):
+    # Split the requested output columns into the fields to ask the process search for and the fields that need a
+    # process detail job. process_guid is always searched for, since the details are requested by it.
+
+    # rtype: (list, list)
+    search_fields = ["process_guid"]
+    detail_fields = []
+    for column in columns:
+        if column in SEARCH_FIELDS:
+            search_fields.append(column)
+        else:
+            detail_fields.append(column)
+    return list(dict.fromkeys(search_fields)), list(dict.fromkeys(detail_fields))
+
+
+def wait_for_results(req_url, headers, rows):
+    # Poll a search or detail job until contacted = completed and return its results
+
+    # rtype: dict
+    # Initialize contacted and completed to different values so the while loop kicks off at least once
+    contacted = 1
+    completed = -1
+    while contacted != completed:
+        response = requests.request("GET", req_url, headers=headers, params={"start": 0, "rows": rows})
+        response = response.json()
+        contacted = response['contacted']
+        completed = response['completed']
+    return response
+
+
+def fetch_process_details(environment, org_key, headers, process_guids, detail_fields, batch_size):
+    # Fetch detail_fields for the processes, batch_size process GUIDs per detail job
+
+    # rtype: dict of process_guid -> details
+    details = {}
+    for i in range(0, len(process_guids), batch_size):
+        payload = {
+          "process_guids": process_guids[i:i + batch_size],
+          "fields": ["process_guid"] + detail_fields
+        }
+        response = requests.request("POST", build_process_detail_url(environment, org_key), headers=headers,
+                                    json=payload)
+        if response.status_code != 200:
+            print(f"Process detail request failed: {response}")
+            continue
+        print(f"Process detail success {response}")
+        job_id = response.json()['job_id']
+        response = wait_for_results(build_detail_job_id_url(environment, org_key, job_id), headers, batch_size)
+        for result in response['results']:
+            details[result['process_guid']] = result
+    return details
+
+
+def arrow_type(kind):
+    # The Arrow type of a FIELD_TYPES kind
+
+    # rtype: pyarrow.DataType
+    import pyarrow as pa
+    if kind == "int":
+        return pa.int64()
+    if kind == "bool":
+        return pa.bool_()
+    if kind == "list":
+        return pa.list_(pa.string())
+    return pa.string()
+
+
+def to_arrow_array(values, kind):
+    # Convert one column of decoded JSON values to an Arrow array of a fixed type, so a column has the same type no
+    # matter which values happen to be on the page
+
+    # rtype: pyarrow.Array
+    import pyarrow as pa
+    if kind == "list":
+        values = [None if value is None else
+                  [str(item) for item in (value if isinstance(value, list) else [value])] for value in values]
+    elif kind not in ("int", "bool"):
+        values = [value if value is None or isinstance(value, str) else json.dumps(value) for value in values]
+    return pa.array(values, type=arrow_type(kind))
+
+
+def decode_results_arrow(content, columns):
+    # Decode a search results body into an Arrow table with one column per requested field. Arrow's JSON reader parses
+    # the body straight into columns, without a Python object per row or cell, and each column is then cast to its
+    # FIELD_TYPES type. A body the reader can not take that way (say a field that is a list in one row and a single
+    # value in the next) is decoded in Python instead.
+
+    # rtype: pyarrow.Table
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.json
+    # Scalar columns get their type up front, so a string that looks like a date stays a string. List items can be
+    # numbers or strings, so list columns are left to the reader and cast afterwards.
+    scalars = [(column, arrow_type(FIELD_TYPES.get(column))) for column in columns
+               if FIELD_TYPES.get(column) != "list"]
+    schema = pa.schema([("results", pa.list_(pa.struct(scalars)))])
+    try:
+        body = pyarrow.json.read_json(pa.BufferReader(content),
+                                      read_options=pyarrow.json.ReadOptions(block_size=len(content) + 1),
+                                      parse_options=pyarrow.json.ParseOptions(explicit_schema=schema))
+        rows = body.column('results').combine_chunks().flatten()
+        names = [field.name for field in rows.type]
+        arrays = [pc.cast(rows.field(column), arrow_type(FIELD_TYPES.get(column))) if column in names
+                  else pa.nulls(len(rows), type=arrow_type(FIELD_TYPES.get(column))) for column in columns]
+        return pa.table(arrays, names=list(columns))
+    except (pa.ArrowInvalid, pa.ArrowTypeError, pa.ArrowNotImplementedError) as e:
+        print(f"Decoding the results in Python: {e}")
+
+    try:
+        import orjson
+        body = orjson.loads(content)
+    except ImportError:
+        body = json.loads(content)
+    results = body['results']
+    arrays = [to_arrow_array([result.get(column) for result in results], FIELD_TYPES.get(column))
+              for column in columns]
+    return pa.table(arrays, names=list(columns))
+
+
+def write_arrow_csv(table, filename):
+    # Write an Arrow table to CSV, joining list columns into comma separated strings
+
+    # rtype: None
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv
+    for i, field in enumerate(table.schema):
+        if pa.types.is_list(field.type):
+            table = table.set_column(i, field.name, pc.binary_join(table.column(i), ","))
+    pyarrow.csv.write_csv(table, filename)
+
+
 def main():
     # Main function to parse arguments and retrieve the endpoint results
 
-    parser = argparse.ArgumentParser(prog="export-endpoints.py",
+    parser = argparse.ArgumentParser(prog="processes-streamlined.py",
                                      description="Query VMware Carbon Black Cloud for process data.")
     requiredNamed = parser.add_argument_group('required arguments')
     requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
@@ -80,8 +274,20 @@ def main():
                                help="API ID")
     requiredNamed.add_argument("-s", "--api_secret", required=True,
                                help="API Secret Key")
+    parser.add_argument("-c", "--columns", default=DEFAULT_COLUMNS, help="Comma separated columns to export")
+    parser.add_argument("--detail_batch", type=int, default=100, help="Most process GUIDs to put in one detail job")
+    parser.add_argument("--arrow", action='store_true',
+                        help="Decode the results into Arrow columns and write the CSV from Arrow (needs pyarrow). The "
+                             "file differs from the default one: it has no index column, list fields are comma "
+                             "separated instead of Python lists, booleans are true/false, strings are quoted, and "
+                             "every requested column is written even when there are no results")
     args = parser.parse_args()
 
+    columns = [column.strip() for column in args.columns.split(',') if column.strip()]
+    search_fields, detail_fields = plan_fields(columns)
+    if detail_fields:
+        print("Columns that need process detail jobs: " + ", ".join(detail_fields))
+
     req_url = build_search_url(args.environment, args.org_key)
     api_token = f"{args.api_secret}/{args.api_id}"
 
@@ -93,9 +299,7 @@ def main():
         "window": "-1h"
       },
       "rows": 10000,
-      "fields": [
-        "*","process_cmdline"
-      ],
+      "fields": search_fields,
       "sort": [
         {
           "field": "device_timestamp",
@@ -119,16 +323,40 @@ def main():
         # Now that we have a job_id, check the status of it.
         req_url = build_search_job_id_url(args.environment, args.org_key, job_id)
 
-        # Initialize contacted and completed to different values so the while loop kicks off at least once
-        contacted = 1
-        completed = -1
-        while contacted != completed:
-            response = requests.request("GET", req_url, headers=headers)
-            response = response.json()
-            contacted = response['contacted']
-            completed = response['completed']
+        if args.arrow:
+            # Wait for the job without fetching rows, then decode the whole page straight into Arrow columns
+            wait_for_results(req_url, headers, 0)
+            response = requests.request("GET", req_url, headers=headers, params={"start": 0, "rows": payload['rows']})
+            table = decode_results_arrow(response.content, search_fields)
+            if detail_fields:
+                # With no results the detail columns are still added, empty, so the file always has every column
+                process_guids = table.column('process_guid').to_pylist()
+                details = {}
+                if process_guids:
+                    details = fetch_process_details(args.environment, args.org_key, headers,
+                                                    list(dict.fromkeys(process_guids)), detail_fields,
+                                                    args.detail_batch)
+                for field in detail_fields:
+                    table = table.append_column(field, to_arrow_array(
+                        [(details.get(process_guid) or {}).get(field) for process_guid in process_guids],
+                        FIELD_TYPES.get(field)))
+            table = table.select([column for column in columns if column in table.column_names])
+            write_arrow_csv(table, 'processes.csv')
+            print('Saved to \'processes.csv\'')
+            return 0
+
+        response = wait_for_results(req_url, headers, payload['rows'])
         events = pd.DataFrame.from_dict(response['results'])
 
+        # Only start detail jobs when a requested column cannot come from the search itself
+        if detail_fields and not events.empty:
+            details = fetch_process_details(args.environment, args.org_key, headers,
+                                            list(dict.fromkeys(events['process_guid'])), detail_fields,
+                                            args.detail_batch)
+            for field in detail_fields:
+                events[field] = [(details.get(process_guid) or {}).get(field) for process_guid in events['process_guid']]
+        events = events[[column for column in columns if column in events]]
+
         # Cool. Let's export to CSV now
         events.to_csv('processes.csv')
         print('Saved to \'processes.csv\'')
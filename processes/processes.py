@@ -2,10 +2,20 @@ import pandas as pd
 import requests
 import argparse
 import sys
+import os
+import json
+import time
+import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
+# The process detail cache lives in tools/process_cache.py, shared with the other process scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "tools"))
+from process_cache import ProcessDetailCache  # noqa: E402
 
-# This script exports the queried for processes into a csv via the process search API. To change the query, look at the "payload" variable which is the
-# json-formatted request made to the CB Cloud back end. The developer documentation has a full list of what can be queried.
+
+# This script exports the queried for processes into a csv via the process search API. The query, time range, fields and
+# number of rows are set with --query, --window (or --start and --end), --fields and --rows. The developer documentation
+# has a full list of what can be queried.
 # The CB Cloud API will return up to 10,000 items in a single request. If you have more than 10,000 alerts, you would need
 # multiple requests to fetch them all.
 
@@ -16,18 +26,45 @@ import sys
 # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-fields/
 # can simply be added to in the initial request making the follow-up request unnecessary.
 
+# Process details are cached by process_guid in a SQLite file (~/.cbcloud/process-cache.sqlite by default) shared with
+# events.py, observations-alert-id.py and enrich-alerts.py. Long-lived processes show up in many searches, and the
+# details of a process that has exited never change, so repeat runs only request details for processes not seen
+# before (or still running and last fetched more than --cache_ttl seconds ago).
+
+# To run many saved hunts at once, put them in a JSON file and pass it with --query_file. The file holds a list of hunts,
+# each with a name and a query and optionally its own window (or start and end), fields and rows; anything left out
+# comes from the command line, except that a hunt with a window, start or end of its own takes no time range from
+# it. The hunts run concurrently (--workers) and each one is saved to its own CSV file, e.g.
+# [
+#     {"name": "powershell", "query": "process_name:powershell.exe"},
+#     {"name": "encoded-commands", "query": "process_cmdline:-enc*", "window": "-1d"}
+# ]
+
 # Usage: python processes.py --help
 
 # API key permissions required:
 # Search - Events - org.search.processes - CREATE
 # Search - Events - org.search.processes - READ
 
+DEFAULT_CACHE_FILE = os.path.join(os.path.expanduser("~"), ".cbcloud", "process-cache.sqlite")
+# The hunt keys that make up its time range, taken from the command line all together or not at all
+TIME_RANGE_KEYS = ("window", "start", "end")
+# Job status polls wait POLL_INTERVAL seconds after the first one that finds the job still running, twice as long after
+# each one after that, up to MAX_POLL_INTERVAL, so many lookup workers polling at once do not flood the API
+POLL_INTERVAL = 0.25
+MAX_POLL_INTERVAL = 2
+DEFAULT_COLUMNS = ['process_guid', 'backend_timestamp', 'device_id', 'device_name', 'device_policy_id', 'process_name',
+                   'process_username']
+
 def get_environment(environment):
     # Function to get the required environment to build a Base URL. More info about building a Base URL can be found at
     # https://developer.carbonblack.com/reference/carbon-black-cloud/authentication/#building-your-base-urls
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -61,6 +98,15 @@ def build_search_url(environment, org_key):
 def build_search_job_id_url(environment, org_key, job_id):
     # Build the URL to return the results of the search based on job_id
     # Documentation on this specific API call can be found here:
+    # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#retrieve-results-for-a-process-search-v2
+
+    # rtype: string
+    environment = get_environment(environment)
+    return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/search_jobs/{job_id}/results"
+
+def build_detail_job_id_url(environment, org_key, job_id):
+    # Build the URL to return the results of a process detail job based on job_id
+    # Documentation on this specific API call can be found here:
     # https://developer.carbonblack.com/reference/carbon-black-cloud/platform/latest/platform-search-api-processes/#retrieve-results-for-a-process-detail-search-v2
 
     # rtype: string
@@ -77,10 +123,164 @@ def build_process_detail_url(environment, org_key):
     return f"{environment}/api/investigate/v2/orgs/{org_key}/processes/detail_jobs"
 
 
+def fetch_process_detail(environment, org_key, headers, process_guid):
+    # Request the details of one process and wait for the detail job to finish
+
+    # rtype: dict or None
+    req_url = build_process_detail_url(environment, org_key)
+    payload = {
+      "process_guids": [
+        process_guid
+      ],
+      "limited": True
+    }
+    response = requests.request("POST", req_url, headers=headers, json=payload)
+    if response.status_code != 200:
+        print(response)
+        return None
+    print(f"Process detail success {response}")
+    response = response.json()
+    job_id = response['job_id']
+
+    # Now that we have the job_id, check the status of it:
+    req_url = build_detail_job_id_url(environment, org_key, job_id)
+
+    wait = POLL_INTERVAL
+    # Initialize contacted and completed to different values so the while loop kicks off at least once
+    contacted = 1
+    completed = -1
+    while completed != contacted:
+        response = requests.request("GET", req_url, headers=headers)
+        response = response.json()
+        contacted = response['contacted']
+        completed = response['completed']
+        if contacted != completed:
+            time.sleep(wait)
+            wait = min(wait * 2, MAX_POLL_INTERVAL)
+    if not response['results']:
+        return None
+    return response['results'][0]
+
+
+def build_time_range(window, start=None, end=None):
+    # Build the time_range of a search: an absolute start and end when both are given, otherwise a relative window
+
+    # rtype: dict
+    if start and end:
+        return {"start": start, "end": end}
+    return {"window": window}
+
+
+def read_hunts(query_file, defaults):
+    # Read the saved hunts from a JSON file, filling in anything a hunt leaves out from the command line defaults. The
+    # command line time range only applies to hunts that set no window, start or end of their own.
+
+    # rtype: list of dict or None
+    with open(query_file, 'r') as f:
+        hunts = json.load(f)
+    for i, hunt in enumerate(hunts):
+        own_time_range = any(hunt.get(key) for key in TIME_RANGE_KEYS)
+        for key, value in defaults.items():
+            if own_time_range and key in TIME_RANGE_KEYS:
+                continue
+            hunt.setdefault(key, value)
+        hunt.setdefault('name', f"hunt{i + 1}")
+        if bool(hunt.get('start')) != bool(hunt.get('end')):
+            print(f"Hunt '{hunt['name']}' needs both a start and an end")
+            return None
+    return hunts
+
+
+def search_processes(environment, org_key, headers, hunt):
+    # Run the process search for a hunt and wait for the job to finish
+
+    # rtype: list or None
+    req_url = build_search_url(environment, org_key)
+    fields = hunt['fields']
+    if fields != ["*"]:
+        # process_guid is needed to look up the process details
+        fields = list(dict.fromkeys(['process_guid'] + fields))
+    payload = {
+      "criteria": {},
+      "exclusions": {},
+      "query": hunt['query'],
+      "time_range": build_time_range(hunt.get('window'), hunt.get('start'), hunt.get('end')),
+      "rows": hunt['rows'],
+      "fields": fields,
+      "sort": [
+        {
+          "field": "device_timestamp",
+          "order": "DESC"
+        }
+      ]
+    }
+    response = requests.request("POST", req_url, headers=headers, json=payload)
+    if response.status_code != 200:
+        print(f"{hunt['name']}: {response}")
+        return None
+    print(f"Process search success {response}")
+    response = response.json()
+    job_id = response['job_id']
+
+    # Now that we have a job_id, check the status of it.
+    req_url = build_search_job_id_url(environment, org_key, job_id)
+
+    wait = POLL_INTERVAL
+    # Initialize contacted and completed to different values so the while loop kicks off at least once
+    contacted = 1
+    completed = -1
+    while contacted != completed:
+        response = requests.request("GET", req_url, headers=headers, params={"start": 0, "rows": hunt['rows']})
+        response = response.json()
+        contacted = response['contacted']
+        completed = response['completed']
+        if contacted != completed:
+            time.sleep(wait)
+            wait = min(wait * 2, MAX_POLL_INTERVAL)
+    return response['results']
+
+
+def run_hunt(environment, org_key, headers, hunt, cache, lookup_workers):
+    # Run one hunt: search for the processes, then add the command line of each one from its process details
+
+    # rtype: DataFrame or None
+    results = search_processes(environment, org_key, headers, hunt)
+    if results is None:
+        return None
+    events = pd.DataFrame.from_dict(results)
+    if events.empty:
+        return events
+
+    # Trim down the dataframe to just the fields we need
+    if hunt['fields'] == ["*"]:
+        columns = DEFAULT_COLUMNS
+    else:
+        columns = ['process_guid'] + hunt['fields']
+    events = events[[column for column in dict.fromkeys(columns) if column in events]]
+
+    # Request details for each process_guid not already in the cache. For each process_guid we request a job_id.
+    # Then check status of the job_id. If completed = contacted, return the info. The detail jobs run --lookup_workers
+    # at a time.
+    def fetch(process_guids):
+        fetched = {}
+        with ThreadPoolExecutor(max_workers=lookup_workers) as executor:
+            details = executor.map(lambda process_guid: fetch_process_detail(environment, org_key, headers,
+                                                                             process_guid), process_guids)
+            for process_guid, detail in zip(process_guids, details):
+                if detail is not None:
+                    fetched[process_guid] = detail
+        return fetched
+
+    details = cache.get_many(list(events['process_guid']), fetch)
+    events['process_cmdline'] = [str((details.get(process_guid) or {}).get('process_cmdline', ''))
+                                 for process_guid in events['process_guid']]
+    return events
+
+
 def main():
     # Main function to parse arguments and retrieve the endpoint results
 
-    parser = argparse.ArgumentParser(prog="export-endpoints.py",
+    parser = argparse.ArgumentParser(prog="processes.py",
                                      description="Query VMware Carbon Black Cloud for process data.")
     requiredNamed = parser.add_argument_group('required arguments')
     requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
@@ -92,97 +292,75 @@ def main():
                                help="API ID")
     requiredNamed.add_argument("-s", "--api_secret", required=True,
                                help="API Secret Key")
+    parser.add_argument("-q", "--query", default="process_name:powershell.exe", help="Process search query")
+    parser.add_argument("--window", default="-1h", help="Relative time window to search, e.g. --window=-3d")
+    parser.add_argument("--start", help="Start of an absolute time range, e.g. 2024-01-01T00:00:00.000Z (needs --end)")
+    parser.add_argument("--end", help="End of an absolute time range (needs --start)")
+    parser.add_argument("--fields", default="*", help="Comma separated fields to return (default: all)")
+    parser.add_argument("--rows", type=int, default=10000, help="Number of processes to return")
+    parser.add_argument("--query_file", help="JSON file of saved hunts to run concurrently, one CSV per hunt")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="Number of hunts to run concurrently")
+    parser.add_argument("--lookup_workers", type=int, default=8,
+                        help="Number of process detail requests to run concurrently for each hunt")
+    parser.add_argument("--cache_file", default=DEFAULT_CACHE_FILE, help="Process detail cache shared between scripts")
+    parser.add_argument("--cache_ttl", type=int, default=3600,
+                        help="Seconds to keep the details of a process that was still running when fetched")
+    parser.add_argument("--no_cache", action='store_true', help="Do not read or write the process detail cache")
     args = parser.parse_args()
 
-    req_url = build_search_url(args.environment, args.org_key)
-    api_token = f"{args.api_secret}/{args.api_id}"
-
-    payload = {
-      "criteria": {},
-      "exclusions": {},
-      "query": "process_name:powershell.exe",
-      "time_range": {
-        "window": "-1h"
-      },
-      "rows": 10000,
-      "fields": [
-        "*"
-      ],
-      "sort": [
-        {
-          "field": "device_timestamp",
-          "order": "DESC"
-        }
-      ]
-    }
+    if bool(args.start) != bool(args.end):
+        parser.error("--start and --end must be given together")
 
+    api_token = f"{args.api_secret}/{args.api_id}"
     headers = {
         "Content-Type": "application/json",
         "X-Auth-Token": api_token
     }
 
-    response = requests.request("POST", req_url, headers=headers, json=payload)
-
-    if response.status_code == 200:
-        print(f"Process search success {response}")
-        response = response.json()
-        job_id = response['job_id']
-
-        # Now that we have a job_id, check the status of it.
-        req_url = build_search_job_id_url(args.environment, args.org_key, job_id)
-
-        # Initialize contacted and completed to different values so the while loop kicks off at least once
-        contacted = 1
-        completed = -1
-        while contacted != completed:
-            response = requests.request("GET", req_url, headers=headers)
-            response = response.json()
-            contacted = response['contacted']
-            completed = response['completed']
-        events = pd.DataFrame.from_dict(response['results'])
-
-        # Trim down the dataframe to just the fields we need
-        events = events[['process_guid', 'backend_timestamp', 'device_id', 'device_name', 'device_policy_id', 'process_name', 'process_username']]
-        # Add a process_cmdline column
-        events['process_cmdline'] = ''
-
-        # Iterate through the processes dataframe and do API call for each process_guid. For each process_guid we request a job_id.
-        # Then check status of the job_id. If completed = contacted, return the info.
-        for i, row in events.iterrows():
-            req_url = build_process_detail_url(args.environment, args.org_key)
-            process_guid = row.process_guid
-            payload = {
-              "process_guids": [
-                row.process_guid
-              ],
-              "limited": True
-            }
-            response = requests.request("POST", req_url, headers=headers, json=payload)
-            if response.status_code == 200:
-                print(f"Process detail success {response}")
-                response = response.json()
-                job_id = response['job_id']
-
-                # Now that we have the job_id, check the status of it:
-                req_url = build_search_job_id_url(args.environment, args.org_key, job_id)
-
-                # Reset contacted and completed to different values so the while loop kicks off at least once
-                contacted = 1
-                completed = -1
-                while completed != contacted:
-                    response = requests.request("GET", req_url, headers=headers)
-                    response = response.json()
-                    contacted = response['contacted']
-                    completed = response['completed']
-                details = pd.DataFrame.from_dict(response['results'])
-                events.at[i, 'process_cmdline'] = str(details.iloc[0]['process_cmdline'])
-                print("Event details successful - round " + str(i) )
+    defaults = {
+        "query": args.query,
+        "window": args.window,
+        "start": args.start,
+        "end": args.end,
+        "fields": [field.strip() for field in args.fields.split(',') if field.strip()],
+        "rows": args.rows
+    }
+    cache = ProcessDetailCache(None if args.no_cache else args.cache_file, ttl=args.cache_ttl)
+
+    if not args.query_file:
+        events = run_hunt(args.environment, args.org_key, headers, dict(defaults, name="processes"), cache,
+                          args.lookup_workers)
+        cache.close()
+        if events is None:
+            return 1
+        print(f"Process detail cache: {cache.hits} hits, {cache.misses} fetched")
         print('Job complete')
         # Cool. Let's export to CSV now
         events.to_csv('processes.csv')
         print('Saved to \'processes.csv\'')
-    else:
-        print(response)
+        return 0
+
+    hunts = read_hunts(args.query_file, defaults)
+    if hunts is None:
+        return 1
+    print(f"Running {len(hunts)} hunts")
+    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+    failures = 0
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        futures = {executor.submit(run_hunt, args.environment, args.org_key, headers, hunt, cache,
+                                   args.lookup_workers): hunt for hunt in hunts}
+        for future in as_completed(futures):
+            hunt = futures[future]
+            events = future.result()
+            if events is None:
+                failures += 1
+                continue
+            filename = 'processes-' + re.sub(r'[^\w.-]+', '_', hunt['name']) + '-' + timestamp + '.csv'
+            events.to_csv(filename)
+            print(f"{hunt['name']}: {len(events)} processes saved to '{filename}'")
+    cache.close()
+    print(f"Process detail cache: {cache.hits} hits, {cache.misses} fetched")
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
@@ -0,0 +1,234 @@
+import argparse
+import sys
+import os
+import json
+import csv
+import glob
+import re
+import time
+import shutil
+import signal
+import tempfile
+import threading
+import subprocess
+import requests
+
+
+# This script benchmarks the export scripts end to end against the local mock API (tools/mock-cbcloud.py). For each
+# dataset size it starts a mock server with that many records, then runs every workflow in a scratch directory and
+# records:
+#   wall_seconds       - time from starting the script to its exit
+#   requests           - requests the mock answered for the run
+#   peak_rss_mb        - peak resident memory of the script's process
+#   records            - rows in the script's output file
+#   records_per_second - records / wall_seconds
+# The results are written to a JSON file (benchmark-<timestamp>.json). Pass an earlier results file with --baseline to
+# compare against it: every workflow and size that got more than --threshold percent slower, or used that much more
+# memory, is reported as a regression and the exit code is 1.
+
+# Usage: python benchmark.py --help
+
+TOOLS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(TOOLS_DIR)
+CREDENTIALS = ["-e", "PROD05", "-o", "MOCKORG", "-i", "benchmark", "-s", "benchmark"]
+
+# Each workflow runs one script with arguments that make it export the whole dataset. The output glob names the file
+# whose rows are counted.
+WORKFLOWS = {
+    "processes": {
+        "script": "processes/processes.py",
+        "args": ["--query", "process_name:*", "--window=-60d", "--rows", "{records}", "--no_cache"],
+        "output": "processes.csv"
+    },
+    "events": {
+        "script": "events/events.py",
+        "args": ["--query", "process_name:*", "--window=-60d", "--rows", "{records}", "--no_cache"],
+        "output": "events-*.csv"
+    },
+    "export-alerts-v7": {
+        "script": "alerts/export-alerts-v7.py",
+        "args": ["-d", "30"],
+        "output": "alerts-v7-*.csv"
+    },
+    "usb-devices": {
+        "script": "usb-devices/usb-devices.py",
+        "args": ["--single"],
+        "output": "usb-devices.xlsx"
+    }
+}
+
+
+def start_mock(records, mock_args):
+    # Start a mock server with the given number of records on a free port and wait until it is listening
+
+    # rtype: (subprocess.Popen, string)
+    command = [sys.executable, os.path.join(TOOLS_DIR, "mock-cbcloud.py"), "--port", "0", "--records", str(records)]
+    process = subprocess.Popen(command + mock_args, stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()
+    match = re.search(r'(http://\S+)', line)
+    if not match:
+        process.kill()
+        raise RuntimeError(f"Mock server did not start: {line}")
+    base_url = match.group(1)
+    requests.post(base_url + "/mock/warm")
+    return process, base_url
+
+
+def stop_mock(process):
+    process.send_signal(signal.SIGINT)
+    try:
+        process.wait(timeout=10)
+    except subprocess.TimeoutExpired:
+        process.kill()
+
+
+def count_records(pattern):
+    # Count the rows of the newest output file matching the pattern
+
+    # rtype: int or None
+    files = sorted(glob.glob(pattern), key=os.path.getmtime)
+    if not files:
+        return None
+    filename = files[-1]
+    if filename.endswith('.csv'):
+        with open(filename, 'r', newline='', encoding='utf-8') as f:
+            return max(sum(1 for _ in csv.reader(f)) - 1, 0)
+    if filename.endswith('.json'):
+        with open(filename, 'r') as f:
+            return len(json.load(f))
+    if filename.endswith('.xlsx'):
+        import openpyxl
+        workbook = openpyxl.load_workbook(filename, read_only=True)
+        return max(workbook.worksheets[0].max_row - 1, 0)
+    return None
+
+
+def run_workflow(name, workflow, records, base_url, timeout):
+    # Run one workflow in a scratch directory and measure it
+
+    # rtype: dict
+    requests.post(base_url + "/mock/stats")
+    command = [sys.executable, os.path.join(REPO_DIR, workflow['script'])] + CREDENTIALS + \
+        [arg.format(records=records) for arg in workflow['args']]
+    workdir = tempfile.mkdtemp(prefix="cbc-benchmark-")
+    env = dict(os.environ, CBC_BASE_URL=base_url)
+    timed_out = threading.Event()
+    start = time.perf_counter()
+    with open(os.path.join(workdir, "output.log"), "w") as log:
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+        def kill():
+            timed_out.set()
+            process.kill()
+        timer = threading.Timer(timeout, kill)
+        timer.start()
+        # wait4 reports the resource usage of this one child, including its peak RSS (in kilobytes on Linux)
+        _, status, usage = os.wait4(process.pid, 0)
+        timer.cancel()
+        process.returncode = os.waitstatus_to_exitcode(status)
+    wall = time.perf_counter() - start
+
+    stats = requests.get(base_url + "/mock/stats").json()
+    output = count_records(os.path.join(workdir, workflow['output']))
+    result = {
+        "workflow": name,
+        "dataset_records": records,
+        "wall_seconds": round(wall, 3),
+        "requests": sum(count for route, count in stats.items() if not route.startswith("mock_")),
+        "rate_limited": stats.get("rate_limited", 0),
+        "peak_rss_mb": round(usage.ru_maxrss / 1024, 1),
+        "records": output,
+        "records_per_second": round(output / wall, 1) if output else None,
+        "exit_code": process.returncode,
+        "timed_out": timed_out.is_set()
+    }
+    if process.returncode != 0 or timed_out.is_set():
+        result["log"] = os.path.join(workdir, "output.log")
+        print(f"{name} @ {records}: failed, see {result['log']}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return result
+
+
+def compare(results, baseline, threshold):
+    # Compare the results with a baseline run and return the regressions
+
+    # rtype: list of string
+    previous = {(r['workflow'], r['dataset_records']): r for r in baseline}
+    regressions = []
+    print(f"\n{'workflow':<18}{'records':>9}{'wall s':>10}{'base s':>10}{'change':>9}{'rss MB':>9}{'base MB':>9}")
+    for result in results:
+        base = previous.get((result['workflow'], result['dataset_records']))
+        if base is None or not base.get('wall_seconds'):
+            continue
+        change = (result['wall_seconds'] - base['wall_seconds']) / base['wall_seconds'] * 100
+        print(f"{result['workflow']:<18}{result['dataset_records']:>9}{result['wall_seconds']:>10.2f}"
+              f"{base['wall_seconds']:>10.2f}{change:>+8.1f}%{result['peak_rss_mb']:>9.1f}{base['peak_rss_mb']:>9.1f}")
+        if change > threshold:
+            regressions.append(f"{result['workflow']} @ {result['dataset_records']}: {change:+.1f}% wall time")
+        if base.get('peak_rss_mb') and result['peak_rss_mb'] > base['peak_rss_mb'] * (1 + threshold / 100):
+            regressions.append(f"{result['workflow']} @ {result['dataset_records']}: peak RSS "
+                               f"{base['peak_rss_mb']} -> {result['peak_rss_mb']} MB")
+    return regressions
+
+
+def main():
+    # Main function to parse arguments and run the benchmarks
+
+    parser = argparse.ArgumentParser(prog="benchmark.py",
+                                     description="Benchmark the export scripts against the local mock API.")
+    parser.add_argument("-w", "--workflows", default=",".join(WORKFLOWS),
+                        help="Comma separated workflows to run (default: all of " + ", ".join(WORKFLOWS) + ")")
+    parser.add_argument("--sizes", default="1000,10000,100000", help="Comma separated dataset sizes")
+    parser.add_argument("--repeat", type=int, default=1, help="Runs per workflow and size; the fastest is kept")
+    parser.add_argument("--timeout", type=int, default=1800, help="Seconds before a run is stopped")
+    parser.add_argument("--mock_args", default="--job_seconds 0 --segments 1",
+                        help="Extra arguments for mock-cbcloud.py, e.g. \"--latency_ms 20 --rate_limit 50\"")
+    parser.add_argument("-f", "--output", help="Results file (default: benchmark-<timestamp>.json)")
+    parser.add_argument("-b", "--baseline", help="Earlier results file to compare against")
+    parser.add_argument("--threshold", type=float, default=10,
+                        help="Percent slower (or more memory) than the baseline that counts as a regression")
+    args = parser.parse_args()
+
+    names = [name.strip() for name in args.workflows.split(',') if name.strip()]
+    unknown = [name for name in names if name not in WORKFLOWS]
+    if unknown:
+        parser.error("unknown workflow(s): " + ", ".join(unknown))
+    sizes = [int(size) for size in args.sizes.split(',') if size.strip()]
+
+    results = []
+    for size in sizes:
+        mock, base_url = start_mock(size, args.mock_args.split())
+        try:
+            for name in names:
+                runs = [run_workflow(name, WORKFLOWS[name], size, base_url, args.timeout)
+                        for _ in range(args.repeat)]
+                best = min(runs, key=lambda run: (run['exit_code'] != 0, run['wall_seconds']))
+                results.append(best)
+                print(f"{name} @ {size}: {best['wall_seconds']}s, {best['requests']} requests, "
+                      f"{best['peak_rss_mb']} MB, {best['records']} records, {best['records_per_second']} records/s")
+        finally:
+            stop_mock(mock)
+
+    timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+    output = args.output or 'benchmark-' + timestamp + '.json'
+    with open(output, "w") as f:
+        json.dump({"created": timestamp, "python": sys.version.split()[0], "mock_args": args.mock_args,
+                   "results": results}, f, indent=4)
+    print(f"Saved to '{output}'")
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print("\nRegressions:")
+            for regression in regressions:
+                print("  " + regression)
+            return 1
+        print("\nNo regressions")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
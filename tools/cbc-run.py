@@ -0,0 +1,852 @@
+import argparse
+import sys
+import os
+import re
+import json
+import time
+import copy
+import gzip
+import hashlib
+import datetime
+import runpy
+import threading
+import cProfile
+import pstats
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+import requests
+
+
+# This script runs any of the scripts in this repository with instrumentation around the calls every script makes:
+# the HTTP requests (everything the requests library sends, whether through requests.request, requests.get or a
+# session), JSON decoding of the responses, building DataFrames and writing output files. The script itself is not
+# changed; it is run exactly as it would be from the command line, with its own arguments after "--":
+#   python tools/cbc-run.py --metrics -- processes/processes.py -e PROD05 -o ORGKEY -i APIID -s APISECRET
+
+# --metrics prints a summary table when the script exits: requests, errors, latency percentiles and bytes per endpoint,
+# how many times each search/detail job or Live Response command was polled, and the time spent decoding JSON, building
+# DataFrames and writing files. For long runs the same numbers are available in the OpenMetrics text format, written to
+# --metrics_file every --metrics_interval seconds and/or served on http://127.0.0.1:<--metrics_port>/metrics.
+# Endpoints are reported as URL templates (IDs, GUIDs and org keys replaced by placeholders) so they aggregate.
+
+# --profile runs the script under cProfile and tracemalloc and writes two reports to --profile_dir (by default the
+# current directory, where the scripts write their output files):
+#   profile-<script>-<timestamp>.txt     - functions sorted by cumulative and by own time. Worker threads are profiled
+#                                          too and merged into the same report. The raw .prof file is kept alongside
+#                                          for tools such as snakeviz
+#   allocations-<script>-<timestamp>.txt - peak traced memory and the source lines holding the most memory at exit,
+#                                          and the lines that allocated the most between start and exit
+
+# --adaptive limits how many requests the script has in flight at once, however many worker threads it runs (so give the
+# script more workers than it needs, e.g. --lookup_workers 32, and let the limit find the right number). The limit
+# starts at --concurrency and is tuned AIMD style: every response with normal latency raises it by 1/limit (about one
+# more request per round trip), up to --max_concurrency. A 429 or 503 halves it, and latency rising above
+# --latency_tolerance times the fastest seen for that endpoint cuts it by a quarter. Throttled requests are retried
+# after their Retry-After (or an exponential backoff) up to --max_retries times. The current limit is part of the
+# metrics.
+
+# --coalesce shares one upstream call between identical requests made at the same moment (single flight): a GET, a
+# process detail job submission or a per-process event search with the same URL, parameters, body and API key as a
+# request already in flight waits for that request and gets a copy of its response instead of being sent again. Only
+# the request that was sent counts towards the request metrics; the others are counted as coalesced.
+
+# --record <directory> saves every request and response of the run to a cassette, and --replay <directory> answers the
+# script's requests from it without touching the network, so post-processing can be re-run offline in seconds and
+# benchmarks get the same input every time. Response bodies are stored once each, gzip compressed and named by their
+# SHA-256 (bodies/<sha256>.gz), so the repeated polls of a job cost one line in the index (index.jsonl.gz) rather than
+# another copy. Requests are matched on method, URL (with its query string) and a hash of the body, in the order they
+# were recorded; when a request comes back more often than recorded (a job polled once more) the last response is
+# repeated.
+# A request whose body changed, such as a time range computed from the current time, falls back to the responses
+# recorded for the same method and URL. API keys are never written to the cassette.
+
+# Usage: python cbc-run.py --help
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10]
+THROTTLED = (429, 503)
+# At most one decrease of the concurrency limit per this many seconds, so a burst of 429s counts as one signal
+DECREASE_COOLDOWN = 1.0
+# POSTs to these endpoints only read data, so identical ones in flight together can share a response
+COALESCE_POSTS = re.compile(r'/processes/detail_jobs$|/events/\{id\}/_search$')
+# GETs of these endpoints are status polls: the same URL is requested until a job or command finishes
+POLL_ENDPOINTS = re.compile(r'/(search_jobs|detail_jobs)/\{id\}/results$|/liveresponse/sessions/\{id\}/commands/\{id\}$')
+
+
+def endpoint_template(url):
+    # Replace the parts of a URL path that vary between calls (org key, IDs, GUIDs) with placeholders
+
+    # rtype: string
+    segments = urlparse(url).path.split('/')
+    template = []
+    for i, segment in enumerate(segments):
+        if i > 0 and segments[i - 1] == 'orgs':
+            template.append('{org_key}')
+        elif re.search(r'\d', segment) and not re.fullmatch(r'v\d+', segment):
+            template.append('{id}')
+        else:
+            template.append(segment)
+    return '/'.join(template)
+
+
+def percentile(values, fraction):
+    # rtype: float
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Metrics:
+    # Counters collected while the script runs. Every update takes the lock, since several scripts make requests from
+    # worker threads.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = {}
+        self.polls = {}
+        self.timers = {}
+        self.controller = None
+        self.single_flight = None
+
+    def record_request(self, method, url, status, seconds, sent, received):
+        endpoint = endpoint_template(url)
+        with self.lock:
+            entry = self.requests.setdefault((method, endpoint), {
+                "count": 0, "errors": 0, "durations": [], "buckets": [0] * len(LATENCY_BUCKETS),
+                "sent": 0, "received": 0, "statuses": {}})
+            entry["count"] += 1
+            entry["durations"].append(seconds)
+            entry["sent"] += sent
+            entry["received"] += received
+            entry["statuses"][status] = entry["statuses"].get(status, 0) + 1
+            if status is None or status >= 400:
+                entry["errors"] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if seconds <= bound:
+                    entry["buckets"][i] += 1
+            if method == "GET" and POLL_ENDPOINTS.search(endpoint):
+                job = urlparse(url).path
+                polls = self.polls.setdefault(endpoint, {})
+                polls[job] = polls.get(job, 0) + 1
+
+    def record_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += 1
+            timer[1] += seconds
+
+    def openmetrics(self):
+        # Render the metrics in the OpenMetrics text exposition format
+
+        # rtype: string
+        with self.lock:
+            lines = ["# TYPE cbc_request_duration_seconds histogram",
+                     "# UNIT cbc_request_duration_seconds seconds",
+                     "# HELP cbc_request_duration_seconds Latency of API requests per endpoint"]
+            for (method, endpoint), entry in sorted(self.requests.items()):
+                labels = f'method="{method}",endpoint="{label_value(endpoint)}"'
+                for bound, count in zip(LATENCY_BUCKETS, entry["buckets"]):
+                    lines.append(f'cbc_request_duration_seconds_bucket{{{labels},le="{bound}"}} {count}')
+                lines.append(f'cbc_request_duration_seconds_bucket{{{labels},le="+Inf"}} {entry["count"]}')
+                lines.append(f'cbc_request_duration_seconds_sum{{{labels}}} {sum(entry["durations"]):.6f}')
+                lines.append(f'cbc_request_duration_seconds_count{{{labels}}} {entry["count"]}')
+            lines.append("# TYPE cbc_requests counter")
+            lines.append("# HELP cbc_requests API requests per endpoint and HTTP status")
+            for (method, endpoint), entry in sorted(self.requests.items()):
+                for status, count in sorted(entry["statuses"].items(), key=lambda item: str(item[0])):
+                    lines.append(f'cbc_requests_total{{method="{method}",endpoint="{label_value(endpoint)}",'
+                                 f'status="{status if status is not None else "error"}"}} {count}')
+            lines.append("# TYPE cbc_transferred_bytes counter")
+            lines.append("# UNIT cbc_transferred_bytes bytes")
+            lines.append("# HELP cbc_transferred_bytes Request and response body bytes per endpoint")
+            for (method, endpoint), entry in sorted(self.requests.items()):
+                labels = f'method="{method}",endpoint="{label_value(endpoint)}"'
+                lines.append(f'cbc_transferred_bytes_total{{{labels},direction="sent"}} {entry["sent"]}')
+                lines.append(f'cbc_transferred_bytes_total{{{labels},direction="received"}} {entry["received"]}')
+            lines.append("# TYPE cbc_jobs counter")
+            lines.append("# HELP cbc_jobs Jobs or commands polled per endpoint")
+            for endpoint, jobs in sorted(self.polls.items()):
+                lines.append(f'cbc_jobs_total{{endpoint="{label_value(endpoint)}"}} {len(jobs)}')
+            lines.append("# TYPE cbc_job_polls counter")
+            lines.append("# HELP cbc_job_polls Status polls per endpoint")
+            for endpoint, jobs in sorted(self.polls.items()):
+                lines.append(f'cbc_job_polls_total{{endpoint="{label_value(endpoint)}"}} {sum(jobs.values())}')
+            lines.append("# TYPE cbc_stage_seconds counter")
+            lines.append("# UNIT cbc_stage_seconds seconds")
+            lines.append("# HELP cbc_stage_seconds Time spent decoding JSON, building DataFrames and writing files")
+            for name, (count, seconds) in sorted(self.timers.items()):
+                lines.append(f'cbc_stage_seconds_total{{stage="{name}"}} {seconds:.6f}')
+            lines.append("# TYPE cbc_stage_calls counter")
+            for name, (count, seconds) in sorted(self.timers.items()):
+                lines.append(f'cbc_stage_calls_total{{stage="{name}"}} {count}')
+            controller = self.controller
+            if controller is not None:
+                with controller.condition:
+                    lines.append("# TYPE cbc_concurrency_limit gauge")
+                    lines.append("# HELP cbc_concurrency_limit Requests allowed in flight by the adaptive controller")
+                    lines.append(f"cbc_concurrency_limit {controller.limit:.3f}")
+                    lines.append("# TYPE cbc_concurrency_in_flight gauge")
+                    lines.append(f"cbc_concurrency_in_flight {controller.in_flight}")
+                    lines.append("# TYPE cbc_concurrency_decreases counter")
+                    lines.append(f'cbc_concurrency_decreases_total{{reason="throttled"}} '
+                                 f'{controller.throttled_decreases}')
+                    lines.append(f'cbc_concurrency_decreases_total{{reason="latency"}} {controller.latency_decreases}')
+                    lines.append("# TYPE cbc_retries counter")
+                    lines.append("# HELP cbc_retries Requests retried after a 429 or 503")
+                    lines.append(f"cbc_retries_total {controller.retries}")
+            single_flight = self.single_flight
+            if single_flight is not None:
+                lines.append("# TYPE cbc_coalesced_requests counter")
+                lines.append("# HELP cbc_coalesced_requests Requests answered with the response of an identical one")
+                with single_flight.lock:
+                    for (method, endpoint), count in sorted(single_flight.coalesced.items()):
+                        lines.append(f'cbc_coalesced_requests_total{{method="{method}",'
+                                     f'endpoint="{label_value(endpoint)}"}} {count}')
+            lines.append("# TYPE cbc_run_seconds gauge")
+            lines.append(f"cbc_run_seconds {time.time() - self.started:.3f}")
+            lines.append("# EOF")
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        # Render the table printed when the script exits
+
+        # rtype: string
+        with self.lock:
+            lines = [f"{'method':<7}{'endpoint':<72}{'count':>7}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}"
+                     f"{'max ms':>9}{'KB in':>10}{'KB out':>9}"]
+            total_time = 0.0
+            for (method, endpoint), entry in sorted(self.requests.items(), key=lambda item: -sum(item[1]["durations"])):
+                durations = entry["durations"]
+                total_time += sum(durations)
+                lines.append(f"{method:<7}{endpoint[-71:]:<72}{entry['count']:>7}{entry['errors']:>7}"
+                             f"{percentile(durations, 0.5) * 1000:>9.1f}{percentile(durations, 0.95) * 1000:>9.1f}"
+                             f"{max(durations) * 1000:>9.1f}{entry['received'] / 1024:>10.1f}"
+                             f"{entry['sent'] / 1024:>9.1f}")
+            for endpoint, jobs in sorted(self.polls.items()):
+                counts = list(jobs.values())
+                lines.append(f"{len(jobs)} jobs polled at {endpoint}: {sum(counts)} polls, "
+                             f"{sum(counts) / len(counts):.1f} per job on average, {max(counts)} at most")
+            lines.append(f"Time in requests: {total_time:.2f}s (summed over threads)")
+            for name, (count, seconds) in sorted(self.timers.items()):
+                lines.append(f"Time in {name}: {seconds:.2f}s over {count} calls")
+            if self.controller is not None:
+                lines.append(self.controller.summary())
+            if self.single_flight is not None:
+                lines.append(self.single_flight.summary())
+            lines.append(f"Wall time: {time.time() - self.started:.2f}s")
+        return "\n".join(lines)
+
+
+def timed(metrics, name, function):
+    # Wrap a function so every call adds its duration to the named timer
+
+    # rtype: function
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            metrics.record_time(name, time.perf_counter() - start)
+    wrapper.__wrapped__ = function
+    return wrapper
+
+
+def install_metrics(metrics):
+    # Patch the requests library, JSON decoding, DataFrame construction and the file writers so they report to metrics
+
+    original_request = requests.sessions.Session.request
+
+    def request(session, method, url, *args, **kwargs):
+        start = time.perf_counter()
+        status = None
+        response = None
+        try:
+            response = original_request(session, method, url, *args, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            seconds = time.perf_counter() - start
+            sent = 0
+            received = 0
+            if response is not None:
+                body = response.request.body
+                sent = len(body) if body else 0
+                length = response.headers.get('Content-Length')
+                if length is not None:
+                    received = int(length)
+                elif not kwargs.get('stream'):
+                    received = len(response.content)
+            metrics.record_request(method.upper(), url, status, seconds, sent, received)
+
+    requests.sessions.Session.request = request
+    requests.models.Response.json = timed(metrics, "json decode", requests.models.Response.json)
+    json.dump = timed(metrics, "file write (json)", json.dump)
+    try:
+        import pandas as pd
+    except ImportError:
+        return
+    pd.DataFrame.from_dict = classmethod(timed(metrics, "DataFrame build", pd.DataFrame.from_dict.__func__))
+    for writer in ("to_csv", "to_excel", "to_json", "to_parquet"):
+        setattr(pd.DataFrame, writer, timed(metrics, f"file write ({writer[3:]})", getattr(pd.DataFrame, writer)))
+    pd.read_json = timed(metrics, "file read (json)", pd.read_json)
+    pd.read_csv = timed(metrics, "file read (csv)", pd.read_csv)
+
+
+class ConcurrencyController:
+    # AIMD limit on the requests in flight, shared by every thread of the script. Threads wait in acquire() while the
+    # limit is reached; release() reports how the request went and adjusts the limit.
+
+    def __init__(self, initial, maximum, latency_tolerance=2.0, max_retries=5):
+        self.condition = threading.Condition()
+        self.limit = float(max(1, min(initial, maximum)))
+        self.highest = self.limit
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.max_retries = max_retries
+        self.in_flight = 0
+        self.latency = {}
+        self.last_decrease = 0.0
+        self.throttled_decreases = 0
+        self.latency_decreases = 0
+        self.retries = 0
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, endpoint, status, seconds):
+        with self.condition:
+            self.in_flight -= 1
+            if status in THROTTLED:
+                if self.decrease(0.5):
+                    self.throttled_decreases += 1
+            elif status is not None and status < 400:
+                # Latency is compared per endpoint: a search job submission is always slower than a status poll
+                average, fastest = self.latency.get(endpoint, (seconds, seconds))
+                average = 0.7 * average + 0.3 * seconds
+                fastest = min(fastest, average)
+                self.latency[endpoint] = (average, fastest)
+                if average > fastest * self.latency_tolerance and average - fastest > 0.05:
+                    if self.decrease(0.75):
+                        self.latency_decreases += 1
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                    self.highest = max(self.highest, self.limit)
+            self.condition.notify_all()
+
+    def decrease(self, factor):
+        # rtype: bool
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_COOLDOWN:
+            return False
+        self.last_decrease = now
+        self.limit = max(1.0, self.limit * factor)
+        return True
+
+    def retry_delay(self, response, attempt):
+        # Seconds to wait before retrying a throttled request: the server's Retry-After when it sends one
+
+        # rtype: float
+        with self.condition:
+            self.retries += 1
+        try:
+            return min(float(response.headers.get('Retry-After')), 30.0)
+        except (TypeError, ValueError):
+            return min(0.5 * 2 ** attempt, 30.0)
+
+    def summary(self):
+        # rtype: string
+        with self.condition:
+            return (f"Concurrency limit: {self.limit:.1f} at exit, {self.highest:.1f} at most, "
+                    f"{self.throttled_decreases} decreases on 429/503, {self.latency_decreases} on latency, "
+                    f"{self.retries} retries")
+
+
+def install_controller(controller):
+    # Patch the requests library so every request waits for a slot from the controller and throttled ones are retried
+    original_request = requests.sessions.Session.request
+
+    def request(session, method, url, *args, **kwargs):
+        endpoint = endpoint_template(url)
+        attempt = 0
+        while True:
+            controller.acquire()
+            start = time.perf_counter()
+            response = None
+            try:
+                response = original_request(session, method, url, *args, **kwargs)
+            finally:
+                controller.release(endpoint, response.status_code if response is not None else None,
+                                   time.perf_counter() - start)
+            if response.status_code not in THROTTLED or attempt >= controller.max_retries:
+                return response
+            delay = controller.retry_delay(response, attempt)
+            response.close()
+            time.sleep(delay)
+            attempt += 1
+
+    requests.sessions.Session.request = request
+
+
+class SingleFlight:
+    # Calls in flight by key. The first caller of a key makes the call; callers arriving before it finishes wait for it
+    # and share the result (or the exception).
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.coalesced = {}
+
+    def do(self, key, name, function):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = {"done": threading.Event(), "response": None, "error": None}
+            else:
+                self.coalesced[name] = self.coalesced.get(name, 0) + 1
+        if not leader:
+            call["done"].wait()
+            if call["error"] is not None:
+                raise call["error"]
+            # Every caller gets its own Response object; the body has already been read and is shared
+            return copy.copy(call["response"])
+        try:
+            response = function()
+            response.content
+            call["response"] = response
+            return response
+        except Exception as e:
+            call["error"] = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call["done"].set()
+
+    def summary(self):
+        # rtype: string
+        with self.lock:
+            total = sum(self.coalesced.values())
+            endpoints = ", ".join(f"{count} {method} {endpoint}" for (method, endpoint), count
+                                  in sorted(self.coalesced.items(), key=lambda item: -item[1]))
+        return f"Coalesced requests: {total}" + (f" ({endpoints})" if endpoints else "")
+
+
+def request_key(session, method, url, kwargs):
+    # Everything that makes two requests identical: method, URL, query parameters, body and API key. Returns None for
+    # requests that must not be shared.
+
+    # rtype: string or None
+    endpoint = endpoint_template(url)
+    if kwargs.get('stream') or kwargs.get('files'):
+        return None
+    if method != 'GET' and not (method == 'POST' and COALESCE_POSTS.search(endpoint)):
+        return None
+    headers = dict(session.headers)
+    headers.update(kwargs.get('headers') or {})
+    token = next((value for name, value in headers.items() if name.lower() == 'x-auth-token'), None)
+    try:
+        return json.dumps([method, url, kwargs.get('params'), kwargs.get('json'), kwargs.get('data'), token],
+                          sort_keys=True, default=str)
+    except TypeError:
+        return None
+
+
+def install_single_flight(single_flight):
+    # Patch the requests library so identical requests in flight at the same time are sent once
+    original_request = requests.sessions.Session.request
+
+    def request(session, method, url, *args, **kwargs):
+        key = None if args else request_key(session, method.upper(), url, kwargs)
+        if key is None:
+            return original_request(session, method, url, *args, **kwargs)
+        return single_flight.do(key, (method.upper(), endpoint_template(url)),
+                                lambda: original_request(session, method, url, **kwargs))
+
+    requests.sessions.Session.request = request
+
+
+class Cassette:
+    # Recorded requests and responses. entries holds one dict per response in recording order; the indexes map the
+    # exact and the loose (method and URL only) key of a request to the entries recorded for it.
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.entries = []
+        self.exact = {}
+        self.loose = {}
+        self.used = set()
+        self.replayed = 0
+        self.missing = 0
+
+    @staticmethod
+    def keys(method, url, body):
+        # rtype: (string, string)
+        digest = hashlib.sha256(body).hexdigest() if body else None
+        loose = json.dumps([method, url])
+        return json.dumps([method, url, digest]), loose
+
+    def load(self):
+        with gzip.open(os.path.join(self.directory, "index.jsonl.gz"), "rt") as f:
+            for line in f:
+                self.add(json.loads(line))
+
+    def add(self, entry):
+        index = len(self.entries)
+        self.entries.append(entry)
+        self.exact.setdefault(entry["key"], []).append(index)
+        self.loose.setdefault(entry["loose"], []).append(index)
+
+    def save_body(self, content):
+        # Store a response body under its SHA-256 unless it is already there
+
+        # rtype: string
+        digest = hashlib.sha256(content).hexdigest()
+        filename = os.path.join(self.directory, "bodies", digest + ".gz")
+        if not os.path.exists(filename):
+            with gzip.open(filename + ".tmp", "wb") as f:
+                f.write(content)
+            os.replace(filename + ".tmp", filename)
+        return digest
+
+    def record(self, method, url, body, response):
+        key, loose = self.keys(method, url, body)
+        digest = self.save_body(response.content)
+        headers = {name: value for name, value in response.headers.items()
+                   if name.lower() not in ('set-cookie', 'content-encoding', 'transfer-encoding')}
+        with self.lock:
+            self.add({"key": key, "loose": loose, "method": method, "url": url, "status": response.status_code,
+                      "reason": response.reason, "headers": headers, "body": digest})
+
+    def find(self, method, url, body):
+        # Return the next recorded entry for a request, or None
+
+        # rtype: dict or None
+        key, loose = self.keys(method, url, body)
+        with self.lock:
+            for index in (self.exact, self.loose):
+                candidates = index.get(key if index is self.exact else loose)
+                if not candidates:
+                    continue
+                chosen = next((i for i in candidates if i not in self.used), candidates[-1])
+                self.used.add(chosen)
+                self.replayed += 1
+                return self.entries[chosen]
+            self.missing += 1
+            return None
+
+    def read_body(self, digest):
+        # rtype: bytes
+        with gzip.open(os.path.join(self.directory, "bodies", digest + ".gz"), "rb") as f:
+            return f.read()
+
+    def save(self):
+        # Write the index in one step so an interrupted run leaves the previous one intact
+        filename = os.path.join(self.directory, "index.jsonl.gz")
+        with self.lock:
+            entries = list(self.entries)
+        with gzip.open(filename + ".tmp", "wt") as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(filename + ".tmp", filename)
+
+    def summary(self, recording):
+        # rtype: string
+        with self.lock:
+            if recording:
+                bodies = len({entry["body"] for entry in self.entries})
+                return f"Recorded {len(self.entries)} responses ({bodies} distinct bodies) to '{self.directory}'"
+            return f"Replayed {self.replayed} responses from '{self.directory}', {self.missing} requests not recorded"
+
+
+def prepare(session, method, url, kwargs):
+    # Build the request the way requests would send it, to get the final URL and body
+
+    # rtype: requests.PreparedRequest
+    request = requests.Request(method=method, url=url, headers=kwargs.get('headers'), files=kwargs.get('files'),
+                               data=kwargs.get('data') or {}, json=kwargs.get('json'),
+                               params=kwargs.get('params') or {})
+    return session.prepare_request(request)
+
+
+def request_body(prepared):
+    # rtype: bytes
+    body = prepared.body or b''
+    return body.encode() if isinstance(body, str) else body
+
+
+def install_recorder(cassette):
+    # Patch the requests library so every response is also written to the cassette
+    os.makedirs(os.path.join(cassette.directory, "bodies"), exist_ok=True)
+    original_request = requests.sessions.Session.request
+
+    def request(session, method, url, *args, **kwargs):
+        response = original_request(session, method, url, *args, **kwargs)
+        prepared = response.request
+        cassette.record(method.upper(), prepared.url, request_body(prepared), response)
+        return response
+
+    requests.sessions.Session.request = request
+
+
+def install_replayer(cassette):
+    # Patch the requests library so requests are answered from the cassette instead of the network
+    cassette.load()
+
+    def request(session, method, url, *args, **kwargs):
+        prepared = prepare(session, method.upper(), url, kwargs)
+        entry = cassette.find(method.upper(), prepared.url, request_body(prepared))
+        if entry is None:
+            raise requests.exceptions.ConnectionError(f"{method.upper()} {prepared.url} is not in the cassette",
+                                                      request=prepared)
+        response = requests.models.Response()
+        response.status_code = entry["status"]
+        response.reason = entry["reason"]
+        response.headers = requests.structures.CaseInsensitiveDict(entry["headers"])
+        response._content = cassette.read_body(entry["body"])
+        response._content_consumed = True
+        response.url = prepared.url
+        response.request = prepared
+        response.elapsed = datetime.timedelta(0)
+        return response
+
+    requests.sessions.Session.request = request
+
+
+def write_metrics_file(metrics, filename):
+    # Replace the metrics file in one step so a scraper never reads half a file
+    with open(filename + '.tmp', 'w') as f:
+        f.write(metrics.openmetrics())
+    os.replace(filename + '.tmp', filename)
+
+
+def serve_metrics(metrics, port):
+    # Serve the metrics on /metrics from a background thread
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = metrics.openmetrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/openmetrics-text; version=1.0.0; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://127.0.0.1:{server.server_port}/metrics", file=sys.stderr)
+    return server
+
+
+class Profiler:
+    # cProfile only sees the thread it was enabled in, so every thread started while profiling gets a profiler of its
+    # own and the results are merged when writing the report
+
+    def __init__(self):
+        self.profiles = [cProfile.Profile()]
+        self.lock = threading.Lock()
+        self.original_run = threading.Thread.run
+
+    def start(self):
+        profiler = self
+        original_run = self.original_run
+
+        def run(thread):
+            profile = cProfile.Profile()
+            with profiler.lock:
+                profiler.profiles.append(profile)
+            profile.enable()
+            try:
+                original_run(thread)
+            finally:
+                profile.disable()
+
+        threading.Thread.run = run
+        tracemalloc.start(25)
+        self.start_snapshot = tracemalloc.take_snapshot()
+        self.profiles[0].enable()
+
+    def stop(self):
+        self.profiles[0].disable()
+        threading.Thread.run = self.original_run
+        self.end_snapshot = tracemalloc.take_snapshot()
+        self.current, self.peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    def write_reports(self, directory, name, top):
+        # Write the hotspot and allocation reports and return their filenames
+
+        # rtype: (string, string)
+        timestamp = time.strftime("%Y%m%d-%H%M%S")  # create a timestamp for our filename
+        with self.lock:
+            profiles = [profile for profile in self.profiles if profile.getstats()]
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        profile_file = os.path.join(directory, f"profile-{name}-{timestamp}.txt")
+        stats.dump_stats(profile_file[:-len('.txt')] + '.prof')
+        with open(profile_file, 'w') as f:
+            f.write(f"Profile of {name}: {len(profiles)} thread(s)\n")
+            for sort, title in (("cumulative", "cumulative time"), ("tottime", "own time")):
+                f.write(f"\n=== Top {top} functions by {title} ===\n")
+                stats.stream = f
+                stats.sort_stats(sort).print_stats(top)
+
+        allocation_file = os.path.join(directory, f"allocations-{name}-{timestamp}.txt")
+        snapshot_filter = [tracemalloc.Filter(False, tracemalloc.__file__),
+                           tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+                           tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>")]
+        end = self.end_snapshot.filter_traces(snapshot_filter)
+        start = self.start_snapshot.filter_traces(snapshot_filter)
+        with open(allocation_file, 'w') as f:
+            f.write(f"Traced memory of {name}: peak {self.peak / 1048576:.1f} MB, "
+                    f"{self.current / 1048576:.1f} MB still allocated at exit\n")
+            f.write(f"\n=== Top {top} lines by memory held at exit ===\n")
+            for stat in end.statistics('lineno')[:top]:
+                f.write(f"{stat.size / 1024:>12.1f} KB {stat.count:>9} blocks  {stat.traceback[0]}\n")
+            f.write(f"\n=== Top {top} lines by growth since start ===\n")
+            for stat in end.compare_to(start, 'lineno')[:top]:
+                f.write(f"{stat.size_diff / 1024:>+12.1f} KB {stat.count_diff:>+9} blocks  {stat.traceback[0]}\n")
+            f.write("\n=== Largest allocation traceback ===\n")
+            for stat in end.statistics('traceback')[:1]:
+                f.write("\n".join(stat.traceback.format()) + "\n")
+        return profile_file, allocation_file
+
+
+def run_script(script, script_args):
+    # Run a script as if it had been started from the command line and return its exit code
+
+    # rtype: int
+    sys.argv = [script] + script_args
+    sys.path.insert(0, os.path.dirname(os.path.abspath(script)))
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    return 0
+
+
+def main():
+    # Main function to parse arguments and run the script
+
+    parser = argparse.ArgumentParser(prog="cbc-run.py",
+                                     description="Run a script from this repository with instrumentation.",
+                                     usage="%(prog)s [options] -- script.py [script arguments]")
+    parser.add_argument("--metrics", action='store_true', help="Print a summary table of the metrics at exit")
+    parser.add_argument("--metrics_file", help="Write the metrics in OpenMetrics format to this file")
+    parser.add_argument("--metrics_interval", type=float, default=15,
+                        help="Seconds between updates of --metrics_file")
+    parser.add_argument("--metrics_port", type=int, help="Serve the metrics on this port at /metrics")
+    parser.add_argument("--profile", action='store_true',
+                        help="Write cProfile hotspot and tracemalloc allocation reports when the script exits")
+    parser.add_argument("--profile_dir", default=".", help="Directory for the --profile reports")
+    parser.add_argument("--profile_top", type=int, default=40, help="Entries per section of the --profile reports")
+    parser.add_argument("--adaptive", action='store_true',
+                        help="Tune the number of requests in flight from latency and 429/503 responses")
+    parser.add_argument("--concurrency", type=int, default=4, help="Starting concurrency limit for --adaptive")
+    parser.add_argument("--max_concurrency", type=int, default=32, help="Highest concurrency limit for --adaptive")
+    parser.add_argument("--latency_tolerance", type=float, default=2.0,
+                        help="Back off when latency rises above this multiple of the fastest seen per endpoint")
+    parser.add_argument("--max_retries", type=int, default=5, help="Retries of a request answered with 429 or 503")
+    parser.add_argument("--coalesce", action='store_true',
+                        help="Send identical GETs and detail job submissions that are in flight together only once")
+    parser.add_argument("--record", metavar="DIRECTORY", help="Record every request and response to this cassette")
+    parser.add_argument("--replay", metavar="DIRECTORY", help="Answer requests from this cassette, offline")
+    parser.add_argument("script", help="Script to run")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments for the script")
+    args = parser.parse_args()
+
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be used together")
+
+    # Recording and replaying sit closest to the network, so the metrics see replayed requests as if they were sent
+    cassette = None
+    if args.record or args.replay:
+        cassette = Cassette(args.record or args.replay)
+        if args.record:
+            install_recorder(cassette)
+        else:
+            install_replayer(cassette)
+
+    metrics = None
+    stop = threading.Event()
+    if args.metrics or args.metrics_file or args.metrics_port is not None:
+        metrics = Metrics()
+        install_metrics(metrics)
+        if args.metrics_port is not None:
+            serve_metrics(metrics, args.metrics_port)
+        if args.metrics_file:
+            def update_file():
+                while not stop.wait(args.metrics_interval):
+                    write_metrics_file(metrics, args.metrics_file)
+            threading.Thread(target=update_file, daemon=True).start()
+
+    controller = None
+    if args.adaptive:
+        # Installed after the metrics so every attempt of a retried request is counted
+        controller = ConcurrencyController(args.concurrency, args.max_concurrency, args.latency_tolerance,
+                                           args.max_retries)
+        install_controller(controller)
+        if metrics is not None:
+            metrics.controller = controller
+
+    single_flight = None
+    if args.coalesce:
+        # Installed last so the requests that wait for an identical one hold no concurrency slot and are not counted
+        single_flight = SingleFlight()
+        install_single_flight(single_flight)
+        if metrics is not None:
+            metrics.single_flight = single_flight
+
+    profiler = None
+    if args.profile:
+        profiler = Profiler()
+        profiler.start()
+
+    try:
+        code = run_script(args.script, args.script_args)
+    finally:
+        stop.set()
+        if profiler is not None:
+            profiler.stop()
+            name = os.path.splitext(os.path.basename(args.script))[0]
+            for report in profiler.write_reports(args.profile_dir, name, args.profile_top):
+                print(f"Saved to '{report}'", file=sys.stderr)
+        if metrics is not None:
+            if args.metrics_file:
+                write_metrics_file(metrics, args.metrics_file)
+            if args.metrics:
+                print("\n" + metrics.summary(), file=sys.stderr)
+        if controller is not None and not args.metrics:
+            print(controller.summary(), file=sys.stderr)
+        if single_flight is not None and not args.metrics:
+            print(single_flight.summary(), file=sys.stderr)
+        if cassette is not None:
+            if args.record:
+                cassette.save()
+            print(cassette.summary(bool(args.record)), file=sys.stderr)
+    return code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
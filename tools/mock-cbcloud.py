@@ -0,0 +1,891 @@
+import argparse
+import sys
+import json
+import re
+import time
+import random
+import threading
+import hashlib
+import uuid
+import fnmatch
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+
+# This script runs a local stand-in for the Carbon Black Cloud API so the scripts in this repository can be run, timed
+# and regression-tested without a live tenant. Point a script at it with the CBC_BASE_URL environment variable, e.g.
+#   python tools/mock-cbcloud.py --records 10000
+#   CBC_BASE_URL=http://127.0.0.1:8080 python processes/processes.py -e PROD05 -o MOCKORG -i id -s secret
+# The environment, org key and API credentials are not checked beyond the X-Auth-Token header being present.
+
+# The data is generated from --seed, so every run against the same settings sees the same records. It covers the
+# endpoints the scripts use:
+#   investigate  - process search and detail jobs and observation search jobs. A job reports the backend partitions it
+#                  contacted and how many have completed, and completes over --job_seconds, as the real service does
+#   events       - per-process event _search, answered in --segments segments over as many requests
+#   alerts       - v7 alert _search with time range, minimum severity and id criteria, _facet term counts, and
+#                  workflow updates, run as jobs (jobs v1) that complete over --job_seconds
+#   devices      - appservices v6 device _search
+#   audit log    - appservices v5 auditlog/find
+#   watchlistmgr - watchlists (list and update) and reports
+#   device_control - USB device _search and the endpoints of each USB device
+#   liveresponse - sessions (PENDING for --lr_pending_polls polls), commands (COMPLETE after --command_seconds) and
+#                  file contents, with Range support
+# --latency_ms and --jitter_ms delay every answer, and --rate_limit answers 429 once more requests per second arrive
+# than allowed. GET /mock/stats returns the number of requests seen per endpoint; POST /mock/stats resets it.
+# POST /mock/warm generates all of the records up front (tools/benchmark.py uses it before timing anything).
+
+# Usage: python mock-cbcloud.py --help
+
+PROCESS_NAMES = ["powershell.exe", "cmd.exe", "chrome.exe", "svchost.exe", "wscript.exe", "rundll32.exe",
+                 "excel.exe", "explorer.exe", "python.exe", "msiexec.exe"]
+USERNAMES = ["CORP\\alice", "CORP\\bob", "NT AUTHORITY\\SYSTEM", "CORP\\carol"]
+EVENT_TYPES = ["childproc", "filemod", "modload", "netconn", "regmod", "scriptload", "crossproc"]
+WORKFLOW_STATUSES = ["OPEN", "IN_PROGRESS", "CLOSED"]
+PARTITIONS = 8
+
+
+def iso(timestamp):
+    # Format a datetime the way the API does
+
+    # rtype: string
+    return timestamp.strftime('%Y-%m-%dT%H:%M:%S.') + f"{timestamp.microsecond // 1000:03d}Z"
+
+
+def parse_time(value):
+    # Parse an API timestamp or return None
+
+    # rtype: datetime or None
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(str(value).replace('Z', '+00:00')).replace(tzinfo=timezone.utc)
+    except ValueError:
+        return None
+
+
+def window_start(window, now):
+    # Turn a relative window such as -1h or -30d into its start time
+
+    # rtype: datetime or None
+    match = re.fullmatch(r'-(\d+)([smhdw])', str(window or '').strip())
+    if not match:
+        return None
+    seconds = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}[match.group(2)]
+    return now - timedelta(seconds=int(match.group(1)) * seconds)
+
+
+class Dataset:
+    # The generated records. Each kind is built the first time it is asked for and then kept, so a large dataset is
+    # only paid for by the endpoints a script actually uses.
+
+    def __init__(self, records, days, seed, events_per_process, file_size):
+        self.records = records
+        self.days = days
+        self.seed = seed
+        self.events_per_process = events_per_process
+        self.file_size = file_size
+        self.now = datetime.now(timezone.utc).replace(microsecond=0)
+        # Re-entrant, because building an index builds the records it indexes
+        self.lock = threading.RLock()
+        self.built = {}
+
+    def get(self, kind):
+        with self.lock:
+            if kind not in self.built:
+                self.built[kind] = getattr(self, 'build_' + kind)()
+            return self.built[kind]
+
+    def timestamp(self, i):
+        # Spread the records evenly over the last `days` days, newest first
+        return self.now - timedelta(seconds=(i * self.days * 86400) // max(self.records, 1))
+
+    def process_guid(self, i):
+        return f"MOCKORG-{self.device_id(i):08x}-{1000 + i % 60000:08x}-00000000-{i:015x}"
+
+    def device_id(self, i):
+        return 100000 + i % max(self.records // 20, 1)
+
+    def build_processes(self):
+        rng = random.Random(self.seed)
+        processes = []
+        for i in range(self.records):
+            name = PROCESS_NAMES[rng.randrange(len(PROCESS_NAMES))]
+            pid = 1000 + i % 60000
+            md5 = hashlib.md5(name.encode()).hexdigest()
+            sha256 = hashlib.sha256(name.encode()).hexdigest()
+            timestamp = self.timestamp(i)
+            processes.append({
+                "process_guid": self.process_guid(i),
+                "backend_timestamp": iso(timestamp),
+                "device_timestamp": iso(timestamp - timedelta(seconds=5)),
+                "process_start_time": iso(timestamp - timedelta(seconds=30)),
+                "device_id": self.device_id(i),
+                "device_name": f"mock-host-{self.device_id(i)}",
+                "device_group_id": 0,
+                "device_os": "WINDOWS",
+                "device_policy": "Standard",
+                "device_policy_id": 6525,
+                "org_id": "MOCKORG",
+                "process_name": f"c:\\windows\\system32\\{name}",
+                "process_pid": [pid],
+                "process_username": [USERNAMES[i % len(USERNAMES)]],
+                "process_cmdline": [f"{name} -mock {i}"],
+                "process_hash": [md5, sha256],
+                "process_sha256": sha256,
+                "process_terminated": i % 3 != 0,
+                "process_effective_reputation": "TRUSTED_WHITE_LIST",
+                "parent_guid": self.process_guid(i + 1),
+                "parent_name": "c:\\windows\\explorer.exe",
+                "parent_pid": pid + 1,
+                "parent_hash": [hashlib.sha256(b"explorer.exe").hexdigest()],
+                "childproc_count": i % 4,
+                "crossproc_count": i % 3,
+                "filemod_count": i % 7,
+                "modload_count": i % 11,
+                "netconn_count": i % 5,
+                "regmod_count": i % 6,
+                "scriptload_count": i % 2,
+                "enriched": True,
+                "enriched_event_type": [EVENT_TYPES[i % len(EVENT_TYPES)]],
+                "event_type": [EVENT_TYPES[i % len(EVENT_TYPES)]],
+                "legacy": False,
+                "alert_id": [self.alert_id(i)] if i % 5 == 0 else [],
+                "alert_category": ["THREAT"] if i % 5 == 0 else []
+            })
+        return processes
+
+    def process_detail(self, process_guid):
+        process = self.get('process_index').get(process_guid)
+        if process is None:
+            return None
+        detail = dict(process)
+        detail["process_cmdline"] = process["process_cmdline"][0]
+        detail["process_md5"] = process["process_hash"][0]
+        detail["parent_cmdline"] = "c:\\windows\\explorer.exe"
+        detail["process_reputation"] = "TRUSTED_WHITE_LIST"
+        return detail
+
+    def build_process_index(self):
+        return {process['process_guid']: process for process in self.get('processes')}
+
+    def alert_id(self, i):
+        return str(uuid.UUID(int=(self.seed << 64) + i))
+
+    def build_alerts(self):
+        rng = random.Random(self.seed + 1)
+        alerts = []
+        for i in range(self.records):
+            timestamp = self.timestamp(i)
+            alerts.append({
+                "id": self.alert_id(i),
+                "org_key": "MOCKORG",
+                "type": "CB_ANALYTICS",
+                "backend_timestamp": iso(timestamp),
+                "backend_update_timestamp": iso(timestamp),
+                "detection_timestamp": iso(timestamp - timedelta(seconds=10)),
+                "first_event_timestamp": iso(timestamp - timedelta(minutes=5)),
+                "last_event_timestamp": iso(timestamp - timedelta(seconds=20)),
+                "severity": rng.randint(1, 10),
+                "reason": f"Mock alert {i}",
+                "device_id": self.device_id(i),
+                "device_name": f"mock-host-{self.device_id(i)}",
+                "device_os": "WINDOWS",
+                "device_policy": "Standard",
+                "device_policy_id": 6525,
+                "reason_code": f"T_MOCK_{i % 20}",
+                "process_guid": self.process_guid(i),
+                "process_name": PROCESS_NAMES[i % len(PROCESS_NAMES)],
+                "parent_guid": self.process_guid(i + 1),
+                "workflow": {"status": WORKFLOW_STATUSES[i % len(WORKFLOW_STATUSES)], "closure_reason": "NO_REASON"},
+                "threat_id": hashlib.md5(str(i % 50).encode()).hexdigest().upper()
+            })
+        return alerts
+
+    def build_alert_index(self):
+        return {alert['id']: (i, alert) for i, alert in enumerate(self.get('alerts'))}
+
+    def observations_for(self, alert_id):
+        entry = self.get('alert_index').get(alert_id)
+        if entry is None:
+            return []
+        i, alert = entry
+        return [{
+            "observation_id": f"{alert_id}:{n}",
+            "alert_id": [alert_id],
+            "observation_type": "CB_ANALYTICS",
+            "event_type": EVENT_TYPES[(i + n) % len(EVENT_TYPES)],
+            "device_id": alert['device_id'],
+            "device_name": alert['device_name'],
+            "device_timestamp": alert['last_event_timestamp'],
+            "backend_timestamp": alert['backend_timestamp'],
+            "process_guid": self.process_guid(i + n),
+            "process_name": PROCESS_NAMES[(i + n) % len(PROCESS_NAMES)]
+        } for n in range(3)]
+
+    def events_for(self, process_guid):
+        return [{
+            "process_guid": process_guid,
+            "event_guid": f"{process_guid}-{n}",
+            "event_type": EVENT_TYPES[n % len(EVENT_TYPES)],
+            "event_description": f"Mock {EVENT_TYPES[n % len(EVENT_TYPES)]} event {n}",
+            "event_timestamp": iso(self.now - timedelta(seconds=n)),
+            "scriptload_name": f"c:\\temp\\script{n}.js"
+        } for n in range(self.events_per_process)]
+
+    def build_devices(self):
+        devices = []
+        for i in range(self.records):
+            devices.append({
+                "id": 100000 + i,
+                "device_owner_id": 500000 + i,
+                "name": f"mock-host-{100000 + i}",
+                "os": "WINDOWS",
+                "os_version": "Windows 10 x64",
+                "deployment_type": ["ENDPOINT", "WORKLOAD", "VDI"][i % 3],
+                "sensor_version": ["4.0.0.1292", "3.9.2.2698", "3.9.1.2464"][i % 3],
+                "status": "REGISTERED",
+                "policy_id": 6525,
+                "policy_name": "Standard",
+                "last_contact_time": iso(self.timestamp(i)),
+                "last_internal_ip_address": f"10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}"
+            })
+        return devices
+
+    def build_usb_devices(self):
+        return [{
+            "id": 2000 + i,
+            "vendor_name": "Mock Vendor",
+            "product_name": f"Mock USB Drive {i % 10}",
+            "serial_number": f"SN{i:010d}",
+            "status": ["APPROVED", "UNAPPROVED"][i % 2],
+            "endpoint_count": 1 + i % 3,
+            "first_seen": iso(self.timestamp(i) - timedelta(days=1)),
+            "last_seen": iso(self.timestamp(i))
+        } for i in range(self.records)]
+
+    def build_audit_entries(self):
+        return [{
+            "eventId": f"mock-audit-{i}",
+            "eventTime": int(self.timestamp(i).timestamp() * 1000),
+            "loginName": USERNAMES[i % len(USERNAMES)],
+            "ipAddress": f"192.0.2.{i % 256}",
+            "description": f"Mock audit entry {i}",
+            "orgName": "MOCKORG",
+            "verbose": False
+        } for i in range(self.records)]
+
+    def build_watchlists(self):
+        count = max(self.records // 1000, 3)
+        return [{
+            "id": f"mockwatchlist{i}",
+            "name": f"Mock watchlist {i}",
+            "description": f"Disable after {(self.now + timedelta(days=30 * (i % 3 - 1))).date()}",
+            "tags_enabled": True,
+            "alerts_enabled": i % 2 == 0,
+            "report_ids": [f"mockreport{i}-{n}" for n in range(5)]
+        } for i in range(count)]
+
+    def report(self, report_id):
+        return {
+            "id": report_id,
+            "title": f"Mock report {report_id}",
+            "description": "Generated by mock-cbcloud.py",
+            "severity": 5,
+            "timestamp": int(self.now.timestamp()),
+            "iocs_v2": [{"id": f"{report_id}-ioc", "match_type": "query", "values": ["process_name:mock.exe"],
+                         "field": None}]
+        }
+
+    def file_content(self, file_id):
+        block = hashlib.sha256(file_id.encode()).hexdigest().encode() * 64
+        return (block * (self.file_size // len(block) + 1))[:self.file_size]
+
+
+class MockState:
+    # Everything the server remembers between requests: jobs, LR sessions and commands, rate limiting and counters
+
+    def __init__(self, dataset, args):
+        self.dataset = dataset
+        self.args = args
+        self.lock = threading.Lock()
+        self.jobs = {}
+        self.segments = {}
+        self.sessions = {}
+        self.session_polls = {}
+        self.commands = {}
+        self.stats = {}
+        self.window_start = time.time()
+        self.window_count = 0
+
+    def next_id(self):
+        return uuid.uuid4().hex
+
+    def count(self, route):
+        with self.lock:
+            self.stats[route] = self.stats.get(route, 0) + 1
+
+    def rate_limited(self):
+        # A fixed one-second window: once --rate_limit requests have arrived in the current second the rest get a 429
+        if not self.args.rate_limit:
+            return False
+        with self.lock:
+            now = time.time()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+            self.window_count += 1
+            return self.window_count > self.args.rate_limit
+
+    def job_progress(self, job):
+        # rtype: (contacted, completed)
+        if self.args.job_seconds <= 0:
+            return PARTITIONS, PARTITIONS
+        elapsed = time.time() - job['created']
+        return PARTITIONS, min(PARTITIONS, int(PARTITIONS * elapsed / self.args.job_seconds))
+
+
+def project(record, fields, default_fields=None):
+    # Keep only the requested fields of a record. "*" (or no fields) returns the default set, or everything.
+
+    # rtype: dict
+    if not fields or fields == ["*"]:
+        if default_fields:
+            return {k: record[k] for k in default_fields if k in record}
+        return record
+    wanted = [field for field in fields if field != "*"]
+    if "*" in fields and default_fields:
+        wanted = list(default_fields) + wanted
+    elif "*" in fields:
+        return record
+    return {k: record[k] for k in wanted if k in record}
+
+
+def search_processes(dataset, payload):
+    # Filter the generated processes by the time range of a search. Queries are not evaluated, except that a
+    # process_name:<name> term keeps only processes of that name (wildcards allowed).
+
+    # rtype: list
+    processes = dataset.get('processes')
+    time_range = payload.get('time_range') or {}
+    start = parse_time(time_range.get('start')) or window_start(time_range.get('window'), dataset.now)
+    end = parse_time(time_range.get('end'))
+    name = re.search(r'process_name:(\S+)', payload.get('query') or '')
+    results = []
+    for process in processes:
+        timestamp = parse_time(process['backend_timestamp'])
+        if start and timestamp < start or end and timestamp > end:
+            continue
+        if name and not fnmatch.fnmatch(process['process_name'].split('\\')[-1], name.group(1).strip('"').lower()):
+            continue
+        results.append(process)
+    return results
+
+
+def search_alerts(dataset, payload):
+    # Filter the generated alerts by id, minimum severity, workflow status and backend_timestamp range
+
+    # rtype: list
+    criteria = payload.get('criteria') or {}
+    time_range = payload.get('time_range') or {}
+    start = parse_time(time_range.get('start')) or window_start(time_range.get('range'), dataset.now)
+    end = parse_time(time_range.get('end'))
+    if criteria.get('id'):
+        index = dataset.get('alert_index')
+        alerts = [index[alert_id][1] for alert_id in criteria['id'] if alert_id in index]
+    else:
+        alerts = dataset.get('alerts')
+    minimum_severity = int(criteria.get('minimum_severity') or 0)
+    statuses = set(criteria.get('workflow_status') or [])
+    results = []
+    for alert in alerts:
+        if alert['severity'] < minimum_severity:
+            continue
+        if statuses and alert['workflow']['status'] not in statuses:
+            continue
+        if start or end:
+            timestamp = parse_time(alert['backend_timestamp'])
+            if start and timestamp < start or end and timestamp >= end:
+                continue
+        results.append(alert)
+    return results
+
+
+DEFAULT_PROCESS_FIELDS = ["process_guid", "backend_timestamp", "device_timestamp", "device_id", "device_name",
+                          "device_group_id", "device_os", "device_policy", "device_policy_id", "org_id",
+                          "process_name", "process_pid", "process_username", "process_hash", "parent_guid",
+                          "parent_pid", "childproc_count", "crossproc_count", "filemod_count", "modload_count",
+                          "netconn_count", "regmod_count", "scriptload_count", "enriched", "enriched_event_type",
+                          "event_type", "legacy", "alert_id", "alert_category"]
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    # Route each request to the handler of the endpoint it matches
+
+    state = None
+    routes = []
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        if self.state.args.verbose:
+            super().log_message(format, *args)
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_PUT(self):
+        self.dispatch("PUT")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        try:
+            return json.loads(self.rfile.read(length))
+        except ValueError:
+            return {}
+
+    def send_json(self, body, status=200, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_empty(self, status):
+        self.send_response(status)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def dispatch(self, method):
+        url = urlparse(self.path)
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self.read_json() if method in ("POST", "PUT") else {}
+        for route_method, pattern, handler in self.routes:
+            match = pattern.fullmatch(url.path)
+            if route_method == method and match:
+                break
+        else:
+            self.state.count("unmatched")
+            self.send_json({"error_code": "NOT_FOUND", "message": f"No mock for {method} {url.path}"}, 404)
+            return
+
+        self.state.count(handler.__name__)
+        if not handler.__name__.startswith("mock_"):
+            args = self.state.args
+            if args.latency_ms or args.jitter_ms:
+                time.sleep((args.latency_ms + random.uniform(0, args.jitter_ms)) / 1000)
+            if self.state.rate_limited():
+                self.state.count("rate_limited")
+                self.send_json({"error_code": "TOO_MANY_REQUESTS", "message": "Rate limit exceeded"}, 429,
+                               {"Retry-After": "1"})
+                return
+            if not self.headers.get('X-Auth-Token'):
+                self.send_json({"error_code": "UNAUTHORIZED", "message": "Missing X-Auth-Token"}, 401)
+                return
+        handler(self, match, query, body)
+
+    # Investigate search and detail jobs
+
+    def start_job(self, match, query, body, kind):
+        job_id = self.state.next_id()
+        with self.state.lock:
+            self.state.jobs[job_id] = {"kind": kind, "payload": body, "created": time.time(), "results": None}
+        self.send_json({"job_id": job_id})
+
+    def start_process_search(self, match, query, body):
+        self.start_job(match, query, body, "processes")
+
+    def start_process_detail(self, match, query, body):
+        self.start_job(match, query, body, "details")
+
+    def start_observation_search(self, match, query, body):
+        self.start_job(match, query, body, "observations")
+
+    def search_job_results(self, match, query, body):
+        self.job_results(match, query, body, "processes")
+
+    def detail_job_results(self, match, query, body):
+        self.job_results(match, query, body, "details")
+
+    def observation_job_results(self, match, query, body):
+        self.job_results(match, query, body, "observations")
+
+    def job_results(self, match, query, body, kind):
+        # Each kind of job is only served under its own URL, as the real service does, so polling a search job under
+        # detail_jobs (or the other way round) gets a 404
+        job = self.state.jobs.get(match.group('job_id'))
+        if job is None or job['kind'] != kind:
+            self.send_json({"error_code": "NOT_FOUND", "message": "Unknown job"}, 404)
+            return
+        contacted, completed = self.state.job_progress(job)
+        if job['results'] is None:
+            dataset = self.state.dataset
+            payload = job['payload']
+            if job['kind'] == "processes":
+                job['results'] = [project(process, payload.get('fields'), DEFAULT_PROCESS_FIELDS)
+                                  for process in search_processes(dataset, payload)][:int(payload.get('rows') or 500)]
+            elif job['kind'] == "details":
+                details = (dataset.process_detail(guid) for guid in payload.get('process_guids') or [])
+                job['results'] = [project(detail, payload.get('fields')) for detail in details if detail]
+            else:
+                alert_ids = re.findall(r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}',
+                                       payload.get('query') or '')
+                observations = [project(observation, payload.get('fields'))
+                                for alert_id in alert_ids for observation in dataset.observations_for(alert_id)]
+                # The job keeps at most its rows results, however many it found
+                job['num_found'] = len(observations)
+                job['results'] = observations[:int(payload.get('rows') or 500)]
+        results = job['results'] if completed == contacted else []
+        start = int(query.get('start') or 0)
+        rows = int(query.get('rows') if query.get('rows') is not None else 10)
+        self.send_json({
+            "contacted": contacted,
+            "completed": completed,
+            "num_found": job.get('num_found', len(results)) if completed == contacted else 0,
+            "num_available": len(results),
+            "approximate_unaggregated": len(results),
+            "results": results[start:start + rows]
+        })
+
+    def event_search(self, match, query, body):
+        process_guid = match.group('process_guid')
+        key = (process_guid, json.dumps(body, sort_keys=True))
+        with self.state.lock:
+            processed = self.state.segments.get(key, 0) + 1
+            if processed >= self.state.args.segments:
+                self.state.segments.pop(key, None)
+            else:
+                self.state.segments[key] = processed
+        total = self.state.args.segments
+        events = self.state.dataset.events_for(process_guid) if processed >= total else []
+        start = int(body.get('start') or 0)
+        rows = int(body.get('rows') or 500)
+        self.send_json({
+            "results": [project(event, body.get('fields')) for event in events[start:start + rows]],
+            "num_found": len(events),
+            "num_available": len(events),
+            "total_segments": total,
+            "processed_segments": min(processed, total)
+        })
+
+    # Alerts, devices and audit log
+
+    def alert_search(self, match, query, body):
+        alerts = search_alerts(self.state.dataset, body)
+        # v7 alert search pages are 1-based
+        start = max(int(body.get('start') or 1), 1) - 1
+        rows = int(body.get('rows') or 100)
+        self.send_json({"results": alerts[start:start + rows], "num_found": len(alerts),
+                        "num_available": len(alerts)})
+
+    def alert_workflow(self, match, query, body):
+        # Apply a workflow update to the matching alerts and return a job that completes over --job_seconds
+        alerts = search_alerts(self.state.dataset, body)
+        updated = iso(datetime.now(timezone.utc))
+        for alert in alerts:
+            alert['workflow'] = {"status": body.get('status') or alert['workflow']['status'],
+                                 "closure_reason": body.get('closure_reason') or
+                                 alert['workflow'].get('closure_reason') or "NO_REASON",
+                                 "note": body.get('note') or "", "changed_by": "mock", "change_timestamp": updated}
+            if body.get('determination'):
+                alert['determination'] = {"value": body['determination'], "change_timestamp": updated}
+        with self.state.lock:
+            job_id = str(len(self.state.jobs) + 1000)
+            self.state.jobs[job_id] = {"kind": "workflow", "payload": body, "created": time.time(),
+                                       "results": len(alerts)}
+        self.send_json({"request_id": job_id})
+
+    def job_status(self, match, query, body):
+        job = self.state.jobs.get(match.group('job_id'))
+        if job is None or job['kind'] != "workflow":
+            self.send_json({"error_code": "NOT_FOUND", "message": "Unknown job"}, 404)
+            return
+        total = job['results']
+        fraction = 1.0
+        if self.state.args.job_seconds > 0:
+            fraction = min((time.time() - job['created']) / self.state.args.job_seconds, 1.0)
+        self.send_json({"id": int(match.group('job_id')), "type": "alert_workflow",
+                        "status": "COMPLETED" if fraction >= 1 else "IN_PROGRESS",
+                        "job_parameters": {"job_parameters": job['payload']},
+                        "progress": {"num_total": total, "num_completed": int(total * fraction), "message": ""}})
+
+    def alert_facet(self, match, query, body):
+        # Count the matching alerts by each terms field, most common values first
+        alerts = search_alerts(self.state.dataset, body)
+        terms = body.get('terms') or {}
+        rows = int(terms.get('rows') or 20)
+        results = []
+        for field in terms.get('fields') or []:
+            counts = {}
+            for alert in alerts:
+                value = alert['workflow']['status'] if field == 'workflow_status' else alert.get(field)
+                if value is not None:
+                    counts[str(value)] = counts.get(str(value), 0) + 1
+            values = sorted(counts.items(), key=lambda item: (-item[1], item[0]))[:rows]
+            results.append({"field": field, "values": [{"id": value, "name": value, "total": total}
+                                                       for value, total in values]})
+        self.send_json({"results": results})
+
+    def device_search(self, match, query, body):
+        devices = self.state.dataset.get('devices')
+        criteria = body.get('criteria') or {}
+        for field in ("deployment_type", "sensor_version", "status", "os"):
+            if criteria.get(field):
+                wanted = set(criteria[field])
+                devices = [device for device in devices if device.get(field) in wanted]
+        start = max(int(body.get('start') or 1), 1) - 1
+        rows = int(body.get('rows') or 20)
+        self.send_json({"results": devices[start:start + rows], "num_found": len(devices)})
+
+    def audit_log(self, match, query, body):
+        entries = self.state.dataset.get('audit_entries')
+        start = parse_time(body.get('startTime'))
+        end = parse_time(body.get('endTime'))
+        if start or end:
+            entries = [entry for entry in entries
+                       if not (start and entry['eventTime'] < start.timestamp() * 1000)
+                       and not (end and entry['eventTime'] >= end.timestamp() * 1000)]
+        first = max(int(body.get('fromRow') or 1), 1) - 1
+        rows = int(body.get('maxRows') or 100)
+        self.send_json({"success": True, "totalResults": len(entries), "entries": entries[first:first + rows]})
+
+    # Watchlists and USB devices
+
+    def list_watchlists(self, match, query, body):
+        self.send_json({"results": self.state.dataset.get('watchlists')})
+
+    def update_watchlist(self, match, query, body):
+        for watchlist in self.state.dataset.get('watchlists'):
+            if watchlist['id'] == match.group('watchlist_id'):
+                watchlist.update({k: body[k] for k in ("name", "description", "tags_enabled", "report_ids")
+                                  if k in body})
+                self.send_json(watchlist)
+                return
+        self.send_json({"error_code": "NOT_FOUND", "message": "Unknown watchlist"}, 404)
+
+    def get_report(self, match, query, body):
+        self.send_json(self.state.dataset.report(match.group('report_id')))
+
+    def usb_device_search(self, match, query, body):
+        devices = self.state.dataset.get('usb_devices')
+        start = int(body.get('start') or 0)
+        rows = int(body.get('rows') or 20)
+        self.send_json({"results": devices[start:start + rows], "num_found": len(devices)})
+
+    def usb_device_endpoints(self, match, query, body):
+        usb_id = int(match.group('usb_id'))
+        self.send_json({"results": [{
+            "endpoint_id": usb_id * 10 + n,
+            "device_id": 100000 + (usb_id + n) % max(self.state.dataset.records, 1),
+            "device_name": f"mock-host-{100000 + (usb_id + n) % max(self.state.dataset.records, 1)}",
+            "first_seen": iso(self.state.dataset.now - timedelta(days=2)),
+            "last_seen": iso(self.state.dataset.now)
+        } for n in range(1 + usb_id % 3)], "num_found": 1 + usb_id % 3})
+
+    # Live Response
+
+    def start_session(self, match, query, body):
+        device_id = str(body.get('device_id'))
+        with self.state.lock:
+            polls = self.state.session_polls.get(device_id, 0) + 1
+            self.state.session_polls[device_id] = polls
+            session_id = self.state.sessions.get(device_id, {}).get('id') or f"1:{device_id}:{self.state.next_id()[:8]}"
+            status = "PENDING" if polls <= self.state.args.lr_pending_polls else "ACTIVE"
+            session = {
+                "id": session_id,
+                "device_id": int(device_id) if device_id.isdigit() else device_id,
+                "status": status,
+                "current_working_directory": "C:\\Windows\\system32",
+                "supported_commands": ["delete file", "put file", "reg enum key", "reg query value",
+                                       "reg create key", "reg delete key", "reg delete value", "reg set value",
+                                       "get file", "directory list", "create directory", "kill", "create process",
+                                       "process list", "memdump"]
+            }
+            self.state.sessions[device_id] = session
+        self.send_json(session)
+
+    def session_for(self, session_id):
+        for session in self.state.sessions.values():
+            if session['id'] == session_id:
+                return session
+        return None
+
+    def get_session(self, match, query, body):
+        session = self.session_for(match.group('session_id'))
+        if session is None:
+            self.send_json({"error_code": "NOT_FOUND", "message": "Unknown session"}, 404)
+        else:
+            self.send_json(session)
+
+    def close_session(self, match, query, body):
+        session = self.session_for(match.group('session_id'))
+        if session is not None:
+            with self.state.lock:
+                self.state.sessions.pop(str(session['device_id']), None)
+                self.state.session_polls.pop(str(session['device_id']), None)
+        self.send_empty(204)
+
+    def command_status(self, command):
+        result = dict(command)
+        if time.time() - command['created'] >= self.state.args.command_seconds:
+            result['status'] = "COMPLETE"
+            if command['name'] == "process list":
+                result['processes'] = [{"pid": 1000 + n, "process_path": f"c:\\windows\\{PROCESS_NAMES[n]}"}
+                                       for n in range(len(PROCESS_NAMES))]
+            elif command['name'] == "directory list":
+                result['files'] = [{"filename": f"file{n}.txt", "size": 1024 * n, "attributes": ["ARCHIVE"]}
+                                   for n in range(5)]
+        del result['created']
+        return result
+
+    def issue_command(self, match, query, body):
+        command_id = len(self.state.commands) + 1
+        name = body.get('name')
+        command = {
+            "id": command_id,
+            "session_id": match.group('session_id'),
+            "name": name,
+            "status": "PENDING",
+            "input": body,
+            "created": time.time(),
+            "create_time": iso(datetime.now(timezone.utc))
+        }
+        if name == "get file":
+            command["file_details"] = {"file_id": hashlib.md5(str(body.get('path')).encode()).hexdigest(),
+                                       "size": self.state.dataset.file_size}
+        with self.state.lock:
+            self.state.commands[command_id] = command
+        self.send_json(self.command_status(command) if self.state.args.command_seconds <= 0 else
+                       {k: v for k, v in command.items() if k != 'created'})
+
+    def get_command(self, match, query, body):
+        command = self.state.commands.get(int(match.group('command_id')))
+        if command is None:
+            self.send_json({"error_code": "NOT_FOUND", "message": "Unknown command"}, 404)
+        else:
+            self.send_json(self.command_status(command))
+
+    def file_content(self, match, query, body):
+        content = self.state.dataset.file_content(match.group('file_id'))
+        status = 200
+        range_header = re.fullmatch(r'bytes=(\d+)-', self.headers.get('Range') or '')
+        if range_header:
+            offset = int(range_header.group(1))
+            if offset >= len(content):
+                self.send_empty(416)
+                return
+            content = content[offset:]
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    # Counters and set-up
+
+    def mock_warm(self, match, query, body):
+        # Generate every kind of record now, so the first timed request does not pay for it
+        for kind in ("processes", "process_index", "alerts", "alert_index", "devices", "usb_devices",
+                     "audit_entries", "watchlists"):
+            self.state.dataset.get(kind)
+        self.send_json({"records": self.state.dataset.records})
+
+    def mock_stats(self, match, query, body):
+        with self.state.lock:
+            stats = dict(self.state.stats)
+            if self.command == "POST":
+                self.state.stats = {}
+        self.send_json(stats)
+
+
+ORG = r'/orgs/(?P<org_key>[^/]+)'
+INVESTIGATE = r'/api/investigate/v2' + ORG
+LIVE_RESPONSE = r'/appservices/v6' + ORG + r'/liveresponse/sessions'
+MockHandler.routes = [(method, re.compile(pattern), handler) for method, pattern, handler in [
+    ("POST", INVESTIGATE + r'/processes/search_jobs', MockHandler.start_process_search),
+    ("POST", INVESTIGATE + r'/processes/detail_jobs', MockHandler.start_process_detail),
+    ("GET", INVESTIGATE + r'/processes/search_jobs/(?P<job_id>[^/]+)/results', MockHandler.search_job_results),
+    ("GET", INVESTIGATE + r'/processes/detail_jobs/(?P<job_id>[^/]+)/results', MockHandler.detail_job_results),
+    ("POST", INVESTIGATE + r'/observations/search_jobs', MockHandler.start_observation_search),
+    ("GET", INVESTIGATE + r'/observations/search_jobs/(?P<job_id>[^/]+)/results', MockHandler.observation_job_results),
+    ("POST", INVESTIGATE + r'/events/(?P<process_guid>[^/]+)/_search', MockHandler.event_search),
+    ("POST", r'/api/alerts/v7' + ORG + r'/alerts/_search', MockHandler.alert_search),
+    ("POST", r'/api/alerts/v7' + ORG + r'/alerts/_facet', MockHandler.alert_facet),
+    ("POST", r'/api/alerts/v7' + ORG + r'/alerts/workflow', MockHandler.alert_workflow),
+    ("GET", r'/jobs/v1' + ORG + r'/jobs/(?P<job_id>[^/]+)', MockHandler.job_status),
+    ("POST", r'/appservices/v6' + ORG + r'/devices/_search', MockHandler.device_search),
+    ("POST", r'/appservices/v5' + ORG + r'/auditlog/find', MockHandler.audit_log),
+    ("GET", r'/threathunter/watchlistmgr/v3' + ORG + r'/watchlists', MockHandler.list_watchlists),
+    ("PUT", r'/threathunter/watchlistmgr/v3' + ORG + r'/watchlists/(?P<watchlist_id>[^/]+)',
+     MockHandler.update_watchlist),
+    ("GET", r'/threathunter/watchlistmgr/v3' + ORG + r'/reports/(?P<report_id>[^/]+)', MockHandler.get_report),
+    ("POST", r'/device_control/v3' + ORG + r'/devices/_search', MockHandler.usb_device_search),
+    ("GET", r'/device_control/v3' + ORG + r'/devices/(?P<usb_id>\d+)/endpoints', MockHandler.usb_device_endpoints),
+    ("POST", LIVE_RESPONSE, MockHandler.start_session),
+    ("GET", LIVE_RESPONSE + r'/(?P<session_id>[^/]+)', MockHandler.get_session),
+    ("DELETE", LIVE_RESPONSE + r'/(?P<session_id>[^/]+)', MockHandler.close_session),
+    ("POST", LIVE_RESPONSE + r'/(?P<session_id>[^/]+)/commands', MockHandler.issue_command),
+    ("GET", LIVE_RESPONSE + r'/(?P<session_id>[^/]+)/commands/(?P<command_id>\d+)', MockHandler.get_command),
+    ("GET", LIVE_RESPONSE + r'/(?P<session_id>[^/]+)/files/(?P<file_id>[^/]+)/content', MockHandler.file_content),
+    ("GET", r'/mock/stats', MockHandler.mock_stats),
+    ("POST", r'/mock/stats', MockHandler.mock_stats),
+    ("POST", r'/mock/warm', MockHandler.mock_warm),
+]]
+
+
+def main():
+    # Main function to parse arguments and run the mock server
+
+    parser = argparse.ArgumentParser(prog="mock-cbcloud.py",
+                                     description="Run a local mock of the VMware Carbon Black Cloud API.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="Port to listen on")
+    parser.add_argument("-r", "--records", type=int, default=1000,
+                        help="Number of processes, alerts, devices, USB devices and audit entries to generate")
+    parser.add_argument("--days", type=int, default=30, help="Days the generated records are spread over")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the generated data")
+    parser.add_argument("--latency_ms", type=float, default=0, help="Delay added to every answer")
+    parser.add_argument("--jitter_ms", type=float, default=0, help="Random extra delay of up to this much")
+    parser.add_argument("--rate_limit", type=int, default=0,
+                        help="Requests per second to allow before answering 429 (0 for no limit)")
+    parser.add_argument("--job_seconds", type=float, default=1,
+                        help="Seconds a search or detail job takes to complete")
+    parser.add_argument("--segments", type=int, default=2, help="Requests an event search takes to process")
+    parser.add_argument("--events_per_process", type=int, default=5, help="Events returned per process")
+    parser.add_argument("--lr_pending_polls", type=int, default=1,
+                        help="Session requests answered PENDING before a Live Response session is ACTIVE")
+    parser.add_argument("--command_seconds", type=float, default=1,
+                        help="Seconds a Live Response command stays PENDING")
+    parser.add_argument("--file_size", type=int, default=65536, help="Size of Live Response file contents in bytes")
+    parser.add_argument("-v", "--verbose", action='store_true', help="Log every request")
+    args = parser.parse_args()
+
+    dataset = Dataset(args.records, args.days, args.seed, args.events_per_process, args.file_size)
+    MockHandler.state = MockState(dataset, args)
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    print(f"Mock Carbon Black Cloud listening on http://{args.host}:{server.server_port} "
+          f"with {args.records} records", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(json.dumps(MockHandler.state.stats, indent=4))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,149 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+from collections import OrderedDict
+
+# The process detail cache shared by processes/processes.py, events/events.py, observations/observations-alert-id.py and
+# alerts/enrich-alerts.py. Those scripts load it from this directory by path, so it is not run on its own.
+
+
+def fields_digest(fields):
+    # A short hash of a field list, the same whatever order the fields are listed in
+
+    # rtype: string
+    return hashlib.sha256(",".join(sorted(fields)).encode()).hexdigest()[:12]
+
+
+class ProcessDetailCache:
+    # Process details keyed by process_guid. Entries are kept in memory (the least recently used are dropped beyond
+    # max_entries) and, when a filename is given, in a SQLite file that the processes, events, observations and alert
+    # scripts share between runs. Details of a process that has terminated never change, so they never expire; details
+    # of a running process expire after ttl seconds. Lookups for GUIDs that another thread is already fetching wait for
+    # that fetch instead of starting a second one. A script that keeps only some fields of each value passes them as
+    # fields: they become part of the kind, so it never reads values stored with another set of fields.
+    # On close, expired rows of this kind are deleted from the file, and when the file holds more than max_rows rows
+    # (of any kind) the longest-fetched ones are dropped, so the shared file stays bounded.
+
+    def __init__(self, filename=None, ttl=3600, max_entries=100000, kind="process_detail", fields=None,
+                 max_rows=200000):
+        self.memory = OrderedDict()
+        self.in_flight = {}
+        self.lock = threading.Lock()
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_rows = max_rows
+        self.kind = kind if fields is None else f"{kind}:{fields_digest(fields)}"
+        self.hits = 0
+        self.misses = 0
+        self.db = None
+        if filename:
+            os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+            self.db = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+            with self.db:
+                self.db.execute("""CREATE TABLE IF NOT EXISTS cache (
+                                       kind TEXT, key TEXT, value TEXT, fetched REAL, terminated INTEGER,
+                                       PRIMARY KEY (kind, key))""")
+
+    def fresh(self, fetched, terminated):
+        return bool(terminated) or time.time() - fetched < self.ttl
+
+    def remember(self, key, value, fetched, terminated):
+        self.memory[key] = (value, fetched, terminated)
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.max_entries:
+            self.memory.popitem(last=False)
+
+    def lookup(self, key):
+        # Called with the lock held. rtype: (found, value)
+        entry = self.memory.get(key)
+        if entry is not None:
+            if self.fresh(entry[1], entry[2]):
+                self.memory.move_to_end(key)
+                return True, entry[0]
+            del self.memory[key]
+        if self.db is not None:
+            row = self.db.execute("SELECT value, fetched, terminated FROM cache WHERE kind = ? AND key = ?",
+                                  (self.kind, key)).fetchone()
+            if row is not None and self.fresh(row[1], row[2]):
+                value = json.loads(row[0])
+                self.remember(key, value, row[1], row[2])
+                return True, value
+        return False, None
+
+    def store(self, values):
+        # Called with the lock held
+        now = time.time()
+        rows = []
+        for key, value in values.items():
+            terminated = 1 if isinstance(value, dict) and value.get('process_terminated') else 0
+            self.remember(key, value, now, terminated)
+            rows.append((self.kind, key, json.dumps(value), now, terminated))
+        if self.db is not None and rows:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?)", rows)
+
+    def get_many(self, keys, fetch):
+        # Return the cached value of every key, calling fetch(list_of_keys) -> dict for the ones not cached yet
+
+        # rtype: dict
+        results = {}
+        to_fetch = []
+        waits = []
+        with self.lock:
+            for key in dict.fromkeys(keys):
+                found, value = self.lookup(key)
+                if found:
+                    self.hits += 1
+                    results[key] = value
+                elif key in self.in_flight:
+                    waits.append(key)
+                else:
+                    self.misses += 1
+                    self.in_flight[key] = threading.Event()
+                    to_fetch.append(key)
+        fetched = {}
+        if to_fetch:
+            try:
+                fetched = fetch(to_fetch)
+            finally:
+                # Keys that could not be fetched are left out of the cache so they are tried again next time
+                with self.lock:
+                    self.store({key: fetched[key] for key in to_fetch if key in fetched})
+                    for key in to_fetch:
+                        self.in_flight.pop(key).set()
+        results.update(fetched)
+        for key in waits:
+            event = self.in_flight.get(key)
+            if event is not None:
+                event.wait()
+            with self.lock:
+                # A key whose fetch failed in the other thread is a miss, left out like the keys fetched here
+                found, value = self.lookup(key)
+                if found:
+                    self.hits += 1
+                    results[key] = value
+                else:
+                    self.misses += 1
+        return results
+
+    def prune(self):
+        # Delete the rows of this kind that have expired, then the longest-fetched rows beyond max_rows
+
+        # rtype: None
+        if self.db is None:
+            return
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM cache WHERE kind = ? AND terminated = 0 AND fetched < ?",
+                            (self.kind, time.time() - self.ttl))
+            excess = self.db.execute("SELECT COUNT(*) FROM cache").fetchone()[0] - self.max_rows
+            if excess > 0:
+                self.db.execute("DELETE FROM cache WHERE rowid IN (SELECT rowid FROM cache ORDER BY fetched LIMIT ?)",
+                                (excess,))
+
+    def close(self):
+        if self.db is not None:
+            self.prune()
+            self.db.close()
@@ -1,7 +1,9 @@
 import requests
 import argparse
 import sys
+import os
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 
 # This script exports the queried for USB devices and saves them as an Excel file. To change the query, look at the "payload" variable which is the
 # json-formatted request made to the CB Cloud back end. The developer documentation has a full list of what can be queried.
@@ -13,6 +15,7 @@ import pandas as pd
 # relevant "device0" "device1" etc. tab(s) also created which contains USB device details such as which endpoints it has been plugged into,
 # not just the *last* endpoint it was plugged into
 # If the -1 or --single command flag is given, the USB device information will be output to a single tab on the sheet.
+# The endpoints of each USB device are requested --workers at a time; the tabs are still written in device order.
 
 # Usage: python usb-devices.py --help
 
@@ -26,6 +29,9 @@ def get_environment(environment):
 
     # rtype: string
 
+    # CBC_BASE_URL points the script at another server instead, such as the local mock in tools/mock-cbcloud.py
+    if os.environ.get("CBC_BASE_URL"):
+        return os.environ["CBC_BASE_URL"].rstrip("/")
     if environment == "EAP1":
         return "https://defense-eap01.confer.deploy.net"
     elif environment == "PROD01":
@@ -78,14 +84,14 @@ def flatten_json(obj):
 
 def main():
 
-    def build_details_url(environment, org_key):
+    def build_details_url(environment, org_key, usb_id):
         # Build the summary URL
         # Documentation on this specific API call can be found here:
         # https://developer.carbonblack.com/reference/carbon-black-cloud/cb-defense/latest/device-control-api/#get-usb-device-by-id
         # rtype: string
 
         environment = get_environment(environment)
-        return f"{environment}/device_control/v3/orgs/{org_key}/devices/{j.usb_id}/endpoints"
+        return f"{environment}/device_control/v3/orgs/{org_key}/devices/{usb_id}/endpoints"
 
     # Main function to parse arguments and retrieve the endpoint results
 
@@ -94,6 +100,8 @@ def main():
                                          Cloud for USB device data.")
     parser.add_argument("-1", "--single", action='store_true',
                         help="Place all USB device info on a single Excel tab instead of 1 tab per USB device"),
+    parser.add_argument("-w", "--workers", type=int, default=8,
+                        help="Number of USB device endpoint requests to run concurrently")
     requiredNamed = parser.add_argument_group('required arguments')
     requiredNamed.add_argument("-e", "--environment", required=True, default="PROD05",
                                choices=["EAP1", "PROD01", "PROD02", "PROD05",
@@ -148,25 +156,28 @@ def main():
     if args.single:
         all_usb_devices_df = pd.DataFrame()
 
-    # Loop through each usb_id from the usb_devices dataframe and pull back the info
-    for i, j in usb_devices.iterrows():
-        req_url = build_details_url(args.environment, args.org_key)
+    def fetch_endpoints(usb_id):
+        req_url = build_details_url(args.environment, args.org_key, usb_id)
 
         # Make the request
         response = requests.get(req_url, headers=headers)
+        return response.json()
 
-        # Let's see what we've got
-        usb_device_endpoints_dict = response.json()
-        flattened_usb_device = flatten_json(usb_device_endpoints_dict)
-        usb_device = pd.DataFrame.from_dict(flattened_usb_device, orient='index', columns=['value'])
-        if args.single:
-            # Add dataframe row with device number
-            top_row = pd.DataFrame(['device'+str(i)],columns=['value'])
-            usb_device = pd.concat([top_row, usb_device])
-            # Append to a single dataframe
-            all_usb_devices_df = pd.concat([all_usb_devices_df, usb_device])
-        else:
-            usb_device.to_excel(xlwriter, sheet_name='device' + str(i))
+    # Loop through each usb_id from the usb_devices dataframe and pull back the info
+    with ThreadPoolExecutor(max_workers=args.workers) as executor:
+        usb_device_endpoints = executor.map(fetch_endpoints, usb_devices['usb_id'])
+        for (i, j), usb_device_endpoints_dict in zip(usb_devices.iterrows(), usb_device_endpoints):
+            # Let's see what we've got
+            flattened_usb_device = flatten_json(usb_device_endpoints_dict)
+            usb_device = pd.DataFrame.from_dict(flattened_usb_device, orient='index', columns=['value'])
+            if args.single:
+                # Add dataframe row with device number
+                top_row = pd.DataFrame(['device'+str(i)],columns=['value'])
+                usb_device = pd.concat([top_row, usb_device])
+                # Append to a single dataframe
+                all_usb_devices_df = pd.concat([all_usb_devices_df, usb_device])
+            else:
+                usb_device.to_excel(xlwriter, sheet_name='device' + str(i))
 
     if args.single:
         # Write the single dataframe out to Excel